@@ -0,0 +1,376 @@
+#!/usr/bin/python
+"""Commits the metadata retrieved from an org to a backup branch by
+streaming the retrieve zips into git fast-import, without writing a working
+tree. Files whose blobs match the previous commit are not sent again.
+
+To call from the Python CLI (with metadata present):
+    % ./backup_import.py -g ~/git/.mirrors/sf-org.git -b backup
+                         -u ~/git/ant-sf/package-all.xml
+    % ./backup_import.py -g ~/git/.mirrors/sf-org.git -b backup
+                         -z retrieved.zip
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_credentials={} BackupFromOrg
+
+To run the embedded tests: python -m doctest -v backup_import.py
+"""
+"""
+Use Case for backup_import.py
+
+Motivation: A backup through RetrieveFromOrg unzips the whole org to disk,
+deletes the problem components, and lets git status and git add rescan
+the whole tree, to commit a few dozen changes.
+
+Stakeholders: Release Engineering
+
+Output: A commit on the backup branch of the repository mirror, pushed to
+the remote, or a message that nothing changed.
+
+Prerequisite: The credentials and manifest are set as for retrieveUnpackaged,
+and the repository is reachable at repo_url.
+
+Assumptions:
+1. The branch holds the retrieved metadata under the source folder (src),
+and anything else on the branch is kept as is.
+2. The components excluded by the component filter (sf_componentFilter, as
+for fixComponents) are left out.
+
+Success Scenario:
+1. External actor invokes script from command line passing the mirror,
+branch and manifest.
+2. Process clones or fetches the bare mirror of repo_url.
+3. Process lists the blobs of the source folder in the last commit of the
+branch.
+4. Process retrieves the manifest in chunks and, as each zip arrives, hashes
+each entry, sending to fast-import only the blobs the branch lacks. The
+profiles and permission sets of the chunks are merged (see retrieve_chunked)
+and sent once every zip has arrived.
+5. Process commits the source folder, with the merged package.xml, on top
+of the branch, and pushes it.
+
+Alternate Scenario:
+(2a)
+1. No repo_url is given, and process uses the repository as it is.
+(4a)
+1. Zip files are given, and process imports them instead of retrieving.
+(5a)
+1. Every blob matches the branch, and process commits nothing.
+"""
+import argparse
+import subprocess
+from hashlib import sha1
+from os import environ, path
+from StringIO import StringIO
+from sys import exit
+from time import time
+from zipfile import ZipFile
+
+from lxml import etree
+
+from component_filter import load_filter
+from metadata_cache import cached_client, default_ttl
+from metadata_client import MetadataClient
+from poll_scheduler import default_initial_millis
+from retrieve_chunked import MANIFEST_NAME, build_manifest, \
+    default_chunk_size, default_jobs, expand_wildcards, merge_entry, \
+    merge_manifests, plan_chunks, read_manifest, retrieve_zips
+from tools_lxml import canonical_bytes, load_tree
+
+FILE_MODE = '100644'
+default_prefix = 'src'
+default_remote = 'origin'
+default_api_version = '38.0'
+
+def blob_sha(data):
+    """Returns the id git gives a blob of the data.
+
+    >>> print blob_sha('hello\\n')
+    ce013625030ba8dba906f756967f9e9ca394464a
+    """
+    return sha1('blob %d\0' % len(data) + data).hexdigest()
+
+
+def quote_path(filename):
+    """Quotes a path for fast-import where it would be misread.
+
+    >>> print quote_path('layouts/Case-Case Layout.layout')
+    layouts/Case-Case Layout.layout
+    >>> print quote_path('"odd\\nname')
+    "\\"odd\\nname"
+    """
+    if not (filename.startswith('"') or '\n' in filename):
+        return filename
+    return '"' + filename.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n') + '"'
+
+
+def git(gitdir, *args):
+    return subprocess.check_output(('git', '--git-dir', gitdir) + args)
+
+
+def ensure_mirror(gitdir, repo_url, remote=default_remote):
+    """Clones the bare mirror if missing, as sh/branch does, and fetches it."""
+    if not path.isdir(gitdir):
+        subprocess.check_call(['git', 'clone', '--bare', repo_url, gitdir])
+        git(gitdir, 'config', 'remote.%s.fetch' % remote,
+            '+refs/heads/*:refs/remotes/%s/*' % remote)
+    git(gitdir, 'fetch', '--prune', remote)
+
+
+def resolve_parent(gitdir, branch, remote=default_remote):
+    """Returns the commit the backup builds on: the remote branch, else the
+    local branch, else None."""
+    for ref in ('refs/remotes/%s/%s' % (remote, branch), 'refs/heads/' + branch):
+        try:
+            return git(gitdir, 'rev-parse', '--verify', '-q', ref + '^{commit}').strip()
+        except subprocess.CalledProcessError:
+            continue
+    return None
+
+
+def previous_blobs(gitdir, parent, prefix):
+    """Maps each path under the prefix in the parent commit to its blob id."""
+    if parent is None:
+        return {}
+    blobs = {}
+    for entry in git(gitdir, 'ls-tree', '-r', '-z', '--full-tree', parent, '--',
+                     prefix).split('\0'):
+        if entry:
+            (info, filename) = entry.split('\t', 1)
+            blobs[filename] = info.split()[2]
+    return blobs
+
+
+class FastImport:
+    """Streams blobs and one commit to git fast-import, skipping the blobs
+    the previous commit already has."""
+
+    def __init__(self, gitdir, previous):
+        self.previous = previous
+        self.known = set(previous.values())
+        self.blobs = {}
+        self.marks = {}
+        self.process = subprocess.Popen(['git', '--git-dir', gitdir, 'fast-import',
+                                         '--quiet', '--force'],
+                                        stdin=subprocess.PIPE)
+        self.stream = self.process.stdin
+
+    def add(self, filename, data):
+        """Records a file, sending its blob unless the repository has it."""
+        sha = blob_sha(data)
+        self.blobs[filename] = sha
+        if sha in self.marks or sha in self.known:
+            return
+        self.marks[sha] = ':%d' % (len(self.marks) + 1)
+        self.stream.write('blob\nmark {mark}\ndata {size}\n'.format(
+            mark=self.marks[sha], size=len(data)))
+        self.stream.write(data)
+        self.stream.write('\n')
+
+    def changed(self):
+        return self.blobs != self.previous
+
+    def commit(self, ref, parent, prefix, committer, message):
+        """Commits the recorded files as the whole prefix folder."""
+        self.stream.write('commit {ref}\ncommitter {committer} {when} +0000\n'
+                          'data {size}\n{message}\n'.format(
+                              ref=ref, committer=committer, when=int(time()),
+                              size=len(message), message=message))
+        if parent is not None:
+            self.stream.write('from {parent}\n'.format(parent=parent))
+        self.stream.write('D {prefix}\n'.format(prefix=quote_path(prefix)))
+        for filename in sorted(self.blobs):
+            sha = self.blobs[filename]
+            self.stream.write('M {mode} {data} {path}\n'.format(
+                mode=FILE_MODE, data=self.marks.get(sha, sha),
+                path=quote_path(filename)))
+        self.stream.write('\n')
+
+    def close(self):
+        self.stream.close()
+        if self.process.wait() != 0:
+            raise IOError('git fast-import failed.')
+
+
+def import_zips(gitdir, branch, zips, version, committer, message,
+                prefix=default_prefix, component_filter=None):
+    """Commits the entries of the zips as the prefix folder of the branch,
+    leaving out the components the filter excludes, and returns the number
+    of files, or 0 when nothing changed.
+
+    >>> from shutil import rmtree
+    >>> from tempfile import mkdtemp
+    >>> gitdir = mkdtemp()
+    >>> _ = git(gitdir, 'init', '-q', '--bare')
+    >>> def zip_of(files):
+    ...     zip_bytes = StringIO()
+    ...     zip_file = ZipFile(zip_bytes, 'w')
+    ...     for (name, text) in files:
+    ...         zip_file.writestr(name, text)
+    ...     zip_file.close()
+    ...     return zip_bytes.getvalue()
+    >>> chunk = [('classes/A.cls', 'a'), ('objects/Idea.object', 'x'),
+    ...          (MANIFEST_NAME, etree.tostring(build_manifest(
+    ...              {'ApexClass': ['A']}, '38.0')))]
+    >>> committer = 'Build <build@example.com>'
+    >>> import_zips(gitdir, 'backup', [zip_of(chunk)], '38.0', committer, 'one')
+    Committed 2 files to backup, sending 2 new blobs.
+    2
+    >>> import_zips(gitdir, 'backup', [zip_of(chunk)], '38.0', committer, 'two')
+    Nothing changed on backup.
+    0
+    >>> chunk[0] = ('classes/A.cls', 'b')
+    >>> import_zips(gitdir, 'backup', [zip_of(chunk)], '38.0', committer, 'three')
+    Committed 2 files to backup, sending 1 new blobs.
+    2
+    >>> print git(gitdir, 'log', '--format=%s', 'backup'),
+    three
+    one
+    >>> print git(gitdir, 'ls-tree', '-r', '--name-only', 'backup'),
+    src/classes/A.cls
+    src/package.xml
+    >>> rmtree(gitdir)
+    """
+    component_filter = load_filter() if component_filter is None \
+        else component_filter
+    parent = resolve_parent(gitdir, branch)
+    importer = FastImport(gitdir, previous_blobs(gitdir, parent, prefix))
+    roots = []
+    merged = {}
+    try:
+        for zip_bytes in zips:
+            zip_file = ZipFile(StringIO(zip_bytes))
+            for info in zip_file.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                if info.filename == MANIFEST_NAME:
+                    roots.append(etree.fromstring(zip_file.read(info)))
+                    continue
+                if component_filter.excludes_path(info.filename):
+                    continue
+                data = zip_file.read(info)
+                if not merge_entry(merged, info.filename, data):
+                    importer.add(prefix + '/' + info.filename, data)
+        for (name, index) in sorted(merged.items()):
+            importer.add(prefix + '/' + name, index.content())
+        types = read_manifest(merge_manifests(roots, version))[0]
+        importer.add(prefix + '/' + MANIFEST_NAME, canonical_bytes(build_manifest(
+            dict(component_filter.filter_types(types)), version)))
+        changed = importer.changed()
+        if changed:
+            importer.commit('refs/heads/' + branch, parent, prefix, committer, message)
+    finally:
+        importer.close()
+    if not changed:
+        print("Nothing changed on {branch}.".format(branch=branch))
+        return 0
+    print("Committed {count} files to {branch}, sending {sent} new blobs.".format(
+        count=len(importer.blobs), branch=branch, sent=len(importer.marks)))
+    return len(importer.blobs)
+
+
+def retrieved_zips(client, unpackaged, jobs=default_jobs,
+                   chunk_size=default_chunk_size, component_filter=None, **poll):
+    """Retrieves the manifest in chunks, less the excluded members, returning
+    its version and a generator of the zips."""
+    (types, version) = read_manifest(load_tree(unpackaged).getroot())
+    version = version or client.api_version
+    component_filter = load_filter() if component_filter is None \
+        else component_filter
+    types = component_filter.filter_types(expand_wildcards(client, types))
+    packages = [build_manifest(chunk, version)
+                for chunk in plan_chunks(types, chunk_size)]
+    return (version, retrieve_zips(client, packages, jobs, **poll))
+
+
+def main(gitdir, branch, version, zips, committer, message, repo_url=None,
+         remote=default_remote, component_filter=None):
+    """Fetches the mirror, imports the zips, and pushes the branch."""
+    if repo_url:
+        ensure_mirror(gitdir, repo_url, remote)
+    if import_zips(gitdir, branch, zips, version, committer, message,
+                   component_filter=component_filter) and repo_url:
+        git(gitdir, 'push', remote, 'refs/heads/{branch}:refs/heads/{branch}'.format(
+            branch=branch))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Commits the metadata "
+                                                 "retrieved from an org to a "
+                                                 "backup branch with git "
+                                                 "fast-import.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-g', '--gitdir', help="The bare repository mirror.")
+    parser.add_argument('-b', '--branch', help="The backup branch.")
+    parser.add_argument('-u', '--sf_unpackaged', help="The package.xml to "
+                                                      "retrieve.")
+    parser.add_argument('-z', '--zip', action='append', help="A retrieved zip "
+                                                             "to import instead "
+                                                             "(repeatable).")
+    parser.add_argument('-r', '--repo_url', help="The remote to fetch from and "
+                                                 "push to.")
+    return parser
+
+
+def __args_verify(gitdir, branch, unpackaged, zips, serverurl, username):
+    if gitdir is None or branch is None:
+        print("Requires gitdir, branch as parameters or system properties.")
+        exit(1)
+    if not zips and (unpackaged is None or serverurl is None or username is None):
+        print("Requires zip parameters, or sf_unpackaged with sf_serverurl, "
+              "sf_username, sf_password as system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    gitdir = environ.get('gitdir')
+    branch = environ.get('branch')
+    sf_serverurl = environ.get('sf_serverurl')
+    sf_username = environ.get('sf_username')
+    sf_password = environ.get('sf_password')
+    sf_unpackaged = environ.get('sf_unpackaged')
+    repo_url = environ.get('repo_url')
+    repo_config_user = environ.get('repo_config_user', 'build')
+    repo_config_email = environ.get('repo_config_email', 'build@example.com')
+    repo_message = environ.get('repo_message', 'Committed by build agent')
+    task = environ.get('task', '')
+    sf_apiVersion = environ.get('sf_apiVersion', default_api_version)
+    sf_jobs = int(environ.get('sf_jobs', default_jobs))
+    sf_chunkSize = int(environ.get('sf_chunkSize', default_chunk_size))
+    sf_pollInitialMillis = int(environ.get('sf_pollInitialMillis',
+                                           default_initial_millis))
+    sf_pollWaitMillis = int(environ.get('sf_pollWaitMillis', 30000))
+    sf_maxPoll = int(environ.get('sf_maxPoll', 600))
+    sf_metadataCache = environ.get('sf_metadataCache')
+    sf_metadataCacheTtl = int(environ.get('sf_metadataCacheTtl', default_ttl))
+    sf_componentFilter = environ.get('sf_componentFilter')
+
+    args = __parser_config().parse_args()
+
+    gitdir = args.gitdir if args.gitdir is not None else gitdir
+    branch = args.branch if args.branch is not None else branch
+    sf_unpackaged = args.sf_unpackaged if args.sf_unpackaged is not None else sf_unpackaged
+    repo_url = args.repo_url if args.repo_url is not None else repo_url
+    __args_verify(gitdir, branch, sf_unpackaged, args.zip, sf_serverurl, sf_username)
+
+    component_filter = load_filter(sf_componentFilter)
+    committer = '{user} <{email}>'.format(user=repo_config_user, email=repo_config_email)
+    message = '{task} {message}'.format(task=task, message=repo_message).strip()
+    client = None
+    if args.zip:
+        version = sf_apiVersion
+        zips = (open(filename, 'rb').read() for filename in args.zip)
+    else:
+        client = MetadataClient(sf_serverurl, sf_username, sf_password,
+                                api_version=sf_apiVersion, pool_size=sf_jobs)
+        if sf_metadataCache:
+            client = cached_client(client, sf_metadataCache, sf_metadataCacheTtl)
+        (version, zips) = retrieved_zips(
+            client, sf_unpackaged, sf_jobs, sf_chunkSize, component_filter,
+            initial_millis=sf_pollInitialMillis, max_millis=sf_pollWaitMillis,
+            timeout_millis=sf_pollWaitMillis * sf_maxPoll)
+    main(gitdir, branch, version, zips, committer, message, repo_url,
+         component_filter=component_filter)
+    if client is not None:
+        client.close()
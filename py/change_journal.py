@@ -0,0 +1,221 @@
+#!/usr/bin/python
+"""Reports the files that the transforms recorded in a change journal, so that
+commit, delta packaging and validation steps can work from exactly those
+files instead of rescanning the repository.
+
+To call from the Python CLI (with metadata present):
+    % ./change_journal.py -j ~/git/.journal -d ~/git/sf-org
+    % ./change_journal.py -j ~/git/.journal -d ~/git/sf-org -m ~/git/.journalSources
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_journal={} journalSources
+
+To run the embedded tests: python -m doctest -v change_journal.py
+"""
+"""
+Use Case for change_journal.py
+
+Motivation: The commit script finds changes with git status over the whole
+tree, and DeployDiff re-diffs git, though the transforms that ran (for
+example prefix_swap, version_forward or fixProfiles) already know which
+files they changed.
+
+Stakeholders: Release Engineering
+
+Output: The paths with a net change under homedir are printed, one per line
+or separated by NUL. Optionally, the changed sources, their companions and
+the manifest are mirrored into a folder to deploy or validate, or the
+journal is cleared.
+
+Prerequisite: The transforms ran with sf_journal naming the journal, so that
+tools_io (or sh/journal) recorded each file they wrote, renamed or removed.
+
+Assumptions:
+1. Each line of the journal holds the path, the operation, the hashes of the
+file before and after, and the step, as written by tools_io.journal_record.
+2. A file that ends as it began has no net change.
+3. Removed files cannot be deployed, and are not mirrored.
+
+Success Scenario:
+1. External actor invokes script from command line passing the journal and
+homedir.
+2. Process collapses the journal to the net change of each path.
+3. Process prints the paths under homedir, relative to it.
+
+Alternate Scenario:
+(3a)
+1. External actor passes a mirror folder, and process mirrors the changed
+files under the source folder, with their companions and package.xml, as
+pr_sources does.
+(3b)
+1. External actor passes --clear, and process empties the journal once
+its changes are consumed.
+(3c)
+1. External actor passes --record with the folder an sf:retrieve wrote, and
+process journals each retrieved file that differs from the file at the same
+place under the source folder, which the retrieve is then moved onto.
+"""
+import argparse
+import sys
+from os import environ, path, walk
+from sys import exit
+
+from pr_sources import companions, mirror_files
+from tools_io import existing_hash, file_hash, journal_paths, journal_record
+
+MANIFEST_NAME = 'package.xml'
+
+
+def source_changes(journal, sourcedir):
+    """Lists the changed files under the source folder that still exist,
+    relative to it, with their companions.
+
+    >>> from os import makedirs
+    >>> from tempfile import mkdtemp
+    >>> from tools_io import journal_record
+    >>> sourcedir = mkdtemp()
+    >>> makedirs(path.join(sourcedir, 'classes'))
+    >>> for name in ['A.cls', 'A.cls-meta.xml']:
+    ...     open(path.join(sourcedir, 'classes', name), 'w').write('v2')
+    >>> journal = path.join(sourcedir, '.journal')
+    >>> _ = journal_record(path.join(sourcedir, 'classes/A.cls'), 'a1', 'a2',
+    ...                    'test', journal)
+    >>> _ = journal_record(path.join(sourcedir, 'classes/B.cls'), 'b1', None,
+    ...                    'test', journal)
+    >>> source_changes(journal, sourcedir)
+    [u'classes/A.cls', u'classes/A.cls-meta.xml']
+    """
+    relpaths = [relpath for relpath in journal_paths(journal, sourcedir)
+                if path.isfile(path.join(sourcedir, relpath))]
+    for relpath in list(relpaths):
+        relpaths.extend(companions(relpath, sourcedir))
+    return sorted(set(relpaths))
+
+
+def record_tree(journal, stagedir, sourcedir):
+    """Journals each file under stagedir that differs from the file at the
+    same place under sourcedir, as moving stagedir onto sourcedir will write
+    it, and returns the number of changes journaled.
+
+    >>> from os import makedirs
+    >>> from tempfile import mkdtemp
+    >>> folder = mkdtemp()
+    >>> for name in ['stage/classes', 'src/classes']:
+    ...     makedirs(path.join(folder, name))
+    >>> for (name, content) in [('stage/classes/A.cls', 'a'),
+    ...         ('stage/classes/B.cls', 'b2'), ('src/classes/A.cls', 'a'),
+    ...         ('src/classes/B.cls', 'b1')]:
+    ...     open(path.join(folder, name), 'w').write(content)
+    >>> journal = path.join(folder, '.journal')
+    >>> record_tree(journal, path.join(folder, 'stage'), path.join(folder, 'src'))
+    1
+    >>> main(journal, folder)
+    src/classes/B.cls
+    0
+    """
+    count = 0
+    for (dirpath, dirnames, filenames) in walk(stagedir):
+        for name in filenames:
+            staged = path.join(dirpath, name)
+            filename = path.join(sourcedir, path.relpath(staged, stagedir))
+            before = existing_hash(filename)
+            after = file_hash(staged)
+            if before != after:
+                journal_record(filename, before, after, journal=journal)
+                count += 1
+    return count
+
+
+def clear(journal):
+    """Empties the journal, keeping the file."""
+    if path.isfile(journal):
+        open(journal, 'w').close()
+
+
+def main(journal, homedir, sourcedir=None, mirrordir=None, separator='\n'):
+    """Prints the changed paths under homedir, or mirrors the changed sources
+    into mirrordir.
+
+    >>> from tempfile import mkdtemp
+    >>> from tools_io import journal_record
+    >>> homedir = mkdtemp()
+    >>> journal = path.join(homedir, '.journal')
+    >>> _ = journal_record(path.join(homedir, 'src/package.xml'), 'p1', 'p2',
+    ...                    'test', journal)
+    >>> _ = journal_record(path.join(homedir, 'src/classes/A.cls'), 'a1', 'a2',
+    ...                    'test', journal)
+    >>> main(journal, homedir)
+    src/classes/A.cls
+    src/package.xml
+    0
+    """
+    if mirrordir is None:
+        for relpath in journal_paths(journal, homedir):
+            sys.stdout.write(relpath + separator)
+        return 0
+    sourcedir = path.join(homedir, 'src') if sourcedir is None else sourcedir
+    relpaths = source_changes(journal, sourcedir) + [MANIFEST_NAME]
+    count = mirror_files(sourcedir, relpaths, mirrordir)
+    print("Mirrored {count} journaled and companion files to {mirrordir}.".format(
+        count=count, mirrordir=mirrordir))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Reports the files recorded "
+                                                 "in a change journal.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-j', '--sf_journal', help="The change journal.")
+    parser.add_argument('-d', '--homedir', help="The repository the paths are "
+                                                "reported under.")
+    parser.add_argument('-s', '--sf_sourcedir', help="The source folder (homedir/"
+                                                     "src by default).")
+    parser.add_argument('-m', '--sf_journalSourcedir', help="A folder to mirror "
+                                                            "the changed sources "
+                                                            "into.")
+    parser.add_argument('-0', '--null', action='store_true',
+                        help="Separate the paths with NUL, as for xargs -0.")
+    parser.add_argument('--clear', action='store_true',
+                        help="Empty the journal instead.")
+    parser.add_argument('--record', help="Journal the files a retrieve wrote "
+                                         "to this folder, as they will be "
+                                         "moved onto the source folder, "
+                                         "instead.")
+    return parser
+
+
+def __args_verify(journal, homedir):
+    if journal is None or homedir is None:
+        print("Requires sf_journal, homedir as parameters or system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    sf_journal = environ.get('sf_journal')
+    homedir = environ.get('homedir')
+    sf_sourcedir = environ.get('sf_sourcedir')
+    sf_journalSourcedir = environ.get('sf_journalSourcedir')
+
+    args = __parser_config().parse_args()
+
+    sf_journal = args.sf_journal if args.sf_journal is not None else sf_journal
+    homedir = args.homedir if args.homedir is not None else homedir
+    sf_sourcedir = args.sf_sourcedir if args.sf_sourcedir is not None \
+        else sf_sourcedir
+    sf_journalSourcedir = args.sf_journalSourcedir \
+        if args.sf_journalSourcedir is not None else sf_journalSourcedir
+    if args.clear:
+        __args_verify(sf_journal, '')
+        clear(sf_journal)
+        exit(0)
+    if args.record is not None:
+        # the journal is off while sf_journal is empty
+        if sf_journal:
+            __args_verify(sf_journal, sf_sourcedir)
+            print("Journaled {count} retrieved files.".format(
+                count=record_tree(sf_journal, args.record, sf_sourcedir)))
+        exit(0)
+    __args_verify(sf_journal, homedir)
+
+    main(sf_journal, homedir, sf_sourcedir, sf_journalSourcedir,
+         '\0' if args.null else '\n')
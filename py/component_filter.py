@@ -0,0 +1,317 @@
+#!/usr/bin/python
+"""Removes the components matched by a rules file of path globs and
+type:member globs from a source folder and its package.xml. The same
+matcher keeps them out of the retrieve manifests and zips of
+retrieve_chunked and backup_import.
+
+To call from the Python CLI (with metadata present):
+    % ./component_filter.py -s ~/git/sf-org/src -f ~/git/ant-sf/components-excluded.txt
+
+To call from the Ant CLI: ant -Dhome={} fixComponents
+
+To run the embedded tests: python -m doctest -v component_filter.py
+"""
+"""
+Use Case for component_filter.py
+
+Motivation: fixComponents deleted a fixed list of problem components after
+the retrieve had written them, though every org needs a different list, and
+a component left out of the manifest is never retrieved at all.
+
+Stakeholders: Release Engineering
+
+Output: The source folder without the excluded files (and their -meta.xml
+companions), and its package.xml without the excluded members.
+
+Prerequisite: A rules file, by default components-excluded.txt in the tool
+folder, lists one rule per line:
+1. A path glob relative to the source folder, such as objects/Idea.object
+or workflows/Social*.workflow.
+2. A type:member glob, such as Workflow:Social* or CustomObject:Idea.
+In a glob, * matches within a folder, ** matches across folders, and ? one
+character. Blank lines and lines starting with # are ignored.
+
+Assumptions:
+1. A file under a folder of FOLDERS is the component named by its path, so
+a path rule also matches manifest members, and a type rule also matches
+files.
+2. A wildcard member is never excluded; the files it retrieves are.
+
+Success Scenario:
+1. External actor invokes script from command line passing the source folder
+and the rules file.
+2. Process compiles the rules into one regular expression.
+3. Process removes each file under the source folder whose path or component
+matches, recording it in the change journal.
+4. Process removes the matching members from package.xml, and any types left
+without members.
+5. Process prints the number of files and members removed.
+"""
+import argparse
+import re
+from os import environ, path, walk
+from sys import exit
+
+from dependency_graph import FOLDERS as GRAPH_FOLDERS, META_SUFFIX, \
+    component_key
+from tools_io import remove_file
+from tools_lxml import SF_URI, load_tree, save_tree
+
+MANIFEST_NAME = 'package.xml'
+WILDCARD = '*'
+COMMENT = '#'
+default_rules = path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                          'components-excluded.txt')
+
+# folder: (metadata type, file suffix), for the components named by path
+FOLDERS = dict(GRAPH_FOLDERS)
+FOLDERS.update({'applications': ('CustomApplication', '.app'),
+                'flows': ('Flow', '.flow'),
+                'layouts': ('Layout', '.layout'),
+                'settings': ('Settings', '.settings'),
+                'staticresources': ('StaticResource', '.resource'),
+                'tabs': ('CustomTab', '.tab'),
+                'workflows': ('Workflow', '.workflow')})
+TYPE_FOLDERS = dict((metadata_type, (folder, suffix))
+                    for (folder, (metadata_type, suffix)) in FOLDERS.items())
+
+
+def glob_regex(glob):
+    """Translates a glob into a regular expression, where * matches within a
+    folder and ** across folders.
+
+    >>> print glob_regex('workflows/Social*.workflow')
+    workflows\\/Social[^/]*\\.workflow
+    >>> print glob_regex('aura/**')
+    aura\\/.*
+    """
+    parts = []
+    for token in re.split(r'(\*\*|\*|\?)', glob):
+        if token == '**':
+            parts.append('.*')
+        elif token == '*':
+            parts.append('[^/]*')
+        elif token == '?':
+            parts.append('[^/]')
+        else:
+            parts.append(re.escape(token))
+    return ''.join(parts)
+
+
+def read_rules(filename):
+    """Returns the rules of a rules file, skipping blanks and comments."""
+    with open(filename) as rules_file:
+        return [line.strip() for line in rules_file
+                if line.strip() and not line.strip().startswith(COMMENT)]
+
+
+def file_component(relpath):
+    """Returns the type:member key of the component a file belongs to, or None
+    for folders outside FOLDERS.
+
+    >>> print file_component('layouts/CaseInteraction-Case Feed Layout.layout')
+    Layout:CaseInteraction-Case Feed Layout
+    >>> print file_component('classes/A.cls-meta.xml'), file_component('A.txt')
+    ApexClass:A None
+    """
+    parts = relpath.split('/', 2)
+    if len(parts) < 2 or parts[0] not in FOLDERS:
+        return None
+    (metadata_type, suffix) = FOLDERS[parts[0]]
+    name = parts[1]
+    if name.endswith(META_SUFFIX):
+        name = name[:-len(META_SUFFIX)]
+    if name.endswith(suffix):
+        name = name[:-len(suffix)]
+    return component_key(metadata_type, name)
+
+
+def member_path(metadata_type, member):
+    """Returns the path of the file a member retrieves as, or None for types
+    outside FOLDERS.
+
+    >>> print member_path('Workflow', 'SocialPost')
+    workflows/SocialPost.workflow
+    """
+    if metadata_type not in TYPE_FOLDERS:
+        return None
+    (folder, suffix) = TYPE_FOLDERS[metadata_type]
+    return folder + '/' + member + suffix
+
+
+class ComponentFilter:
+    """Matches files and manifest members against the rules, compiled into one
+    regular expression over paths and type:member keys.
+
+    >>> component_filter = ComponentFilter(['objects/Idea.object',
+    ...                                     'Workflow:Social*'])
+    >>> component_filter.excludes_path('objects/Idea.object-meta.xml')
+    True
+    >>> component_filter.excludes_path('workflows/SocialPost.workflow')
+    True
+    >>> component_filter.excludes_member('CustomObject', 'Idea')
+    True
+    >>> component_filter.excludes_member('CustomObject', 'Ideas__c')
+    False
+    >>> component_filter.excludes_member('Workflow', WILDCARD)
+    False
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.my_pattern = None
+        if rules:
+            self.my_pattern = re.compile('(?:%s)\\Z' % '|'.join(
+                '(?:%s)' % glob_regex(rule) for rule in rules), re.DOTALL)
+
+    def matches(self, *keys):
+        return self.my_pattern is not None and any(
+            key is not None and self.my_pattern.match(key) is not None
+            for key in keys)
+
+    def excludes_path(self, relpath):
+        """Returns True if a file, by path relative to the source folder, is
+        excluded itself or as part of an excluded component."""
+        if relpath.endswith(META_SUFFIX):
+            relpath = relpath[:-len(META_SUFFIX)]
+        return self.matches(relpath, file_component(relpath))
+
+    def excludes_member(self, metadata_type, member):
+        """Returns True if a manifest member is excluded by type or by the
+        path it retrieves as."""
+        if member == WILDCARD:
+            return False
+        return self.matches(component_key(metadata_type, member),
+                            member_path(metadata_type, member))
+
+    def filter_types(self, types):
+        """Drops the excluded members from (type, members) pairs, and any type
+        left without members.
+
+        >>> ComponentFilter(['settings/Ideas.settings']).filter_types(
+        ...     [('Settings', ['Ideas']), ('ApexClass', ['A', '*'])])
+        [('ApexClass', ['A', '*'])]
+        """
+        filtered = []
+        for (name, members) in types:
+            members = [member for member in members
+                       if not self.excludes_member(name, member)]
+            if members:
+                filtered.append((name, members))
+        return filtered
+
+
+def load_filter(filename=None):
+    """Returns the filter of a rules file, or of the default rules if none is
+    given (an empty filter if they are missing). Exits if a rules file is
+    given but missing, rather than letting every component through.
+
+    >>> len(load_filter().rules)
+    10
+    >>> load_filter('missing-rules.txt')
+    Traceback (most recent call last):
+    SystemExit: 1
+    """
+    if not filename:
+        if not path.isfile(default_rules):
+            return ComponentFilter([])
+        filename = default_rules
+    elif not path.isfile(filename):
+        print("Rules file {filename} not found.".format(filename=filename))
+        exit(1)
+    return ComponentFilter(read_rules(filename))
+
+
+def filter_manifest(filename, component_filter):
+    """Removes the excluded members from a package.xml, and returns the
+    number removed."""
+    tree = load_tree(filename)
+    root = tree.getroot()
+    ns = {'md': SF_URI}
+    count = 0
+    for types in root.findall('md:types', namespaces=ns):
+        name = types.findtext('md:name', namespaces=ns)
+        for member in types.findall('md:members', namespaces=ns):
+            if component_filter.excludes_member(name, member.text):
+                types.remove(member)
+                count += 1
+        if types.find('md:members', namespaces=ns) is None:
+            root.remove(types)
+    if count:
+        save_tree(root, filename)
+    return count
+
+
+def main(sourcedir, component_filter):
+    """Removes the excluded files from the source folder and the excluded
+    members from its package.xml.
+
+    >>> from os import makedirs
+    >>> from tempfile import mkdtemp
+    >>> from retrieve_chunked import build_manifest
+    >>> sourcedir = mkdtemp()
+    >>> for name in ['classes/A.cls', 'classes/A.cls-meta.xml',
+    ...              'objects/Idea.object', 'workflows/SocialPost.workflow']:
+    ...     if not path.isdir(path.join(sourcedir, path.dirname(name))):
+    ...         makedirs(path.join(sourcedir, path.dirname(name)))
+    ...     open(path.join(sourcedir, name), 'w').write('')
+    >>> _ = save_tree(build_manifest({'ApexClass': ['A'], 'CustomObject': ['Idea'],
+    ...     'Workflow': ['*']}, '38.0'), path.join(sourcedir, MANIFEST_NAME))
+    >>> main(sourcedir, load_filter())
+    Removed 2 files and 1 members excluded by 10 rules.
+    0
+    >>> sorted(name for (dirpath, dirnames, names) in walk(sourcedir)
+    ...        for name in names)
+    ['A.cls', 'A.cls-meta.xml', 'package.xml']
+    """
+    removed = 0
+    for (dirpath, dirnames, filenames) in walk(sourcedir):
+        for filename in filenames:
+            filename = path.join(dirpath, filename)
+            relpath = path.relpath(filename, sourcedir).replace(path.sep, '/')
+            if relpath != MANIFEST_NAME and component_filter.excludes_path(relpath):
+                remove_file(filename)
+                removed += 1
+    members = 0
+    manifest = path.join(sourcedir, MANIFEST_NAME)
+    if path.isfile(manifest):
+        members = filter_manifest(manifest, component_filter)
+    print("Removed {removed} files and {members} members excluded by {rules} "
+          "rules.".format(removed=removed, members=members,
+                          rules=len(component_filter.rules)))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Removes the components "
+                                                 "matched by a rules file from "
+                                                 "a source folder and its "
+                                                 "package.xml.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-s', '--sf_sourcedir', help="The source folder.")
+    parser.add_argument('-f', '--sf_componentFilter', help="The rules file "
+                                                           "(components-"
+                                                           "excluded.txt by "
+                                                           "default).")
+    return parser
+
+
+def __args_verify(sourcedir):
+    if sourcedir is None:
+        print("Requires sf_sourcedir as a parameter or system property.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    sf_sourcedir = environ.get('sf_sourcedir')
+    sf_componentFilter = environ.get('sf_componentFilter')
+
+    args = __parser_config().parse_args()
+
+    sf_sourcedir = args.sf_sourcedir if args.sf_sourcedir is not None else sf_sourcedir
+    sf_componentFilter = args.sf_componentFilter \
+        if args.sf_componentFilter is not None else sf_componentFilter
+    __args_verify(sf_sourcedir)
+
+    exit(main(sf_sourcedir, load_filter(sf_componentFilter)))
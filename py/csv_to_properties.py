@@ -74,6 +74,35 @@ SEP = '='
 # = 'org-data/'
 
 
+def row_name(row, fields):
+    """Names a row by its label, group and phase columns.
+
+    >>> fields = ['label', 'group', 'phase', 'sf_credentials']
+    >>> print row_name({'label': 'acme', 'group': 'east', 'phase': '1'}, fields)
+    acme.east.1
+    """
+    return '{label}.{group}.{phase}'.format(
+        label=row[fields[LABEL_COL]],
+        group=row[fields[GROUP_COL]],
+        phase=row[fields[PHASE_COL]])
+
+
+def write_properties(f, row, fields):
+    """Renders each column of a row as a property, one per line.
+
+    >>> from StringIO import StringIO
+    >>> f = StringIO()
+    >>> write_properties(f, {'label': 'acme', 'sf_username': 'a@b.c'},
+    ...                  ['label', 'sf_username'])
+    >>> print f.getvalue(),
+    label=acme
+    sf_username=a@b.c
+    """
+    for field in fields:
+        f.write(field + SEP + row[field])
+        f.write('\n')
+
+
 def main(csvfile_path,properties_dir):
 
     with open(csvfile_path) as csvfile:
@@ -81,14 +110,9 @@ def main(csvfile_path,properties_dir):
         fields = reader.fieldnames
         count = 0
         for row in reader:
-            fn = '{label}.{group}.{phase}.properties'.format(
-                label=row[fields[LABEL_COL]],
-                group=row[fields[GROUP_COL]],
-                phase=row[fields[PHASE_COL]])
+            fn = row_name(row, fields) + '.properties'
             f = open(path.join(properties_dir, fn), 'w')
-            for field in fields:
-                f.write(field + SEP + row[field])
-                f.write('\n')
+            write_properties(f, row, fields)
             f.close()
             count += 1
 
@@ -0,0 +1,489 @@
+#!/usr/bin/python
+"""Indexes the references between metadata components under src/ and answers
+"what depends on X" queries. The index is persisted next to the metadata and
+updated incrementally, so that only files whose content changed are scanned
+again.
+
+To call from the Python CLI (with metadata present):
+    ./dependency_graph.py -d ~/git/sf-org -c ApexClass:AccountService
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_component=ApexClass:AccountService
+    dependencyGraph
+
+To run the embedded tests: python -m doctest -v dependency_graph.py
+"""
+"""
+Use Case for dependency_graph.py
+
+Motivation: Nothing in the build knows how components relate to each other,
+so a change to one class deploys and tests everything. A reference graph is
+the foundation for selecting the components and tests a change impacts.
+
+Stakeholders: Release Engineering
+
+Output: A persisted index (.dependency_graph.json in the homedir) and, when a
+component is given, the list of components that depend on it.
+
+Prerequisite: The metadata is checked out under homedir/src.
+
+Assumptions:
+1. Apex is case-insensitive, so references are matched without case.
+2. A reference is any identifier in a source file that names another
+component. Some references are found in comments or strings, which errs on
+the side of including a component.
+3. Custom fields are matched by their field name across all objects, since
+Apex usually reaches a field through a variable rather than the object name.
+
+Success Scenario:
+1. External actor invokes script from command line passing homedir and an
+optional component.
+2. Process loads the prior index, if any.
+3. Process walks src/, and compares each file with the index by modification
+time and size, and then by hash. Only changed files are scanned again.
+4. For each scanned file, process records the components the file defines and
+the names it refers to: Apex class to class, trigger to the object it fires
+on, page and component to controller, object field references, Label references (as named by
+zlabels_build.extract_full_name), and profile grants (as keyed by
+profile_delta.PARENTS).
+5. Process saves the index and resolves the names into a graph.
+6. Process prints the components that depend on the given component.
+
+Alternate Scenario:
+(6a)
+1. The transitive option is given, and process prints every component that
+depends on the given component directly or indirectly.
+"""
+import argparse
+import json
+from os import environ, path, stat, walk
+from re import compile, IGNORECASE
+from sys import exit
+
+from tools_io import file_hash
+from tools_lxml import load_tree, namespace_declare, namespace_prepend
+from profile_delta import PARENTS, fetch_elements, prune_elements
+from zlabels_build import extract_full_name
+
+GRAPH_FILE = '.dependency_graph.json'
+GRAPH_VERSION = 3
+
+# folder: (metadata type, file suffix) for components indexed by the graph
+FOLDERS = {'classes': ('ApexClass', '.cls'),
+           'triggers': ('ApexTrigger', '.trigger'),
+           'pages': ('ApexPage', '.page'),
+           'components': ('ApexComponent', '.component'),
+           'objects': ('CustomObject', '.object'),
+           'labels': ('CustomLabels', '.labels'),
+           'profiles': ('Profile', '.profile'),
+           'permissionsets': ('PermissionSet', '.permissionset')}
+META_SUFFIX = '-meta.xml'
+
+# profile section: metadata type of the component it grants
+GRANTS = {'applicationVisibilities': 'CustomApplication',
+          'classAccesses': 'ApexClass',
+          'fieldPermissions': 'CustomField',
+          'layoutAssignments': 'Layout',
+          'objectPermissions': 'CustomObject',
+          'pageAccesses': 'ApexPage',
+          'recordTypeVisibilities': 'RecordType',
+          'tabVisibilities': 'CustomTab'}
+
+# Identifier types that may be referenced by name from code
+CODE_TYPES = ('ApexClass', 'ApexPage', 'ApexComponent', 'CustomObject')
+
+IDENTIFIER = compile(r'[A-Za-z_][A-Za-z0-9_]*')
+LABEL = compile(r'\bLabel\.([A-Za-z0-9_]+)', IGNORECASE)
+CONTROLLER = compile(r'\b(?:controller|extensions)\s*=\s*"([^"]*)"', IGNORECASE)
+COMPONENT_TAG = compile(r'<c:([A-Za-z0-9_]+)', IGNORECASE)
+IS_TEST = compile(r'@isTest\b|\btestMethod\b', IGNORECASE)
+TRIGGER_HEADER = compile(r'\btrigger\s+[A-Za-z0-9_]+\s+on\s+([A-Za-z0-9_]+)',
+                         IGNORECASE)
+
+# Common Apex words that never name a component, omitted to keep the index small
+KEYWORDS = set(['if', 'else', 'for', 'while', 'do', 'return', 'new', 'null',
+                'true', 'false', 'this', 'super', 'public', 'private',
+                'protected', 'global', 'static', 'final', 'void', 'class',
+                'interface', 'extends', 'implements', 'with', 'without',
+                'sharing', 'override', 'virtual', 'abstract', 'try', 'catch',
+                'finally', 'throw', 'insert', 'update', 'upsert', 'delete',
+                'select', 'from', 'where', 'and', 'or', 'not', 'in', 'limit',
+                'order', 'by', 'string', 'integer', 'boolean', 'list', 'set',
+                'map', 'id', 'object', 'system', 'label', 'istest', 'trigger',
+                'on', 'before', 'after'])
+
+
+def component_key(metadata_type, name):
+    """Formats the key used for a component in the graph.
+
+    >>> print component_key('ApexClass', 'AccountService')
+    ApexClass:AccountService
+    """
+    return metadata_type + ':' + name
+
+
+def file_component(relpath):
+    """Returns the key of the component that a file under src/ belongs to,
+    including its -meta.xml companion, or None for untracked folders.
+
+    >>> print file_component('classes/AccountService.cls-meta.xml')
+    ApexClass:AccountService
+    >>> print file_component('labels/CustomLabels.labels')
+    CustomLabels:CustomLabels
+    >>> print file_component('documents/Logo.png')
+    None
+    """
+    parts = relpath.replace('\\', '/').split('/')
+    if len(parts) != 2 or parts[0] not in FOLDERS:
+        return None
+    (metadata_type, suffix) = FOLDERS[parts[0]]
+    name = parts[1]
+    if name.endswith(META_SUFFIX):
+        name = name[:-len(META_SUFFIX)]
+    if not name.endswith(suffix):
+        return None
+    return component_key(metadata_type, name[:-len(suffix)])
+
+
+def scan_code(content):
+    """Collects the names referenced by Apex, Visualforce, or a formula.
+
+    >>> refs = scan_code('new AccountService().run(Label.Greeting, x.Due__c);')
+    >>> print sorted(refs['tokens'])
+    ['accountservice', 'due__c', 'greeting', 'run', 'x']
+    >>> print refs['labels']
+    ['Label.Greeting']
+    """
+    tokens = set(token.lower() for token in IDENTIFIER.findall(content))
+    labels = set('Label.' + name for name in LABEL.findall(content))
+    return {'tokens': sorted(tokens - KEYWORDS),
+            'labels': sorted(labels)}
+
+
+def scan_trigger(content):
+    """Collects the names referenced by a trigger, and the object named in
+    its header as an explicit reference.
+
+    >>> refs = scan_trigger('trigger Rollup on Account (after update) {}')
+    >>> print refs['explicit'], refs['tokens']
+    ['CustomObject:Account'] ['account', 'rollup']
+    """
+    refs = scan_code(content)
+    header = TRIGGER_HEADER.search(content)
+    if header is not None:
+        refs['explicit'] = [component_key('CustomObject', header.group(1))]
+    return refs
+
+
+def scan_page(content):
+    """Collects the names referenced by a page or component, including the
+    controller and extensions, as explicit class references.
+
+    >>> refs = scan_page('<apex:page controller="Foo" extensions="Bar, Baz">'
+    ...                  '<c:Header/>{!$Label.Title}</apex:page>')
+    >>> print refs['explicit']
+    ['ApexClass:Bar', 'ApexClass:Baz', 'ApexClass:Foo', 'ApexComponent:Header']
+    >>> print refs['labels']
+    ['Label.Title']
+    """
+    refs = scan_code(content)
+    explicit = set()
+    for names in CONTROLLER.findall(content):
+        for name in names.split(','):
+            if name.strip():
+                explicit.add(component_key('ApexClass', name.strip()))
+    for name in COMPONENT_TAG.findall(content):
+        explicit.add(component_key('ApexComponent', name))
+    refs['explicit'] = sorted(explicit)
+    return refs
+
+
+def child_texts(root, parent_name, child_name):
+    """Returns the text of each child_name under the parent_name elements."""
+    ns = namespace_declare()
+    match = namespace_prepend(parent_name) + '/' + namespace_prepend(child_name)
+    return [x.text for x in root.findall(match, ns) if x.text is not None]
+
+
+def scan_object(filename, object_name):
+    """Collects the fields an object defines, and the objects and fields its
+    lookups and formulas refer to."""
+    root = load_tree(filename).getroot()
+    defines = [component_key('CustomField', object_name + '.' + name)
+               for name in child_texts(root, 'fields', 'fullName')]
+    formulas = ' '.join(child_texts(root, 'fields', 'formula') +
+                        child_texts(root, 'validationRules', 'errorConditionFormula'))
+    refs = scan_code(formulas)
+    refs['explicit'] = sorted(component_key('CustomObject', name) for name in
+                              set(child_texts(root, 'fields', 'referenceTo')))
+    return (defines, refs)
+
+
+def scan_labels(filename):
+    """Collects the labels defined by a CustomLabels document."""
+    root = load_tree(filename).getroot()
+    return [component_key('CustomLabel', name) for name in extract_full_name(root)]
+
+
+def scan_grants(filename):
+    """Collects the components granted by a profile or permission set,
+    leaving out the access elements that grant nothing.
+
+    >>> from tempfile import mkdtemp
+    >>> filename = path.join(mkdtemp(), 'Admin.profile')
+    >>> open(filename, 'w').write('<Profile xmlns="http://soap.sforce.com/'
+    ...     '2006/04/metadata"><classAccesses><apexClass>A</apexClass>'
+    ...     '<enabled>true</enabled></classAccesses><classAccesses>'
+    ...     '<apexClass>B</apexClass><enabled>false</enabled></classAccesses>'
+    ...     '</Profile>')
+    >>> scan_grants(filename)
+    {'explicit': ['ApexClass:A']}
+    """
+    root = prune_elements(load_tree(filename).getroot())
+    explicit = set()
+    for parent_name in PARENTS:
+        for name in fetch_elements(root, parent_name):
+            explicit.add(component_key(GRANTS[parent_name], name))
+    return {'explicit': sorted(explicit)}
+
+
+def scan_file(filename, relpath):
+    """Returns the index entry for one source file."""
+    key = file_component(relpath)
+    metadata_type = key.split(':')[0]
+    name = key.split(':', 1)[1]
+    entry = {'component': key, 'defines': [key], 'refs': {}, 'test': False}
+    if relpath.endswith(META_SUFFIX):
+        return entry
+    if metadata_type in ('ApexClass', 'ApexTrigger'):
+        content = open(filename, 'rb').read()
+        entry['refs'] = scan_trigger(content) if metadata_type == 'ApexTrigger' \
+            else scan_code(content)
+        entry['test'] = IS_TEST.search(content) is not None
+    elif metadata_type in ('ApexPage', 'ApexComponent'):
+        entry['refs'] = scan_page(open(filename, 'rb').read())
+    elif metadata_type == 'CustomObject':
+        (defines, entry['refs']) = scan_object(filename, name)
+        entry['defines'] += defines
+    elif metadata_type == 'CustomLabels':
+        entry['defines'] += scan_labels(filename)
+    elif metadata_type in ('Profile', 'PermissionSet'):
+        entry['refs'] = scan_grants(filename)
+    return entry
+
+
+class DependencyGraph:
+    """Maintains the file index and the reference graph derived from it.
+    Entries are keyed by the path relative to the source directory, and
+    hold the hash, modification time and size used to detect changes.
+    """
+
+    def __init__(self, sourcedir, graph_path=None):
+        self.sourcedir = sourcedir
+        self.graph_path = graph_path if graph_path is not None else \
+            path.join(path.dirname(path.abspath(sourcedir)), GRAPH_FILE)
+        self.files = {}
+        self.modified = False
+        self.my_edges = None
+        self.my_dependents = None
+
+    def load(self):
+        """Loads the persisted index, if compatible. Returns self."""
+        try:
+            with open(self.graph_path) as f:
+                data = json.load(f)
+            if data.get('version') == GRAPH_VERSION:
+                self.files = data['files']
+        except (IOError, ValueError):
+            self.files = {}
+        return self
+
+    def save(self):
+        """Writes the index if it changed since it was loaded."""
+        if self.modified:
+            with open(self.graph_path, 'w') as f:
+                json.dump({'version': GRAPH_VERSION, 'files': self.files}, f,
+                          sort_keys=True, separators=(',', ':'))
+            self.modified = False
+
+    def update(self):
+        """Rescans the files that changed since the last update, and drops
+        the files that were removed. Returns the number of files scanned."""
+        scanned = 0
+        seen = set()
+        for (root, dirs, files) in walk(self.sourcedir):
+            for basename in files:
+                filename = path.join(root, basename)
+                relpath = path.relpath(filename, self.sourcedir).replace('\\', '/')
+                if file_component(relpath) is None:
+                    continue
+                seen.add(relpath)
+                if self.update_file(filename, relpath):
+                    scanned += 1
+        for relpath in set(self.files) - seen:
+            del self.files[relpath]
+            self.modified = True
+        if self.modified:
+            self.my_edges = None
+            self.my_dependents = None
+        return scanned
+
+    def update_file(self, filename, relpath):
+        """Rescans a file if its content changed. Returns True if scanned."""
+        info = stat(filename)
+        entry = self.files.get(relpath)
+        if entry is not None and entry['mtime'] == info.st_mtime and \
+                entry['size'] == info.st_size:
+            return False
+        digest = file_hash(filename)
+        if entry is None or entry['hash'] != digest:
+            entry = scan_file(filename, relpath)
+            entry['hash'] = digest
+            scanned = True
+        else:
+            scanned = False
+        entry['mtime'] = info.st_mtime
+        entry['size'] = info.st_size
+        self.files[relpath] = entry
+        self.modified = True
+        return scanned
+
+    def definitions(self):
+        """Maps each lowercase name that code may use to the components."""
+        names = {}
+        for entry in self.files.values():
+            keys = list(entry['defines'])
+            if entry['component'].startswith('ApexTrigger:'):
+                # the object a trigger fires on may be standard, with no file
+                keys += entry['refs'].get('explicit', [])
+            for key in keys:
+                (metadata_type, name) = key.split(':', 1)
+                if metadata_type in CODE_TYPES:
+                    names.setdefault(name.lower(), set()).add(key)
+                elif metadata_type == 'CustomField' and '__' in name:
+                    field = name.split('.', 1)[1].lower()
+                    names.setdefault(field, set()).add(key)
+        return names
+
+    def edges(self):
+        """Returns the graph as component: set of referenced components."""
+        if self.my_edges is not None:
+            return self.my_edges
+        names = self.definitions()
+        labels = {}
+        for entry in self.files.values():
+            for key in entry['defines']:
+                if key.startswith('CustomLabel:'):
+                    labels[key.lower()] = key
+        edges = {}
+        for entry in self.files.values():
+            key = entry['component']
+            refs = entry['refs']
+            targets = edges.setdefault(key, set())
+            for token in refs.get('tokens', []):
+                targets.update(names.get(token, ()))
+            for label in refs.get('labels', []):
+                target = labels.get(component_key('CustomLabel', label).lower())
+                if target is not None:
+                    targets.add(target)
+            targets.update(refs.get('explicit', []))
+            targets.discard(key)
+        self.my_edges = edges
+        return edges
+
+    def dependents(self, key, transitive=False):
+        """Returns the components that refer to the given component.
+
+        >>> graph = DependencyGraph('src')
+        >>> graph.files = {
+        ...  'classes/A.cls': {'component': 'ApexClass:A', 'defines': ['ApexClass:A'],
+        ...                    'refs': {'tokens': ['b']}, 'test': False},
+        ...  'classes/B.cls': {'component': 'ApexClass:B', 'defines': ['ApexClass:B'],
+        ...                    'refs': {'tokens': ['c']}, 'test': False},
+        ...  'classes/C.cls': {'component': 'ApexClass:C', 'defines': ['ApexClass:C'],
+        ...                    'refs': {}, 'test': False}}
+        >>> print sorted(graph.dependents('ApexClass:C'))
+        ['ApexClass:B']
+        >>> print sorted(graph.dependents('ApexClass:C', True))
+        ['ApexClass:A', 'ApexClass:B']
+        """
+        if self.my_dependents is None:
+            reverse = {}
+            for (source, targets) in self.edges().items():
+                for target in targets:
+                    reverse.setdefault(target, set()).add(source)
+            self.my_dependents = reverse
+        found = set(self.my_dependents.get(key, ()))
+        if transitive:
+            pending = list(found)
+            while pending:
+                for source in self.my_dependents.get(pending.pop(), ()):
+                    if source not in found:
+                        found.add(source)
+                        pending.append(source)
+            found.discard(key)
+        return found
+
+    def references(self, key):
+        """Returns the components the given component refers to."""
+        return set(self.edges().get(key, ()))
+
+    def owner(self, key):
+        """Returns the component whose file defines the given key, such as
+        the object for a field, or the key itself."""
+        for entry in self.files.values():
+            if key in entry['defines']:
+                return entry['component']
+        return key
+
+
+def main(homedir, component, transitive=False):
+    """Updates the index for homedir/src and prints the dependents of the
+    component, if given."""
+    graph = DependencyGraph(path.join(homedir, 'src'),
+                            path.join(homedir, GRAPH_FILE)).load()
+    scanned = graph.update()
+    graph.save()
+    print("Indexed {count} files ({scanned} scanned).".format(
+        count=len(graph.files), scanned=scanned))
+    if component:
+        for key in sorted(graph.dependents(component, transitive)):
+            print(key)
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Indexes the references "
+                                                 "between metadata components "
+                                                 "and lists the components "
+                                                 "that depend on a component.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-d', '--homedir', help="The folder holding the "
+                                                "Salesforce metadata.")
+    parser.add_argument('-c', '--sf_component', help="The component to query, "
+                                                     "as Type:Name.")
+    parser.add_argument('-t', '--transitive', action='store_true',
+                        help="Include indirect dependents.")
+    return parser
+
+
+def __args_verify(homedir):
+    if homedir is None:
+        print("Requires homedir as a parameter or system property.")
+        exit(1)
+    if not path.exists(homedir):
+        print("The homedir does not exist: {}".format(homedir))
+        exit(1)
+
+
+if __name__ == '__main__':
+    homedir = environ.get('homedir')
+    sf_component = environ.get('sf_component')
+
+    args = __parser_config().parse_args()
+
+    homedir = args.homedir if args.homedir is not None else homedir
+    sf_component = args.sf_component if args.sf_component is not None else sf_component
+    __args_verify(homedir)
+
+    main(homedir, sf_component, args.transitive)
@@ -5,7 +5,7 @@ from sys import exit
 
 from lxml import etree
 
-from tools_lxml import print_tree, save_tree, sforce_root, sub_element_text, field_sets_element, namespace_declare, namespace_prepend
+from tools_lxml import load_tree, print_tree, save_tree, sforce_root, sub_element_text, field_sets_element, namespace_declare, namespace_prepend
 
 
 """Updates the Account object fieldSet elements to include expected Account
@@ -205,8 +205,7 @@ def main_verify_path(homedir):
 
 
 def main_parse_file(filename):
-    parser = etree.XMLParser(remove_blank_text=True)
-    return etree.parse(filename, parser)
+    return load_tree(filename)
 
 
 def main(homedir):
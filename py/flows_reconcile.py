@@ -0,0 +1,231 @@
+#!/usr/bin/python
+"""Reconciles local flows with the flows retrieved from the org. Local flow
+versions that are identical to, or older than, a version already on the
+server are removed, so that only real changes are deployed. Optionally
+writes a manifest restricted to the flows that still need deploying.
+
+To call from the Python CLI (with metadata present):
+    ./flows_reconcile.py -s ~/git/sf-org/server -d ~/git/sf-org/src
+                         -m ~/git/sf-org/flows-package.xml
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_credentials={} fixFlowVersions
+
+To run the embedded tests: python -m doctest -v flows_reconcile.py
+"""
+"""
+Use Case for flows_reconcile.py
+
+Motivation: A flow version cannot be deployed over an active version that
+already exists in the org. The prior shell script deleted every local flow that had
+a namesake on the server, one process per flow, without checking whether
+the content differed.
+
+Stakeholders: Release Engineering
+
+Output: The unneeded local flows are removed, the counts are printed, and
+(optionally) a package manifest lists the flows still to deploy.
+
+Prerequisite: The server flows are retrieved to serverdir/flows (see
+retrieveFlows), and the local flows are under sf_sourcedir/flows.
+
+Assumptions:
+1. Versioned flows are named Name-N.flow, where N is the version number.
+Unversioned flows are named Name.flow.
+2. Files with identical bytes are identical flows.
+3. Only an inactive version can be overwritten, so a changed version of the
+same name is kept and deployed, and the deploy reports a conflict if the
+version is active in the org.
+
+Success Scenario:
+1. External actor invokes script from command line passing serverdir and
+sf_sourcedir arguments.
+2. Process indexes the server and local flows by name, version and hash.
+3. For each local flow, process decides whether it is unchanged (same file
+and hash on the server), older (the server has a higher version of the same
+flow), changed (same file, different hash), or new.
+4. Process removes the unchanged and older flows.
+5. Process prints the tally of each outcome.
+
+Alternate Scenario:
+(2a)
+1. There are no server flows, and process keeps every local flow.
+(5a)
+1. A manifest path is given, and process writes a package.xml listing the
+changed and new flows, and their flow definitions.
+"""
+import argparse
+from os import environ, listdir, path
+from re import compile
+from sys import exit
+
+from tools_io import file_hash, remove_file
+from tools_lxml import save_tree, sforce_root, sub_element_text
+from lxml import etree
+
+FLOW_SUFFIX = '.flow'
+VERSIONED = compile(r'^(.+)-(\d+)$')
+UNCHANGED = 'unchanged'
+OLDER = 'older'
+CHANGED = 'changed'
+NEW = 'new'
+default_api_version = '38.0'
+
+
+def flow_version(filename):
+    """Splits a flow file name into its name and version number.
+
+    >>> flow_version('Escalate-3.flow')
+    ('Escalate', 3)
+    >>> flow_version('Escalate.flow')
+    ('Escalate', None)
+    """
+    member = filename[:-len(FLOW_SUFFIX)]
+    found = VERSIONED.match(member)
+    if found is None:
+        return (member, None)
+    return (found.group(1), int(found.group(2)))
+
+
+def index_flows(flowsdir):
+    """Maps each flow file name in a folder to its hash."""
+    flows = {}
+    if not path.isdir(flowsdir):
+        return flows
+    for filename in listdir(flowsdir):
+        if filename.endswith(FLOW_SUFFIX):
+            flows[filename] = file_hash(path.join(flowsdir, filename))
+    return flows
+
+
+def classify(local, server):
+    """Decides the outcome for each local flow given the server flows, where
+    both map file names to hashes.
+
+    >>> server = {'A-1.flow': 'x', 'A-2.flow': 'y', 'B-1.flow': 'z'}
+    >>> local = {'A-1.flow': 'x', 'A-2.flow': 'q', 'B-1.flow': 'z',
+    ...          'B-2.flow': 'w', 'C.flow': 'v'}
+    >>> outcomes = classify(local, server)
+    >>> for filename in sorted(outcomes):
+    ...     print filename, outcomes[filename]
+    A-1.flow unchanged
+    A-2.flow changed
+    B-1.flow unchanged
+    B-2.flow new
+    C.flow new
+    """
+    latest = {}
+    for filename in server:
+        (name, version) = flow_version(filename)
+        if version is not None and version > latest.get(name, -1):
+            latest[name] = version
+    outcomes = {}
+    for (filename, digest) in local.items():
+        (name, version) = flow_version(filename)
+        if server.get(filename) == digest:
+            outcomes[filename] = UNCHANGED
+        elif version is not None and version < latest.get(name, -1):
+            outcomes[filename] = OLDER
+        elif filename in server:
+            outcomes[filename] = CHANGED
+        else:
+            outcomes[filename] = NEW
+    return outcomes
+
+
+def build_manifest(filenames, version=default_api_version):
+    """Creates a package manifest for the given flow files.
+
+    >>> from tools_lxml import print_tree
+    >>> print_tree(build_manifest(['A-2.flow', 'B.flow']))
+    <?xml version='1.0' encoding='UTF-8'?>
+    <Package xmlns="http://soap.sforce.com/2006/04/metadata">
+      <types>
+        <members>A-2</members>
+        <members>B</members>
+        <name>Flow</name>
+      </types>
+      <types>
+        <members>A</members>
+        <members>B</members>
+        <name>FlowDefinition</name>
+      </types>
+      <version>38.0</version>
+    </Package>
+    <BLANKLINE>
+    """
+    root = sforce_root('Package')
+    members = sorted(filename[:-len(FLOW_SUFFIX)] for filename in filenames)
+    names = sorted(set(flow_version(filename)[0] for filename in filenames))
+    for (metadata_type, type_members) in [('Flow', members),
+                                          ('FlowDefinition', names)]:
+        if type_members:
+            types = etree.SubElement(root, 'types')
+            for member in type_members:
+                sub_element_text(types, 'members', member)
+            sub_element_text(types, 'name', metadata_type)
+    sub_element_text(root, 'version', version)
+    return root
+
+
+def main(serverdir, sourcedir, manifest_path=None, sf_apiVersion=None):
+    """Removes the local flows that need not be deployed, and reports the
+    tally of each outcome."""
+    flowsdir = path.join(sourcedir, 'flows')
+    outcomes = classify(index_flows(flowsdir),
+                        index_flows(path.join(serverdir, 'flows')))
+    tally = dict((outcome, 0) for outcome in (UNCHANGED, OLDER, CHANGED, NEW))
+    for (filename, outcome) in outcomes.items():
+        tally[outcome] += 1
+        if outcome in (UNCHANGED, OLDER):
+            remove_file(path.join(flowsdir, filename))
+    print("Removed {unchanged} unchanged and {older} older flows. "
+          "Kept {changed} changed and {new} new flows.".format(**tally))
+    if manifest_path:
+        deploy = [filename for (filename, outcome) in outcomes.items()
+                  if outcome in (CHANGED, NEW)]
+        save_tree(build_manifest(deploy, sf_apiVersion or default_api_version),
+                  manifest_path)
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Removes local flows that "
+                                                 "are unchanged or older than "
+                                                 "the flows in the org.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-s', '--serverdir', help="The folder holding the "
+                                                  "flows retrieved from the "
+                                                  "org.")
+    parser.add_argument('-d', '--sf_sourcedir', help="The folder holding the "
+                                                     "local metadata.")
+    parser.add_argument('-m', '--manifest', help="The package.xml to write "
+                                                 "for the flows to deploy.")
+    parser.add_argument('-v', '--sf_apiVersion', help="The API version to "
+                                                      "include in the "
+                                                      "manifest.")
+    return parser
+
+
+def __args_verify(serverdir, sourcedir):
+    if serverdir is None or sourcedir is None:
+        print("Requires serverdir, sf_sourcedir as parameters or system "
+              "properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    serverdir = environ.get('serverdir')
+    sf_sourcedir = environ.get('sf_sourcedir')
+    manifest = environ.get('sf_flows_manifest')
+    sf_apiVersion = environ.get('sf_apiVersion')
+
+    args = __parser_config().parse_args()
+
+    serverdir = args.serverdir if args.serverdir is not None else serverdir
+    sf_sourcedir = args.sf_sourcedir if args.sf_sourcedir is not None else sf_sourcedir
+    manifest = args.manifest if args.manifest is not None else manifest
+    sf_apiVersion = args.sf_apiVersion if args.sf_apiVersion is not None else sf_apiVersion
+    __args_verify(serverdir, sf_sourcedir)
+
+    main(serverdir, sf_sourcedir, manifest, sf_apiVersion)
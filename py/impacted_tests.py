@@ -0,0 +1,296 @@
+#!/usr/bin/python
+"""Selects the Apex test classes impacted by the files changed between two
+git refs, and renders the properties and buildfile that run only those tests
+with a RunSpecifiedTests deploy.
+
+To call from the Python CLI (with metadata present):
+    ./impacted_tests.py -d ~/git/sf-org -f previousDeployment -t HEAD
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_credentials={}
+    -DpreviousDeployment=master-org deployImpacted
+
+To run the embedded tests: python -m doctest -v impacted_tests.py
+"""
+"""
+Use Case for impacted_tests.py
+
+Motivation: Deploys either skip tests or run every local test, and on
+production RunLocalTests takes over an hour. Most changes impact a handful of
+test classes, which can be run with RunSpecifiedTests instead.
+
+Stakeholders: Release Engineering
+
+Output: impactedTests.properties, setting sf_testLevel and sf_runTests, and
+impactedTests.xml, a buildfile whose deploySpecifiedTests target deploys
+sf_deployRoot with one runTest element per impacted test class.
+
+Prerequisite: The metadata repository is checked out to homedir, and both
+refs are available locally (as for DeployDiff's previousDeployment tag).
+If sf_journal names a change journal, the files changed by transforms since
+the last commit are included as well.
+
+Assumptions:
+1. A test class is impacted if it refers to a changed component, directly or
+through other components (see dependency_graph).
+2. A change to an object impacts every field the object defines, and a change
+to CustomLabels impacts every label.
+3. A change to a trigger impacts the object it fires on (as named in its
+header), so the tests that refer to the object are selected.
+
+Success Scenario:
+1. External actor invokes script from command line passing homedir and the
+from and to refs.
+2. Process lists the files changed between the refs with git diff, and
+adds any changed files recorded in the journal.
+3. Process updates the dependency graph, scanning only files whose hash
+changed since the last run.
+4. Process maps each changed file to its component and collects the
+components that depend on it.
+5. Process selects the impacted classes marked @isTest.
+6. Process writes the properties file and buildfile, and prints the tests.
+
+Alternate Scenario:
+(5a)
+1. No Apex is impacted, and process sets sf_testLevel to NoTestRun.
+(5b)
+1. Apex is impacted but no test class refers to it, and process falls back to
+RunLocalTests.
+"""
+import argparse
+import subprocess
+from os import environ, path
+from sys import exit
+
+from lxml import etree
+
+from dependency_graph import DependencyGraph, GRAPH_FILE, file_component
+from tools_io import journal_paths
+from tools_lxml import save_tree
+
+OUTPUT_NAME = 'impactedTests'
+SRC_PREFIX = 'src/'
+APEX_TYPES = ('ApexClass', 'ApexTrigger')
+
+# Attributes passed through to sf:deploy, as set by deployUnpackaged
+DEPLOY_ATTRIBUTES = ['username', 'password', 'serverurl', 'pollWaitMillis',
+                     'maxPoll', 'checkOnly', 'deployRoot', 'singlePackage',
+                     'allowMissingFiles', 'autoUpdatePackage', 'ignoreWarnings',
+                     'logType', 'purgeOnDelete', 'rollbackOnError', 'testLevel']
+
+
+def changed_files(homedir, from_ref, to_ref):
+    """Lists the repository paths changed between two refs."""
+    output = subprocess.check_output(['git', 'diff', '--name-only', from_ref,
+                                      to_ref], cwd=homedir)
+    return [line for line in output.splitlines() if line]
+
+
+def changed_components(graph, filenames):
+    """Maps changed repository paths to the keys of the components they
+    hold, expanding objects to their fields and CustomLabels to its labels.
+
+    >>> graph = DependencyGraph('src')
+    >>> graph.files = {'objects/Account.object': {
+    ...     'component': 'CustomObject:Account',
+    ...     'defines': ['CustomObject:Account', 'CustomField:Account.Due__c'],
+    ...     'refs': {}, 'test': False}}
+    >>> print sorted(changed_components(graph, ['src/objects/Account.object',
+    ...                                         'README.md']))
+    ['CustomField:Account.Due__c', 'CustomObject:Account']
+    """
+    keys = set()
+    for filename in filenames:
+        if not filename.startswith(SRC_PREFIX):
+            continue
+        relpath = filename[len(SRC_PREFIX):]
+        key = file_component(relpath)
+        if key is None:
+            continue
+        keys.add(key)
+        entry = graph.files.get(relpath)
+        if entry is not None:
+            keys.update(entry['defines'])
+    return keys
+
+
+def trigger_objects(graph, keys):
+    """Returns the keys of the objects the changed triggers fire on, as
+    dependency_graph records them from each trigger's header."""
+    objects = set()
+    for entry in graph.files.values():
+        if entry['component'] in keys and \
+                entry['component'].startswith('ApexTrigger:'):
+            objects.update(ref for ref in entry['refs'].get('explicit', [])
+                           if ref.startswith('CustomObject:'))
+    return objects
+
+
+def test_classes(graph):
+    """Returns the keys of the ApexClass components marked as tests."""
+    return set(entry['component'] for entry in graph.files.values()
+               if entry['test'] and entry['component'].startswith('ApexClass:'))
+
+
+def impacted_tests(graph, keys):
+    """Returns the sorted names of the test classes impacted by the changed
+    component keys, and whether any Apex is impacted.
+
+    >>> graph = DependencyGraph('src')
+    >>> graph.files = {
+    ...  'classes/A.cls': {'component': 'ApexClass:A', 'defines': ['ApexClass:A'],
+    ...                    'refs': {}, 'test': False},
+    ...  'classes/ATest.cls': {'component': 'ApexClass:ATest',
+    ...                        'defines': ['ApexClass:ATest'],
+    ...                        'refs': {'tokens': ['a']}, 'test': True},
+    ...  'classes/BTest.cls': {'component': 'ApexClass:BTest',
+    ...                        'defines': ['ApexClass:BTest'],
+    ...                        'refs': {}, 'test': True}}
+    >>> impacted_tests(graph, set(['ApexClass:A']))
+    (['ATest'], True)
+    >>> impacted_tests(graph, set(['Layout:Account-Account Layout']))
+    ([], False)
+    >>> graph.files['triggers/Rollup.trigger'] = {
+    ...     'component': 'ApexTrigger:Rollup', 'defines': ['ApexTrigger:Rollup'],
+    ...     'refs': {'tokens': ['account'],
+    ...              'explicit': ['CustomObject:Account']}, 'test': False}
+    >>> graph.files['classes/BTest.cls']['refs'] = {'tokens': ['account']}
+    >>> graph.my_edges = graph.my_dependents = None
+    >>> impacted_tests(graph, set(['ApexTrigger:Rollup']))
+    (['BTest'], True)
+    """
+    keys = set(keys) | trigger_objects(graph, keys)
+    impacted = set(keys)
+    for key in keys:
+        impacted.update(graph.dependents(key, transitive=True))
+    tests = sorted(key.split(':', 1)[1] for key in impacted & test_classes(graph))
+    apex = any(key.split(':', 1)[0] in APEX_TYPES for key in impacted)
+    return (tests, apex)
+
+
+def test_level(tests, apex):
+    """Chooses the test level for the impacted tests.
+
+    >>> print test_level(['ATest'], True)
+    RunSpecifiedTests
+    >>> print test_level([], True)
+    RunLocalTests
+    >>> print test_level([], False)
+    NoTestRun
+    """
+    if tests:
+        return 'RunSpecifiedTests'
+    return 'RunLocalTests' if apex else 'NoTestRun'
+
+
+def render_properties(level, tests):
+    """Formats the property block read by the deployImpacted target.
+
+    >>> print render_properties('RunSpecifiedTests', ['ATest', 'BTest']),
+    sf_testLevel=RunSpecifiedTests
+    sf_runTests=ATest,BTest
+    """
+    return 'sf_testLevel={level}\nsf_runTests={tests}\n'.format(
+        level=level, tests=','.join(tests))
+
+
+def render_buildfile(tests):
+    """Builds an Ant project whose deploySpecifiedTests target runs sf:deploy
+    with a runTest element for each test class. Ant cannot expand a list
+    property into nested elements, so the elements are generated here.
+
+    >>> from tools_lxml import canonical_bytes
+    >>> print canonical_bytes(render_buildfile(['ATest'])),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <project name="sfImpactedTests" xmlns:sf="antlib:com.salesforce">
+        <taskdef uri="antlib:com.salesforce" resource="com/salesforce/antlib.xml" classpath="${tooldir}/lib/ant-salesforce-39.0.jar"/>
+        <target name="deploySpecifiedTests">
+            <sf:deploy username="${sf_username}" password="${sf_password}${sf_securityToken}" serverurl="${sf_serverurl}" pollWaitMillis="${sf_pollWaitMillis}" maxPoll="${sf_maxPoll}" checkOnly="${sf_checkOnly}" deployRoot="${sf_deployRoot}" singlePackage="${sf_singlePackage}" allowMissingFiles="${sf_allowMissingFiles}" autoUpdatePackage="${sf_autoUpdatePackage}" ignoreWarnings="${sf_ignoreWarnings}" logType="${sf_logType}" purgeOnDelete="${sf_purgeOnDelete}" rollbackOnError="${sf_rollbackOnError}" testLevel="${sf_testLevel}">
+                <runTest>ATest</runTest>
+            </sf:deploy>
+        </target>
+    </project>
+    """
+    sf_uri = 'antlib:com.salesforce'
+    project = etree.Element('project', nsmap={'sf': sf_uri})
+    project.set('name', 'sfImpactedTests')
+    taskdef = etree.SubElement(project, 'taskdef')
+    taskdef.set('uri', sf_uri)
+    taskdef.set('resource', 'com/salesforce/antlib.xml')
+    taskdef.set('classpath', '${tooldir}/lib/ant-salesforce-39.0.jar')
+    target = etree.SubElement(project, 'target')
+    target.set('name', 'deploySpecifiedTests')
+    deploy = etree.SubElement(target, '{%s}deploy' % sf_uri)
+    for attribute in DEPLOY_ATTRIBUTES:
+        value = '${sf_%s}' % attribute
+        if attribute == 'password':
+            value += '${sf_securityToken}'
+        deploy.set(attribute, value)
+    for test in tests:
+        etree.SubElement(deploy, 'runTest').text = test
+    return project
+
+
+def main(homedir, from_ref, to_ref, output_dir=None, journal=None):
+    """Writes the impacted test selection for the changes between two refs,
+    and any changes in the journal, to output_dir (the homedir by default)."""
+    output_dir = homedir if output_dir is None else output_dir
+    graph = DependencyGraph(path.join(homedir, 'src'),
+                            path.join(homedir, GRAPH_FILE)).load()
+    graph.update()
+    graph.save()
+    filenames = changed_files(homedir, from_ref, to_ref)
+    if journal:
+        filenames = sorted(set(filenames).union(journal_paths(journal, homedir)))
+    keys = changed_components(graph, filenames)
+    (tests, apex) = impacted_tests(graph, keys)
+    level = test_level(tests, apex)
+    with open(path.join(output_dir, OUTPUT_NAME + '.properties'), 'w') as f:
+        f.write(render_properties(level, tests))
+    save_tree(render_buildfile(tests), path.join(output_dir, OUTPUT_NAME + '.xml'))
+    print("{count} components changed, {tests} tests impacted, using {level}."
+          .format(count=len(keys), tests=len(tests), level=level))
+    for test in tests:
+        print(test)
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Selects the Apex test "
+                                                 "classes impacted by the "
+                                                 "changes between two refs.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-d', '--homedir', help="The repository holding the "
+                                                "Salesforce metadata.")
+    parser.add_argument('-f', '--previousDeployment', help="The ref of the "
+                                                           "prior deployment.")
+    parser.add_argument('-t', '--to_ref', default='HEAD',
+                        help="The ref being deployed (HEAD by default).")
+    parser.add_argument('-o', '--output_dir', help="The folder for the "
+                                                   "properties and buildfile.")
+    return parser
+
+
+def __args_verify(homedir, previous_deployment):
+    if homedir is None or previous_deployment is None:
+        print("Requires homedir, previousDeployment as parameters or system "
+              "properties.")
+        exit(1)
+    if not path.exists(homedir):
+        print("The homedir does not exist: {}".format(homedir))
+        exit(1)
+
+
+if __name__ == '__main__':
+    homedir = environ.get('homedir')
+    previous_deployment = environ.get('previousDeployment')
+    sf_journal = environ.get('sf_journal')
+
+    args = __parser_config().parse_args()
+
+    homedir = args.homedir if args.homedir is not None else homedir
+    previous_deployment = args.previousDeployment \
+        if args.previousDeployment is not None else previous_deployment
+    __args_verify(homedir, previous_deployment)
+
+    main(homedir, previous_deployment, args.to_ref, args.output_dir, sf_journal)
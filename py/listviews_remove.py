@@ -5,7 +5,11 @@ from sys import exit
 
 from lxml import etree
 
-from tools_lxml import print_tree, save_tree, sforce_root, field_sets_element, list_views_element, namespace_prepend, namespace_declare
+from tools_io import contains_any
+from tools_lxml import load_tree, print_tree, save_tree, sforce_root, field_sets_element, list_views_element, namespace_prepend, namespace_declare
+
+# Objects without these bytes have no ListView elements to remove
+LIST_VIEWS_TOKEN = '<listViews>'
 
 """Remove the ListView elements from the Account and Contact objects."""
 """
@@ -128,12 +132,14 @@ def main_verify_object(homedir,component):
 
 
 def main_parse_file(filename):
-    parser = etree.XMLParser(remove_blank_text=True)
-    return etree.parse(filename, parser)
+    return load_tree(filename)
 
 
 def do_component(component):
     filename = main_verify_object(homedir, component)
+    if not contains_any(filename, [LIST_VIEWS_TOKEN]):
+        # nothing to remove, so the document need not be parsed
+        return
     tree = main_parse_file(filename)
     root = strip_listviews(tree.getroot())
     if root is not None:
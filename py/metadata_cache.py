@@ -0,0 +1,346 @@
+#!/usr/bin/python
+"""Caches describeMetadata and listMetadata results in a SQLite file, keyed
+by org user and API version, so that manifest, chunking and validation
+steps can look up types and members without calling the org.
+
+To call from the Python CLI (with metadata present):
+    % ./metadata_cache.py -f ~/git/.metadataCache.sqlite
+    % ./metadata_cache.py -f ~/git/.metadataCache.sqlite -t ApexClass
+    % ./metadata_cache.py -f ~/git/.metadataCache.sqlite -i -t ApexClass
+
+To call from the Ant CLI: ant -Dsf_credentials={} -Dsf_metadataType=ApexClass
+                              metadataCache
+
+To run the embedded tests: python -m doctest -v metadata_cache.py
+"""
+"""
+Use Case for metadata_cache.py
+
+Motivation: The describe and list targets call the org every time, and each
+script that needs the types or members of an org lists them again.
+
+Stakeholders: Release Engineering
+
+Output: The metadata types, or the members of a type, printed one per line.
+The cache file is updated as a side effect.
+
+Prerequisite: Credentials are set as for retrieveUnpackaged, unless every
+answer is already cached.
+
+Assumptions:
+1. A listing stays valid for sf_metadataCacheTtl seconds, and a describe for
+a week, unless invalidated.
+
+Success Scenario:
+1. External actor invokes script from command line passing the cache file.
+2. Process prints the cached metadata types, describing the org if the
+describe is missing or stale.
+
+Alternate Scenario:
+(2a)
+1. A metadata type is given, and process prints its cached members, listing
+them in the org if the listing is missing or stale.
+(2b)
+1. Invalidate is given, and process drops the cached listings of the type
+(or, with no type, everything cached for the user) and prints the count.
+"""
+import argparse
+import json
+import sqlite3
+from os import environ
+from sys import exit
+from threading import Lock
+from time import time
+
+from metadata_client import MetadataClient
+
+CACHE_NAME = '.metadataCache.sqlite'
+DESCRIBE_TTL = 7 * 24 * 3600
+default_ttl = 3600
+default_api_version = '38.0'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS describes (
+    org TEXT, api_version TEXT, fetched REAL, fields TEXT,
+    PRIMARY KEY (org, api_version));
+CREATE TABLE IF NOT EXISTS types (
+    org TEXT, api_version TEXT, xml_name TEXT, fields TEXT,
+    PRIMARY KEY (org, api_version, xml_name));
+CREATE TABLE IF NOT EXISTS listings (
+    org TEXT, api_version TEXT, type TEXT, folder TEXT, fetched REAL,
+    PRIMARY KEY (org, api_version, type, folder));
+CREATE TABLE IF NOT EXISTS members (
+    org TEXT, api_version TEXT, type TEXT, folder TEXT, full_name TEXT,
+    fields TEXT,
+    PRIMARY KEY (org, api_version, type, folder, full_name));
+"""
+
+
+def query_folder(fields, folder):
+    """Tells whether a listed component answers a query for the folder.
+
+    >>> query_folder({'fullName': 'Ops/Weekly'}, 'Ops')
+    True
+    >>> query_folder({'fullName': 'Sales/Weekly'}, 'Ops')
+    False
+    >>> query_folder({'fullName': 'Account'}, '')
+    True
+    """
+    return not folder or fields['fullName'].startswith(folder + '/')
+
+
+class MetadataCache:
+    """The cached describe and listings of one org user and API version. An
+    instance is safe to share between threads.
+
+    >>> cache = MetadataCache(':memory:', 'user@example.com', '38.0', ttl=60,
+    ...                       clock=lambda: 1000.0)
+    >>> print cache.listing('ApexClass')
+    None
+    >>> cache.put_listing('ApexClass', None, [
+    ...     {'type': 'ApexClass', 'fullName': 'B', 'fileName': 'classes/B.cls'},
+    ...     {'type': 'ApexClass', 'fullName': 'A', 'fileName': 'classes/A.cls'}])
+    >>> print [fields['fullName'] for fields in cache.listing('ApexClass')]
+    [u'A', u'B']
+    >>> print cache.members('ApexClass')
+    [u'A', u'B']
+    >>> cache.clock = lambda: 1061.0
+    >>> print cache.listing('ApexClass'), cache.members('ApexClass')
+    None [u'A', u'B']
+    >>> cache.invalidate(['ApexClass'])
+    1
+    >>> print cache.members('ApexClass')
+    []
+    """
+
+    def __init__(self, filename, org, api_version=default_api_version,
+                 ttl=default_ttl, clock=time):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.key = (org, api_version)
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = Lock()
+
+    def fresh(self, fetched, ttl):
+        return fetched is not None and self.clock() - fetched < ttl
+
+    def describe(self):
+        """Returns the cached describe fields, or None when stale."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT fetched, fields FROM describes WHERE org=? AND api_version=?',
+                self.key).fetchone()
+            if row is None or not self.fresh(row[0], DESCRIBE_TTL):
+                return None
+            fields = json.loads(row[1])
+            fields['metadataObjects'] = [json.loads(type_fields) for (type_fields,) in
+                                         self.connection.execute(
+                'SELECT fields FROM types WHERE org=? AND api_version=? '
+                'ORDER BY xml_name', self.key)]
+            return fields
+
+    def put_describe(self, fields):
+        fields = dict(fields)
+        types = fields.pop('metadataObjects', [])
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM types WHERE org=? AND api_version=?',
+                                    self.key)
+            self.connection.executemany(
+                'INSERT INTO types VALUES (?, ?, ?, ?)',
+                [self.key + (type_fields['xmlName'], json.dumps(type_fields))
+                 for type_fields in types])
+            self.connection.execute('INSERT OR REPLACE INTO describes VALUES (?, ?, ?, ?)',
+                                    self.key + (self.clock(), json.dumps(fields)))
+
+    def types(self):
+        """Returns the cached metadata type names, stale or not."""
+        with self.lock:
+            return [name for (name,) in self.connection.execute(
+                'SELECT xml_name FROM types WHERE org=? AND api_version=? '
+                'ORDER BY xml_name', self.key)]
+
+    def listing(self, metadata_type, folder=None):
+        """Returns the cached file properties for a query, or None when
+        stale."""
+        query = self.key + (metadata_type, folder or '')
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT fetched FROM listings WHERE org=? AND api_version=? AND '
+                'type=? AND folder=?', query).fetchone()
+            if row is None or not self.fresh(row[0], self.ttl):
+                return None
+            return [json.loads(fields) for (fields,) in self.connection.execute(
+                'SELECT fields FROM members WHERE org=? AND api_version=? AND '
+                'type=? AND folder=? ORDER BY full_name', query)]
+
+    def put_listing(self, metadata_type, folder, results):
+        query = self.key + (metadata_type, folder or '')
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM members WHERE org=? AND api_version=? AND type=? AND '
+                'folder=?', query)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)',
+                [query + (fields['fullName'], json.dumps(fields)) for fields in results])
+            self.connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                                    query + (self.clock(),))
+
+    def members(self, metadata_type):
+        """Returns the cached member names of a type, stale or not."""
+        with self.lock:
+            return [name for (name,) in self.connection.execute(
+                'SELECT DISTINCT full_name FROM members WHERE org=? AND '
+                'api_version=? AND type=? ORDER BY full_name',
+                self.key + (metadata_type,))]
+
+    def invalidate(self, metadata_types=None):
+        """Drops the listings of the types, or everything cached for the org
+        user and API version, and returns the number of listings dropped."""
+        with self.lock, self.connection:
+            if metadata_types is None:
+                self.connection.execute('DELETE FROM describes WHERE org=? AND '
+                                        'api_version=?', self.key)
+                self.connection.execute('DELETE FROM types WHERE org=? AND '
+                                        'api_version=?', self.key)
+                where = ('', ())
+            else:
+                where = (' AND type IN (%s)' % ','.join('?' * len(metadata_types)),
+                         tuple(metadata_types))
+            self.connection.execute('DELETE FROM members WHERE org=? AND '
+                                    'api_version=?' + where[0], self.key + where[1])
+            return self.connection.execute('DELETE FROM listings WHERE org=? AND '
+                                           'api_version=?' + where[0],
+                                           self.key + where[1]).rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedMetadataClient:
+    """Answers describe_metadata and list_metadata from the cache where it is
+    fresh, and from the client otherwise, storing what the client returns.
+    Other calls go to the client.
+
+    >>> from metadata_client import StubServer
+    >>> calls = []
+    >>> def list_handler(request):
+    ...     calls.append(request)
+    ...     return [[('type', 'Report'), ('fullName', 'Ops/Weekly')],
+    ...             [('type', 'ApexClass'), ('fullName', 'A')]]
+    >>> stub = StubServer({'listMetadata': list_handler})
+    >>> client = CachedMetadataClient(MetadataClient(stub.url, 'user', 'pass'),
+    ...                               MetadataCache(':memory:', 'user'))
+    >>> print [fields['fullName'] for fields in client.list_metadata(
+    ...     [('Report', 'Ops'), ('ApexClass', None)])]
+    ['Ops/Weekly', 'A']
+    >>> print [fields['fullName'] for fields in client.list_metadata(
+    ...     [('ApexClass', None)])], len(calls)
+    [u'A'] 1
+    >>> client.close(); stub.close()
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def describe_metadata(self):
+        fields = self.cache.describe()
+        if fields is None:
+            fields = self.client.describe_metadata()
+            self.cache.put_describe(fields)
+        return fields
+
+    def list_metadata(self, queries):
+        results = []
+        missing = []
+        for (metadata_type, folder) in queries:
+            cached = self.cache.listing(metadata_type, folder)
+            if cached is None:
+                missing.append((metadata_type, folder))
+            else:
+                results.extend(cached)
+        if missing:
+            listed = self.client.list_metadata(missing)
+            for (metadata_type, folder) in missing:
+                self.cache.put_listing(metadata_type, folder, [
+                    fields for fields in listed if fields.get('type') == metadata_type
+                    and query_folder(fields, folder)])
+            results.extend(listed)
+        return results
+
+    def close(self):
+        self.client.close()
+        self.cache.close()
+
+
+def cached_client(client, filename, ttl=default_ttl):
+    """Wraps a client with the cache in filename for its user."""
+    cache = MetadataCache(filename, client.username or client.serverurl,
+                          client.api_version, ttl)
+    return CachedMetadataClient(client, cache)
+
+
+def main(client, metadata_type=None, invalidate=False):
+    """Prints the types, or the members of a type, or invalidates them."""
+    if invalidate:
+        count = client.cache.invalidate([metadata_type] if metadata_type else None)
+        print("Invalidated {count} listings.".format(count=count))
+    elif metadata_type is None:
+        for fields in client.describe_metadata()['metadataObjects']:
+            print(fields['xmlName'])
+    else:
+        client.list_metadata([(metadata_type, None)])
+        for member in client.cache.members(metadata_type):
+            print(member)
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Prints the metadata types or "
+                                                 "members of an org from a "
+                                                 "local cache.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-f', '--sf_metadataCache', help="The cache file.")
+    parser.add_argument('-t', '--sf_metadataType', help="The type whose "
+                                                        "members to print.")
+    parser.add_argument('-i', '--invalidate', action='store_true',
+                        help="Drops the cached listings of the type, or "
+                             "everything cached for the user.")
+    return parser
+
+
+def __args_verify(serverurl, username, metadata_cache):
+    if serverurl is None or username is None or metadata_cache is None:
+        print("Requires sf_serverurl, sf_username, sf_password as system "
+              "properties, and sf_metadataCache as a parameter or system "
+              "property.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    sf_serverurl = environ.get('sf_serverurl')
+    sf_username = environ.get('sf_username')
+    sf_password = environ.get('sf_password')
+    sf_metadataCache = environ.get('sf_metadataCache')
+    sf_apiVersion = environ.get('sf_apiVersion', default_api_version)
+    sf_metadataCacheTtl = int(environ.get('sf_metadataCacheTtl', default_ttl))
+    sf_metadataType = environ.get('sf_metadataType') or None
+
+    args = __parser_config().parse_args()
+
+    sf_metadataCache = args.sf_metadataCache if args.sf_metadataCache is not None \
+        else sf_metadataCache
+    sf_metadataType = args.sf_metadataType if args.sf_metadataType is not None \
+        else sf_metadataType
+    __args_verify(sf_serverurl, sf_username, sf_metadataCache)
+
+    client = cached_client(MetadataClient(sf_serverurl, sf_username, sf_password,
+                                          api_version=sf_apiVersion),
+                           sf_metadataCache, sf_metadataCacheTtl)
+    main(client, sf_metadataType, args.invalidate)
+    client.close()
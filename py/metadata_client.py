@@ -0,0 +1,441 @@
+#!/usr/bin/python
+"""Calls the Salesforce Metadata API operations used by the sf: Ant tasks
+(retrieve, deploy, checkRetrieveStatus, checkDeployStatus, listMetadata and
+describeMetadata) over one session and a pool of keep-alive connections.
+
+A client is safe to share between threads, so several retrieves or deploys
+can be in flight at once:
+
+    client = MetadataClient(sf_serverurl, sf_username, sf_password)
+    pool = ThreadPool(4)
+    results = pool.map(client.retrieve_wait, packages)
+
+StubServer answers the same operations from canned handlers on localhost,
+so scripts built on the client can be tested without an org.
+
+To run the embedded tests: python -m doctest -v metadata_client.py
+"""
+import httplib
+import socket
+from base64 import b64decode, b64encode
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+from threading import BoundedSemaphore, Lock, Thread
+from time import sleep
+from urlparse import urlparse
+
+from lxml import etree
+
+from poll_scheduler import PollScheduler
+from tools_lxml import SF_URI
+
+SOAP_URI = 'http://schemas.xmlsoap.org/soap/envelope/'
+PARTNER_URI = 'urn:partner.soap.sforce.com'
+INVALID_SESSION = 'INVALID_SESSION_ID'
+# Operations that can be sent again safely if the first attempt was lost
+IDEMPOTENT = ('checkDeployStatus', 'checkRetrieveStatus', 'describeMetadata',
+              'listMetadata')
+default_api_version = '38.0'
+
+
+def add_params(parent, params):
+    """Appends (name, value) parameters to a request element, in order. A
+    list repeats the element, a tuple of pairs nests elements, an element
+    contributes its children, and None is omitted.
+
+    >>> request = etree.Element('{%s}listMetadata' % SF_URI, nsmap={None: SF_URI})
+    >>> add_params(request, [('queries', [(('type', 'Report'), ('folder', 'Ops')),
+    ...                                   (('type', 'ApexClass'),)]),
+    ...                      ('asOfVersion', 38.0), ('skip', None)])
+    >>> print etree.tostring(request)
+    <listMetadata xmlns="http://soap.sforce.com/2006/04/metadata"><queries><type>Report</type><folder>Ops</folder></queries><queries><type>ApexClass</type></queries><asOfVersion>38.0</asOfVersion></listMetadata>
+    """
+    uri = etree.QName(parent).namespace
+    for (name, value) in params:
+        for item in (value if isinstance(value, list) else [value]):
+            if item is None:
+                continue
+            child = etree.SubElement(parent, '{%s}%s' % (uri, name))
+            if isinstance(item, tuple):
+                add_params(child, item)
+            elif etree.iselement(item):
+                for grandchild in item:
+                    if isinstance(grandchild.tag, basestring):
+                        child.append(etree.fromstring(etree.tostring(grandchild)))
+            elif isinstance(item, bool):
+                child.text = 'true' if item else 'false'
+            else:
+                child.text = unicode(item)
+
+
+def envelope(operation, params, session_id=None, uri=SF_URI):
+    """Renders the SOAP request for an operation.
+
+    >>> print envelope('checkRetrieveStatus', [('asyncProcessId', '09S'),
+    ...                                        ('includeZip', False)], 'abc')
+    <?xml version='1.0' encoding='UTF-8'?>
+    <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns="http://soap.sforce.com/2006/04/metadata"><soapenv:Header><SessionHeader><sessionId>abc</sessionId></SessionHeader></soapenv:Header><soapenv:Body><checkRetrieveStatus><asyncProcessId>09S</asyncProcessId><includeZip>false</includeZip></checkRetrieveStatus></soapenv:Body></soapenv:Envelope>
+    """
+    root = etree.Element('{%s}Envelope' % SOAP_URI,
+                         nsmap={'soapenv': SOAP_URI, None: uri})
+    if session_id is not None:
+        header = etree.SubElement(root, '{%s}Header' % SOAP_URI)
+        add_params(etree.SubElement(header, '{%s}SessionHeader' % uri),
+                   [('sessionId', session_id)])
+    body = etree.SubElement(root, '{%s}Body' % SOAP_URI)
+    add_params(etree.SubElement(body, '{%s}%s' % (uri, operation)), params)
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+def parse_response(data):
+    """Returns the result elements of a SOAP response, or raises IOError
+    with the code and message of a SOAP fault.
+
+    >>> results = parse_response('<Envelope xmlns="%s"><Body>'
+    ...     '<listMetadataResponse xmlns="%s"><result><fullName>A</fullName>'
+    ...     '</result></listMetadataResponse></Body></Envelope>' % (SOAP_URI, SF_URI))
+    >>> print len(results), results[0][0].text
+    1 A
+    >>> parse_response('<Envelope xmlns="%s"><Body><Fault><faultcode>'
+    ...     'sf:INVALID_SESSION_ID</faultcode><faultstring>Invalid Session ID'
+    ...     '</faultstring></Fault></Body></Envelope>' % SOAP_URI)
+    Traceback (most recent call last):
+    ...
+    IOError: sf:INVALID_SESSION_ID: Invalid Session ID
+    """
+    root = etree.fromstring(data)
+    body = root.find('{%s}Body' % SOAP_URI)
+    if body is None or len(body) == 0:
+        raise IOError('Not a SOAP response: ' + data[:200])
+    fault = body.find('{%s}Fault' % SOAP_URI)
+    if fault is not None:
+        raise IOError('{code}: {message}'.format(
+            code=fault.xpath('string(*[local-name()="faultcode"])'),
+            message=fault.xpath('string(*[local-name()="faultstring"])')))
+    return [child for child in body[0] if etree.QName(child).localname == 'result']
+
+
+def result_fields(element):
+    """Maps the names of the leaf children of a result to their text, as a
+    list where a name repeats.
+
+    >>> result = etree.fromstring('<result><xmlName>CustomObject</xmlName>'
+    ...     '<childXmlNames>CustomField</childXmlNames>'
+    ...     '<childXmlNames>ListView</childXmlNames><inFolder>false</inFolder>'
+    ...     '</result>')
+    >>> fields = result_fields(result)
+    >>> for name in sorted(fields):
+    ...     print name, fields[name]
+    childXmlNames ['CustomField', 'ListView']
+    inFolder false
+    xmlName CustomObject
+    """
+    fields = {}
+    for child in element:
+        if not isinstance(child.tag, basestring) or len(child):
+            continue
+        name = str(etree.QName(child).localname)
+        text = child.text or ''
+        if name not in fields:
+            fields[name] = text
+        elif isinstance(fields[name], list):
+            fields[name].append(text)
+        else:
+            fields[name] = [fields[name], text]
+    return fields
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections to one host, and bounds the number
+    of requests in flight to it."""
+
+    def __init__(self, url, size=4, timeout=300):
+        parsed = urlparse(url)
+        self.secure = parsed.scheme == 'https'
+        self.netloc = parsed.netloc
+        self.timeout = timeout
+        self.idle = Queue()
+        self.slots = BoundedSemaphore(size)
+
+    def connect(self):
+        connection = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        return connection(self.netloc, timeout=self.timeout)
+
+    def post(self, url_path, body, headers, retry=True):
+        """Posts the body and returns the status and response data, retrying
+        once on a fresh connection if an idle one was dropped. A request that
+        must not be sent twice (retry False) always takes a fresh connection,
+        as the server may have acted on a request whose response was lost."""
+        with self.slots:
+            try:
+                if not retry:
+                    raise Empty
+                (connection, reused) = (self.idle.get_nowait(), True)
+            except Empty:
+                (connection, reused) = (self.connect(), False)
+            while True:
+                try:
+                    connection.request('POST', url_path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    if not reused:
+                        raise
+                    (connection, reused) = (self.connect(), False)
+            if response.getheader('connection', '').lower() == 'close':
+                connection.close()
+            else:
+                self.idle.put(connection)
+            return (response.status, data)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                return
+
+
+class MetadataClient:
+    """Calls the Metadata API with one session, logging in on first use with
+    the username and password, or using a given session id."""
+
+    def __init__(self, serverurl, username=None, password=None, session_id=None,
+                 api_version=default_api_version, pool_size=4):
+        self.serverurl = serverurl.rstrip('/')
+        self.username = username
+        self.password = password
+        self.api_version = api_version
+        self.pool_size = pool_size
+        self.pools = {}
+        self.lock = Lock()
+        self.session_id = session_id
+        self.metadata_url = None
+        if session_id is not None:
+            self.metadata_url = '{serverurl}/services/Soap/m/{version}'.format(
+                serverurl=self.serverurl, version=api_version)
+
+    def pool(self, url):
+        netloc = urlparse(url).netloc
+        with self.lock:
+            if netloc not in self.pools:
+                self.pools[netloc] = ConnectionPool(url, self.pool_size)
+            return self.pools[netloc]
+
+    def post(self, url, operation, params, session_id=None, uri=SF_URI,
+             retry=True):
+        body = envelope(operation, params, session_id, uri)
+        headers = {'Content-Type': 'text/xml; charset=UTF-8', 'SOAPAction': '""',
+                   'Connection': 'keep-alive'}
+        parsed = urlparse(url)
+        (status, data) = self.pool(url).post(parsed.path, body, headers, retry)
+        if status != 200 and not data.lstrip().startswith('<'):
+            raise IOError('HTTP {status} from {url}'.format(status=status, url=url))
+        return parse_response(data)
+
+    def login(self, expired=None):
+        """Logs in with the partner API, unless another thread already
+        replaced the expired session, and returns the session id."""
+        with self.lock:
+            if self.session_id is not None and self.session_id != expired:
+                return self.session_id
+            if self.username is None:
+                raise IOError('Session expired and no credentials to log in.')
+        url = '{serverurl}/services/Soap/u/{version}'.format(
+            serverurl=self.serverurl, version=self.api_version)
+        result = self.post(url, 'login', [('username', self.username),
+                                          ('password', self.password)],
+                           uri=PARTNER_URI)[0]
+        with self.lock:
+            self.session_id = result.findtext('{%s}sessionId' % PARTNER_URI)
+            self.metadata_url = result.findtext('{%s}metadataServerUrl' % PARTNER_URI)
+            return self.session_id
+
+    def call(self, operation, params):
+        """Calls a Metadata API operation and returns its result elements,
+        logging in again once if the session has expired. Only IDEMPOTENT
+        operations are resent when a connection drops; a retrieve or deploy
+        is sent on a fresh connection instead, and fails if that drops.
+
+        >>> stub = StubServer({'listMetadata': lambda request: [],
+        ...                    'retrieve': lambda request: [[('id', 'R1')]]})
+        >>> client = MetadataClient(stub.url, 'user', 'pass')
+        >>> client.list_metadata([('ApexClass', None)])
+        []
+        >>> class Dropped:
+        ...     def request(self, *args): raise socket.error('reset')
+        ...     def close(self): pass
+        >>> pool = client.pool(stub.url)
+        >>> pool.close(); pool.idle.put(Dropped())
+        >>> print client.retrieve(etree.Element('Package')), pool.idle.qsize()
+        R1 2
+        >>> pool.close(); pool.idle.put(Dropped())
+        >>> print client.list_metadata([('ApexClass', None)]), pool.idle.qsize()
+        [] 1
+        >>> client.close(); stub.close()
+        """
+        retry = operation in IDEMPOTENT
+        session_id = self.login() if self.session_id is None else self.session_id
+        try:
+            return self.post(self.metadata_url, operation, params, session_id,
+                             retry=retry)
+        except IOError as e:
+            if INVALID_SESSION not in str(e) or self.username is None:
+                raise
+        return self.post(self.metadata_url, operation, params,
+                         self.login(session_id), retry=retry)
+
+    def describe_metadata(self):
+        """Returns the describeMetadata result, with each metadata type as
+        fields under 'metadataObjects'."""
+        result = self.call('describeMetadata', [('asOfVersion', self.api_version)])[0]
+        fields = result_fields(result)
+        fields['metadataObjects'] = [result_fields(child) for child in result
+                                     if etree.QName(child).localname == 'metadataObjects']
+        return fields
+
+    def list_metadata(self, queries):
+        """Lists the components for up to three (type, folder) queries, as a
+        list of file property fields."""
+        params = [('queries', [(('type', metadata_type), ('folder', folder))
+                               for (metadata_type, folder) in queries]),
+                  ('asOfVersion', self.api_version)]
+        return [result_fields(result) for result in self.call('listMetadata', params)]
+
+    def retrieve(self, package, single_package=True):
+        """Starts retrieving the components of a package.xml root, and
+        returns the async process id."""
+        params = [('retrieveRequest', (('apiVersion', self.api_version),
+                                       ('singlePackage', single_package),
+                                       ('unpackaged', package)))]
+        return self.call('retrieve', params)[0].findtext('{%s}id' % SF_URI)
+
+    def check_retrieve_status(self, async_id, include_zip=True):
+        """Returns the retrieve status fields, with the decoded zip bytes
+        under 'zipFile' once done."""
+        result = self.call('checkRetrieveStatus', [('asyncProcessId', async_id),
+                                                   ('includeZip', include_zip)])[0]
+        fields = result_fields(result)
+        if fields.get('zipFile'):
+            fields['zipFile'] = b64decode(fields['zipFile'])
+        return fields
+
+    def deploy(self, zip_bytes, options):
+        """Starts deploying zip bytes with a list of (name, value) deploy
+        options, and returns the async process id."""
+        params = [('ZipFile', b64encode(zip_bytes)), ('DeployOptions', tuple(options))]
+        return self.call('deploy', params)[0].findtext('{%s}id' % SF_URI)
+
+    def check_deploy_status(self, async_id, include_details=False):
+        """Returns the deploy status fields, with the raw result element
+        under 'result' for the details."""
+        result = self.call('checkDeployStatus', [('asyncProcessId', async_id),
+                                                 ('includeDetails', include_details)])[0]
+        fields = result_fields(result)
+        fields['result'] = result
+        return fields
+
+    def wait(self, check, async_id, **poll):
+        """Polls a status check until it is done, timing the polls with a
+        PollScheduler made from the poll arguments."""
+        scheduler = PollScheduler(**poll)
+        while True:
+            fields = check(async_id)
+            if fields.get('done') == 'true':
+                return fields
+            try:
+                sleep(scheduler.next_wait(fields))
+            except IOError as e:
+                raise IOError('Request {id}: {error}'.format(id=async_id, error=e))
+
+    def retrieve_wait(self, package, **poll):
+        """Retrieves a package.xml root and returns the final status."""
+        return self.wait(self.check_retrieve_status, self.retrieve(package), **poll)
+
+    def deploy_wait(self, zip_bytes, options, **poll):
+        """Deploys zip bytes and returns the final status."""
+        return self.wait(self.check_deploy_status, self.deploy(zip_bytes, options),
+                         **poll)
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = etree.fromstring(self.rfile.read(int(self.headers['Content-Length'])))
+        operation = request.find('{%s}Body' % SOAP_URI)[0]
+        name = etree.QName(operation).localname
+        uri = etree.QName(operation).namespace
+        root = etree.Element('{%s}Envelope' % SOAP_URI, nsmap={None: SOAP_URI})
+        body = etree.SubElement(root, '{%s}Body' % SOAP_URI)
+        try:
+            response = etree.SubElement(body, '{%s}%sResponse' % (uri, name),
+                                        nsmap={None: uri})
+            for params in self.server.answer(name, operation):
+                add_params(etree.SubElement(response, '{%s}result' % uri), params)
+            status = 200
+        except IOError as e:
+            body.remove(response)
+            fault = etree.SubElement(body, '{%s}Fault' % SOAP_URI)
+            (fault_code, fault_string) = str(e).split(': ', 1)
+            add_params(fault, [('faultcode', fault_code), ('faultstring', fault_string)])
+            status = 500
+        data = etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Answers SOAP requests on localhost with canned results. Handlers map
+    an operation name to a function taking the request element and returning
+    a list of result parameters (see add_params), or raising IOError with
+    'code: message' for a fault. Login is answered with session 'stub'.
+
+    >>> from itertools import count
+    >>> ids = count(1)
+    >>> stub = StubServer({
+    ...     'retrieve': lambda request: [[('id', 'R%d' % next(ids))]],
+    ...     'checkRetrieveStatus': lambda request: [[
+    ...         ('id', request.findtext('{%s}asyncProcessId' % SF_URI)),
+    ...         ('done', True), ('zipFile', b64encode('PK'))]]})
+    >>> client = MetadataClient(stub.url, 'user', 'pass')
+    >>> status = client.retrieve_wait(etree.Element('Package'))
+    >>> print client.session_id, status['id'], status['zipFile']
+    stub R1 PK
+    >>> client.close(); stub.close()
+    """
+    daemon_threads = True
+
+    def __init__(self, handlers):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.handlers = dict(handlers)
+        self.handlers.setdefault('login', lambda request: [[
+            ('sessionId', 'stub'),
+            ('metadataServerUrl', self.url + '/services/Soap/m/' + default_api_version)]])
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def answer(self, name, operation):
+        if name not in self.handlers:
+            raise IOError('sf:INVALID_OPERATION: No handler for ' + name)
+        return self.handlers[name](operation)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
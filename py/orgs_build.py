@@ -0,0 +1,260 @@
+#!/usr/bin/python
+"""Runs one build for every row in a comma-separated file, several at a time,
+and streams the outcome of each row to a summary file. The rows are the same
+ones csv_to_properties renders as properties files.
+
+To call from the Python CLI (with metadata present):
+    % ./orgs_build.py -c orgs.csv -t RetrieveFromOrg -w ~/builds -j 8
+                      -l 'acme*' -g east
+
+To call from the Ant CLI: ant -Dcsvfile_path=orgs.csv -Dsf_target=RetrieveFromOrg
+                              -Dsf_jobs=8 orgsBuild
+
+To run the embedded tests: python -m doctest -v orgs_build.py
+"""
+"""
+Use Case for orgs_build.py
+
+Motivation: Rolling a change across many customer orgs one build at a time
+takes a day, and most of each build is spent waiting on the org. Running the
+builds side by side overlaps the waiting.
+
+Stakeholders: Release Engineering
+
+Output: One build log, and the properties file passed to the build, per row
+under workdir/label.group.phase/, and a summary.csv in the workdir listing the status and duration of each row as it
+finishes.
+
+Prerequisites:
+1. The parameters are available as a CSV file, as for csv_to_properties.
+2. The first three columns of the spreadsheet can be concatenated into a
+unique name.
+
+Assumptions:
+1. Each build only writes under its own homedir, retrieve target, check-only
+deploy root and parent folder, which the orchestrator points to the row's
+folder. The homedir is the row's folder named for its repo_name (or home),
+where sh/branch checks the repository out.
+2. The columns may hold credentials, so they are passed in a properties file
+readable only by its owner, rather than on the command line where ps would
+show them.
+
+Success Scenario:
+1. External actor invokes script from command line passing the csvfile_path,
+target and workdir arguments.
+2. Process reads the rows, keeping those that match the label, group and
+phase patterns (shell wildcards).
+3. Process starts up to jobs builds at once, writing each column of the row
+to a properties file as csv_to_properties does, with homedir,
+sf_retrieveTarget, sf_checkOnlyRoot and parentdir set under the row's folder,
+and passing the file with -propertyfile.
+4. As each build finishes, process appends its outcome to the summary and
+prints it.
+5. Process prints the tally and exits with an error if any build failed.
+"""
+import argparse
+import csv
+import subprocess
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+from os import O_CREAT, O_TRUNC, O_WRONLY, environ, fdopen, makedirs, \
+    open as open_fd, path
+from sys import exit
+from time import time
+
+from csv_to_properties import row_name, write_properties, LABEL_COL, \
+    GROUP_COL, PHASE_COL
+
+SUMMARY_NAME = 'summary.csv'
+LOG_NAME = 'build.log'
+PROPERTIES_SUFFIX = '.properties'
+# Properties the orchestrator sets for each row, rather than the CSV
+ISOLATED = ('homedir', 'sf_retrieveTarget', 'parentdir', 'sf_checkOnlyRoot')
+# The home build.xml defaults to, which sh/branch checks out as repo_name
+default_home = 'sf-org'
+default_command = 'ant -f ' + path.join(path.dirname(path.dirname(
+    path.abspath(__file__))), 'build.xml')
+
+
+def select_rows(rows, fields, label='*', group='*', phase='*'):
+    """Keeps the rows whose label, group and phase match the patterns.
+
+    >>> fields = ['label', 'group', 'phase']
+    >>> rows = [{'label': 'acme', 'group': 'east', 'phase': '1'},
+    ...         {'label': 'apex', 'group': 'west', 'phase': '1'},
+    ...         {'label': 'beta', 'group': 'east', 'phase': '2'}]
+    >>> print [row_name(row, fields) for row in select_rows(rows, fields, 'a*')]
+    ['acme.east.1', 'apex.west.1']
+    >>> print [row_name(row, fields) for row in select_rows(rows, fields, group='east', phase='2')]
+    ['beta.east.2']
+    """
+    patterns = [(fields[LABEL_COL], label), (fields[GROUP_COL], group),
+                (fields[PHASE_COL], phase)]
+    return [row for row in rows
+            if all(fnmatch(row[field], pattern) for (field, pattern) in patterns)]
+
+
+def row_properties(row, fields, rowdir):
+    """Returns the properties of one row, and their order: each column of the
+    row, with the folders the build writes to isolated under rowdir. The
+    homedir is named for the row's repo_name, or home, as sh/branch checks
+    the repository out to parentdir/repo_name.
+
+    >>> fields = ['label', 'group', 'phase', 'homedir', 'sf_password']
+    >>> row = {'label': 'acme', 'group': 'east', 'phase': '1', 'homedir': 'x',
+    ...        'sf_password': 'secret'}
+    >>> (properties, names) = row_properties(row, fields, '/w/acme.east.1')
+    >>> for name in names:
+    ...     print name, properties[name]
+    label acme
+    group east
+    phase 1
+    sf_password secret
+    homedir /w/acme.east.1/sf-org
+    sf_retrieveTarget /w/acme.east.1/retrieveTarget
+    parentdir /w/acme.east.1
+    sf_checkOnlyRoot /w/acme.east.1/.checkOnlyRoot
+    >>> row.update({'home': 'acme-org', 'repo_name': 'acme-sf'})
+    >>> print row_properties(row, fields, '/w/acme.east.1')[0]['homedir']
+    /w/acme.east.1/acme-sf
+    """
+    properties = dict(row)
+    home = row.get('repo_name') or row.get('home') or default_home
+    properties.update({'homedir': path.join(rowdir, home),
+                       'sf_retrieveTarget': path.join(rowdir, 'retrieveTarget'),
+                       'parentdir': rowdir,
+                       'sf_checkOnlyRoot': path.join(rowdir, '.checkOnlyRoot')})
+    names = [field for field in fields if field not in ISOLATED] + list(ISOLATED)
+    return (properties, names)
+
+
+def build_command(command, target, properties_path):
+    """Renders the command line for one row, which passes the row's
+    properties file rather than any of its values.
+
+    >>> print ' '.join(build_command('ant', 'retrieve', '/w/acme.east.1/acme.east.1.properties'))
+    ant retrieve -propertyfile /w/acme.east.1/acme.east.1.properties
+    """
+    return command.split() + [target, '-propertyfile', properties_path]
+
+
+class RowBuild:
+    """Runs the build for one row, logging to the row's folder. Instances
+    are called from the worker threads of the pool."""
+
+    def __init__(self, command, target, fields, workdir):
+        self.command = command
+        self.target = target
+        self.fields = fields
+        self.workdir = workdir
+
+    def __call__(self, row):
+        name = row_name(row, self.fields)
+        rowdir = path.join(self.workdir, name)
+        if not path.isdir(rowdir):
+            makedirs(rowdir)
+        log_path = path.join(rowdir, LOG_NAME)
+        properties_path = path.join(rowdir, name + PROPERTIES_SUFFIX)
+        (properties, names) = row_properties(row, self.fields, rowdir)
+        # readable by the owner only, as the row may hold credentials
+        with fdopen(open_fd(properties_path, O_WRONLY | O_CREAT | O_TRUNC,
+                            0600), 'w') as f:
+            write_properties(f, properties, names)
+        args = build_command(self.command, self.target, properties_path)
+        start = time()
+        with open(log_path, 'w') as log:
+            try:
+                status = subprocess.call(args, stdout=log,
+                                         stderr=subprocess.STDOUT, cwd=rowdir)
+            except OSError as e:
+                log.write(str(e) + '\n')
+                status = -1
+        return (name, status, time() - start, log_path)
+
+
+def main(csvfile_path, target, workdir, jobs=4, label='*', group='*',
+         phase='*', command=None):
+    """Runs the target for each selected row, jobs at a time, and returns
+    the number of failed builds."""
+    command = default_command if command is None else command
+    workdir = path.abspath(workdir)
+    with open(csvfile_path) as csvfile:
+        reader = csv.DictReader(csvfile)
+        fields = reader.fieldnames
+        rows = select_rows(list(reader), fields, label, group, phase)
+    if not path.isdir(workdir):
+        makedirs(workdir)
+    run = RowBuild(command, target, fields, workdir)
+    failed = 0
+    pool = ThreadPool(max(1, min(jobs, len(rows))))
+    with open(path.join(workdir, SUMMARY_NAME), 'w') as summary_file:
+        summary = csv.writer(summary_file)
+        summary.writerow(['name', 'status', 'seconds', 'log'])
+        for (name, status, seconds, log_path) in pool.imap_unordered(run, rows):
+            outcome = 'ok' if status == 0 else 'failed'
+            failed += 0 if status == 0 else 1
+            summary.writerow([name, outcome, '%.1f' % seconds, log_path])
+            summary_file.flush()
+            print("{name}: {outcome} in {seconds:.1f}s".format(
+                name=name, outcome=outcome, seconds=seconds))
+    pool.close()
+    pool.join()
+    print("Built {count} rows from {csvfile_path}, {failed} failed.".format(
+        count=len(rows), csvfile_path=csvfile_path, failed=failed))
+    return failed
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(
+        description="Runs one build for every row in a comma-separated file, "
+                    "several at a time.",
+        epilog="The parameters may also be passed as environment variables.")
+    parser.add_argument('-c', '--csvfile_path', help="The input file.")
+    parser.add_argument('-t', '--sf_target', help="The Ant target to run for "
+                                                  "each row.")
+    parser.add_argument('-w', '--workdir', help="The folder holding a "
+                                                "subfolder for each row.")
+    parser.add_argument('-j', '--sf_jobs', type=int, help="The number of "
+                                                          "builds to run at "
+                                                          "once.")
+    parser.add_argument('-l', '--label', help="Pattern for the "
+                                                           "label column.")
+    parser.add_argument('-g', '--group', help="Pattern for the "
+                                                           "group column.")
+    parser.add_argument('-p', '--phase', help="Pattern for the "
+                                                           "phase column.")
+    parser.add_argument('--command', help="The build command (ant with the "
+                                          "ant-sf build.xml by default).")
+    return parser
+
+
+def __args_verify(csvfile_path, sf_target, workdir):
+    if csvfile_path is None or sf_target is None or workdir is None:
+        print("Requires csvfile_path, sf_target, workdir as parameters or "
+              "system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    csvfile_path = environ.get('csvfile_path')
+    sf_target = environ.get('sf_target')
+    workdir = environ.get('workdir')
+    sf_jobs = environ.get('sf_jobs', '4')
+    label = environ.get('label', '*')
+    group = environ.get('group', '*')
+    phase = environ.get('phase', '*')
+
+    args = __parser_config().parse_args()
+
+    csvfile_path = args.csvfile_path if args.csvfile_path is not None else csvfile_path
+    sf_target = args.sf_target if args.sf_target is not None else sf_target
+    workdir = args.workdir if args.workdir is not None else workdir
+    sf_jobs = args.sf_jobs if args.sf_jobs is not None else int(sf_jobs)
+    label = args.label if args.label is not None else label
+    group = args.group if args.group is not None else group
+    phase = args.phase if args.phase is not None else phase
+    __args_verify(csvfile_path, sf_target, workdir)
+
+    failed = main(csvfile_path, sf_target, workdir, sf_jobs, label, group,
+                  phase, args.command)
+    exit(1 if failed else 0)
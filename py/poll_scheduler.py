@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""Schedules the status polls of a deploy or retrieve. Polls start fast and
+back off exponentially, with jitter, up to a cap. When the status reports
+component or test counts, the next poll is timed from the observed rate,
+so polls close in as the request nears completion.
+
+    scheduler = PollScheduler(1000, 30000, 18000000)
+    while not done:
+        fields = check(async_id)
+        sleep(scheduler.next_wait(fields))
+
+To run the embedded tests: python -m doctest -v poll_scheduler.py
+"""
+from random import Random
+from time import time
+
+default_initial_millis = 1000
+default_max_millis = 30000
+default_timeout_millis = 30000 * 600
+default_factor = 2.0
+default_jitter = 0.1
+
+# Status fields that count work done, and the totals they count towards
+DONE_FIELDS = ['numberComponentsDeployed', 'numberComponentErrors',
+               'numberTestsCompleted', 'numberTestErrors']
+TOTAL_FIELDS = ['numberComponentsTotal', 'numberTestsTotal']
+
+
+def progress(fields):
+    """Sums the work done and the total work reported by a status.
+
+    >>> progress({'numberComponentsDeployed': '40', 'numberComponentErrors': '2',
+    ...           'numberComponentsTotal': '100', 'numberTestsTotal': '0',
+    ...           'status': 'InProgress'})
+    (42, 100)
+    >>> progress({'done': 'false'})
+    (0, 0)
+    """
+    fields = fields or {}
+    count = lambda names: sum(int(fields.get(name) or 0) for name in names)
+    return (count(DONE_FIELDS), count(TOTAL_FIELDS))
+
+
+class PollScheduler:
+    """Returns the seconds to wait before each poll, or raises IOError once
+    the timeout has passed.
+
+    Without counts, the waits double up to the cap:
+
+    >>> clock = [0.0]
+    >>> scheduler = PollScheduler(1000, 8000, 60000, jitter=0, clock=lambda: clock[0])
+    >>> waits = []
+    >>> for poll in range(5):
+    ...     waits.append(scheduler.next_wait({'done': 'false'}))
+    ...     clock[0] += waits[-1]
+    >>> print waits
+    [1.0, 2.0, 4.0, 8.0, 8.0]
+
+    With counts, the wait is half the estimated time left:
+
+    >>> scheduler = PollScheduler(1000, 30000, 60000, jitter=0, clock=lambda: clock[0])
+    >>> print scheduler.next_wait({'numberComponentsDeployed': '0',
+    ...                            'numberComponentsTotal': '100'})
+    1.0
+    >>> clock[0] += 1.0
+    >>> print scheduler.next_wait({'numberComponentsDeployed': '10',
+    ...                            'numberComponentsTotal': '100'})
+    4.5
+    >>> clock[0] += 4.5
+    >>> print scheduler.next_wait({'numberComponentsDeployed': '100',
+    ...                            'numberComponentsTotal': '100'})
+    1.0
+    >>> clock[0] = scheduler.start + 60
+    >>> scheduler.next_wait({})
+    Traceback (most recent call last):
+    ...
+    IOError: Not done after 60 seconds.
+    """
+
+    def __init__(self, initial_millis=default_initial_millis,
+                 max_millis=default_max_millis,
+                 timeout_millis=default_timeout_millis, factor=default_factor,
+                 jitter=default_jitter, clock=time, seed=None):
+        self.initial = initial_millis / 1000.0
+        self.cap = max(max_millis / 1000.0, self.initial)
+        self.timeout = timeout_millis / 1000.0
+        self.factor = factor
+        self.jitter = jitter
+        self.clock = clock
+        self.random = Random(seed)
+        self.start = clock()
+        self.wait = None
+        self.last = None
+
+    def estimate(self, fields, now):
+        """Estimates the seconds left from the rate of progress since the
+        last poll that made progress, or returns None."""
+        (done, total) = progress(fields)
+        estimate = None
+        if total and self.last is not None and done > self.last[0] and now > self.last[1]:
+            rate = (done - self.last[0]) / float(now - self.last[1])
+            estimate = max(total - done, 0) / rate
+        if total and (self.last is None or done != self.last[0]):
+            self.last = (done, now)
+        return estimate
+
+    def next_wait(self, fields=None):
+        now = self.clock()
+        elapsed = now - self.start
+        if elapsed >= self.timeout:
+            raise IOError('Not done after {seconds:.0f} seconds.'.format(
+                seconds=elapsed))
+        estimate = self.estimate(fields, now)
+        if self.wait is None:
+            self.wait = self.initial
+        elif estimate is not None:
+            self.wait = min(max(estimate / 2, self.initial), self.cap)
+        else:
+            self.wait = min(self.wait * self.factor, self.cap)
+        wait = self.wait * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(wait, self.timeout - elapsed)
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+"""Mirrors the source files changed on a branch since it left its base,
+with their companion files, into a folder for static analysis. Files are
+hardlinked where possible, so the mirror costs no copying.
+
+To call from the Python CLI (with metadata present):
+    % ./pr_sources.py -d ~/git/sf-org -b origin/master -m ~/git/.prSources
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_prBase=origin/master prSources
+
+To run the embedded tests: python -m doctest -v pr_sources.py
+"""
+"""
+Use Case for pr_sources.py
+
+Motivation: AnalyzePullRequest sets sonar.sources to the whole source
+folder, so a pull request touching three classes scans every class and page
+in the org.
+
+Stakeholders: Release Engineering, Developers
+
+Output: The mirror folder holds the changed sources, laid out as in the
+source folder, and the count is printed.
+
+Prerequisite: The branch is checked out to homedir, and the base ref is
+available locally (for example, origin/master after a fetch).
+
+Assumptions:
+1. Deleted files need no analysis.
+2. A source file is analyzed with its -meta.xml companion, and an Aura or
+Lightning web component with the rest of its bundle.
+
+Success Scenario:
+1. External actor invokes script from command line passing homedir, the
+base ref and the mirror folder.
+2. Process lists the files added or modified between the merge base and
+the head with git diff.
+3. Process keeps those under the source folder, and adds their companions.
+4. Process clears the mirror, and hardlinks each file into it.
+5. Process prints the number of files mirrored.
+
+Alternate Scenario:
+(4a)
+1. The mirror is on another file system, and process copies the files.
+"""
+import argparse
+import subprocess
+from os import environ, link, listdir, makedirs, path
+from shutil import copy2, rmtree
+from sys import exit
+
+META_SUFFIX = '-meta.xml'
+BUNDLE_FOLDERS = ('aura', 'lwc')
+default_head = 'HEAD'
+
+
+def changed_files(homedir, base, head=default_head):
+    """Lists the repository paths added or modified on head since it left
+    base."""
+    output = subprocess.check_output(['git', 'diff', '--name-only',
+                                      '--diff-filter=d', base + '...' + head],
+                                     cwd=homedir)
+    return [line for line in output.splitlines() if line]
+
+
+def source_paths(filenames, source_prefix):
+    """Keeps the paths under the source folder, relative to it.
+
+    >>> source_paths(['src/classes/A.cls', 'README.md', 'srcx/B.cls'], 'src')
+    ['classes/A.cls']
+    """
+    prefix = source_prefix.rstrip('/') + '/'
+    return [filename[len(prefix):] for filename in filenames
+            if filename.startswith(prefix)]
+
+
+def companions(relpath, sourcedir):
+    """Returns the files analyzed with a source file: its -meta.xml file or
+    source, or the rest of its component bundle.
+
+    >>> companions('classes/A.cls', 'src')
+    ['classes/A.cls-meta.xml']
+    >>> companions('classes/A.cls-meta.xml', 'src')
+    ['classes/A.cls']
+    """
+    parts = relpath.split('/')
+    if len(parts) > 2 and parts[0] in BUNDLE_FOLDERS:
+        bundle = path.join(sourcedir, parts[0], parts[1])
+        if path.isdir(bundle):
+            return ['/'.join(parts[:2] + [name]) for name in sorted(listdir(bundle))
+                    if path.isfile(path.join(bundle, name))]
+        return []
+    if relpath.endswith(META_SUFFIX):
+        return [relpath[:-len(META_SUFFIX)]]
+    return [relpath + META_SUFFIX]
+
+
+def mirror_files(sourcedir, relpaths, mirrordir):
+    """Recreates the mirror with a hardlink (or copy) of each existing file,
+    and returns the number mirrored."""
+    if path.isdir(mirrordir):
+        rmtree(mirrordir)
+    makedirs(mirrordir)
+    count = 0
+    for relpath in sorted(set(relpaths)):
+        source = path.join(sourcedir, relpath)
+        if not path.isfile(source):
+            continue
+        target = path.join(mirrordir, relpath)
+        if not path.isdir(path.dirname(target)):
+            makedirs(path.dirname(target))
+        try:
+            link(source, target)
+        except OSError:
+            copy2(source, target)
+        count += 1
+    return count
+
+
+def main(homedir, sourcedir, base, mirrordir, head=default_head):
+    """Mirrors the sources changed on head since base.
+
+    >>> from tempfile import mkdtemp
+    >>> homedir = mkdtemp()
+    >>> git = lambda *args: subprocess.check_output(('git', '-c', 'user.name=t',
+    ...     '-c', 'user.email=t@t') + args, cwd=homedir, stderr=subprocess.STDOUT)
+    >>> def write(relpath, text):
+    ...     if not path.isdir(path.dirname(path.join(homedir, relpath))):
+    ...         makedirs(path.dirname(path.join(homedir, relpath)))
+    ...     open(path.join(homedir, relpath), 'w').write(text)
+    >>> for relpath in ['src/classes/A.cls', 'src/classes/A.cls-meta.xml',
+    ...                 'src/classes/B.cls', 'src/aura/Card/Card.cmp',
+    ...                 'src/aura/Card/CardController.js']:
+    ...     write(relpath, 'v1')
+    >>> _ = git('init', '-q'); _ = git('add', '.'); _ = git('commit', '-qm', 'base')
+    >>> _ = git('tag', 'base')
+    >>> write('src/classes/A.cls', 'v2'); write('src/aura/Card/Card.cmp', 'v2')
+    >>> _ = git('commit', '-qam', 'change')
+    >>> mirrordir = path.join(homedir, 'mirror')
+    >>> main(homedir, path.join(homedir, 'src'), 'base', mirrordir) # doctest: +ELLIPSIS
+    Mirrored 4 changed and companion files to ...
+    0
+    >>> from os import walk
+    >>> for (folder, folders, names) in sorted(walk(mirrordir)):
+    ...     for name in sorted(names):
+    ...         print path.relpath(path.join(folder, name), mirrordir)
+    aura/Card/Card.cmp
+    aura/Card/CardController.js
+    classes/A.cls
+    classes/A.cls-meta.xml
+    >>> rmtree(homedir)
+    """
+    source_prefix = path.relpath(path.realpath(sourcedir), path.realpath(homedir))
+    relpaths = source_paths(changed_files(homedir, base, head), source_prefix)
+    for relpath in list(relpaths):
+        relpaths.extend(companions(relpath, sourcedir))
+    count = mirror_files(sourcedir, relpaths, mirrordir)
+    print("Mirrored {count} changed and companion files to {mirrordir}.".format(
+        count=count, mirrordir=mirrordir))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Mirrors the source files "
+                                                 "changed on a branch for "
+                                                 "static analysis.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-d', '--homedir', help="The repository with the branch "
+                                                "checked out.")
+    parser.add_argument('-s', '--sf_sourcedir', help="The source folder (homedir/"
+                                                     "src by default).")
+    parser.add_argument('-b', '--sf_prBase', help="The ref the branch is merged "
+                                                  "into.")
+    parser.add_argument('-m', '--sf_prSourcedir', help="The mirror folder.")
+    parser.add_argument('--head', default=default_head, help="The branch ref "
+                                                             "(HEAD by default).")
+    return parser
+
+
+def __args_verify(homedir, base, mirrordir):
+    if homedir is None or base is None or mirrordir is None:
+        print("Requires homedir, sf_prBase, sf_prSourcedir as parameters or "
+              "system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    homedir = environ.get('homedir')
+    sf_prBase = environ.get('sf_prBase')
+    sf_prSourcedir = environ.get('sf_prSourcedir')
+    sf_sourcedir = environ.get('sf_sourcedir')
+
+    args = __parser_config().parse_args()
+
+    homedir = args.homedir if args.homedir is not None else homedir
+    sf_prBase = args.sf_prBase if args.sf_prBase is not None else sf_prBase
+    sf_prSourcedir = args.sf_prSourcedir if args.sf_prSourcedir is not None \
+        else sf_prSourcedir
+    sf_sourcedir = args.sf_sourcedir if args.sf_sourcedir is not None else sf_sourcedir
+    __args_verify(homedir, sf_prBase, sf_prSourcedir)
+    sf_sourcedir = path.join(homedir, 'src') if sf_sourcedir is None else sf_sourcedir
+
+    main(homedir, sf_sourcedir, sf_prBase, sf_prSourcedir, args.head)
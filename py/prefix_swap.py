@@ -48,6 +48,9 @@ process.
 4. Process renames .object metadata files to reflect target prefix.
 5. Process replaces the source prefix with the target prefix in all metadata
 files under the source directory.
+** A static resource is swapped by the content type in its
+.resource-meta.xml file: a zip archive entry by entry (see swap_zip), a text
+resource as any other file, and a binary resource not at all.
 6. Process returns a tally of the modified files. 
 ** "{hits_tally} matches in {count} files"
 
@@ -64,10 +67,189 @@ Alternate Scenario:
 ** "Invalid source directory. Expecting: /.../example-org/src"
 ** "Exactly two prefixes are required: X1,X2"
 """
-from os import environ, listdir, rename
+import struct
+import zipfile
+from copy import copy
+from os import close, environ, listdir, path, remove, rename
+from shutil import copymode
 from sys import argv
+from tempfile import mkstemp
+
+from tools_io import existing_hash, file_hash, find_files, journal_file, \
+    journal_record, rename_file, replace, replacement_pattern
+from tools_lxml import SF_URI, load_tree
+
+RESOURCE_SUFFIX = '.resource'
+RESOURCE_META_SUFFIX = '.resource-meta.xml'
+ZIP_TYPES = ('application/zip', 'application/x-zip', 'application/x-zip-compressed')
+TEXT_TYPES = ('application/javascript', 'application/x-javascript',
+              'application/json', 'application/xml', 'image/svg+xml')
+# Archive entries that are never text, and so are copied without inflating
+BINARY_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.ico', '.bmp', '.webp',
+                     '.woff', '.woff2', '.ttf', '.otf', '.eot', '.pdf', '.zip',
+                     '.gz', '.jar', '.swf', '.mp3', '.mp4')
+SNIFF_BYTES = 8192
+BLOCK_BYTES = 65536
+# Flag bit set when the sizes follow the data rather than the local header
+DATA_DESCRIPTOR = 0x08
+
+
+def prefix_replacements(p1, p2):
+    """Returns the substitutions that swap prefix p1 for p2.
+
+    >>> sorted(prefix_replacements('zX', 'X').items())
+    [('<namespace>zX', '<namespace>X'), ('zX.', 'X.'), ('zX__', 'X__')]
+    """
+    return {p1 + '__': p2 + '__', p1 + '.': p2 + '.',
+            '<namespace>' + p1: '<namespace>' + p2}
+
+
+def rename_object(filename, p1, p2):
+    """Renames an object file carrying prefix p1 to carry p2 instead, and
+    returns the new filename, or None if the name has no prefix p1."""
+    (folder, fileName) = path.split(filename)
+    x1, x2 = (p1 + '__', p2 + '__')
+    if x1 != fileName[0:len(x1)]:
+        return None
+    target = path.join(folder, fileName.replace(x1, x2))
+    rename_file(filename, target)
+    return target
+
+
+def is_text(data):
+    """Guesses whether content is text: it holds no NUL byte in its first
+    block.
+
+    >>> is_text('var x = 1;'), is_text('\\x89PNG\\x00')
+    (True, False)
+    """
+    return '\0' not in data[:SNIFF_BYTES]
+
 
-from tools_io import find_files, replace
+def resource_type(filename):
+    """Returns the contentType declared by the .resource-meta.xml file of a
+    static resource, or None if there is none."""
+    meta = filename[:-len(RESOURCE_SUFFIX)] + RESOURCE_META_SUFFIX
+    if not path.isfile(meta):
+        return None
+    return load_tree(meta).getroot().findtext('{%s}contentType' % SF_URI)
+
+
+def swap_text(data, replacements):
+    """Applies the replacements to content in one pass, the longest key
+    first, as tools_io.replace does, and returns it with the hits.
+
+    >>> swap_text('zX__A X__B', {'zX__': 'X__', 'X__': 'Y__'})
+    ('X__A Y__B', 2)
+    """
+    return replacement_pattern(replacements).subn(
+        lambda match: replacements[match.group()], data)
+
+
+def copy_raw(source, target, info):
+    """Copies an archive entry from source to target as its compressed bytes,
+    without inflating it."""
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    (name_length, extra_length) = struct.unpack('<HH', header[26:30])
+    source.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length +
+                   extra_length)
+    entry = copy(info)
+    entry.flag_bits &= ~DATA_DESCRIPTOR
+    entry.header_offset = target.fp.tell()
+    target.fp.write(entry.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        block = source.fp.read(min(BLOCK_BYTES, remaining))
+        if not block:
+            raise IOError("Truncated archive entry: " + info.filename)
+        target.fp.write(block)
+        remaining -= len(block)
+    target.filelist.append(entry)
+    target.NameToInfo[entry.filename] = entry
+
+
+def swap_zip(filename, replacements):
+    """Swaps prefixes inside the text entries of a zip archive. Each text
+    entry is inflated and rewritten only if it holds a prefix, and every other
+    entry is copied as its compressed bytes. The archive is replaced
+    atomically, and only if an entry changed. Returns the number of matches.
+
+    >>> from tempfile import mkdtemp
+    >>> from StringIO import StringIO
+    >>> filename = path.join(mkdtemp(), 'bundle.resource')
+    >>> archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+    >>> archive.writestr('js/app.js', 'zX__Widget.render(zX.Util);')
+    >>> archive.writestr('css/app.css', 'body {}')
+    >>> archive.writestr('img/logo.png', '\\x89PNG\\x00zX__')
+    >>> archive.close()
+    >>> swap_zip(filename, prefix_replacements('zX', 'X'))
+    2
+    >>> archive = zipfile.ZipFile(filename)
+    >>> archive.read('js/app.js'), archive.read('img/logo.png')
+    ('X__Widget.render(X.Util);', '\\x89PNG\\x00zX__')
+    >>> archive.testzip()
+    >>> archive.close()
+    >>> swap_zip(filename, prefix_replacements('zX', 'X'))
+    0
+    """
+    hits = 0
+    (handle, temp) = mkstemp(dir=path.dirname(filename),
+                             prefix='.' + path.basename(filename))
+    close(handle)
+    try:
+        source = zipfile.ZipFile(filename)
+        target = zipfile.ZipFile(temp, 'w', allowZip64=True)
+        try:
+            for info in source.infolist():
+                extension = path.splitext(info.filename)[1].lower()
+                if info.filename.endswith('/') or extension in BINARY_EXTENSIONS \
+                        or info.flag_bits & 0x01:
+                    copy_raw(source, target, info)
+                    continue
+                data = source.read(info)
+                (swapped, count) = swap_text(data, replacements) \
+                    if is_text(data) else (data, 0)
+                if count:
+                    entry = copy(info)
+                    entry.flag_bits &= ~DATA_DESCRIPTOR
+                    target.writestr(entry, swapped)
+                    hits += count
+                else:
+                    copy_raw(source, target, info)
+        finally:
+            target.close()
+            source.close()
+        if hits:
+            before = existing_hash(filename) if journal_file() else None
+            copymode(filename, temp)
+            rename(temp, filename)
+            if before is not None:
+                journal_record(filename, before, file_hash(filename))
+    finally:
+        if path.isfile(temp):
+            remove(temp)
+    return hits
+
+
+def swap_file(filename, replacements):
+    """Applies the replacements to one file, and returns the number of
+    matches. Static resources are swapped by their content type, so that
+    archives are rewritten entry by entry and binaries are left alone."""
+    if filename.endswith(RESOURCE_SUFFIX):
+        content_type = resource_type(filename)
+        if content_type in ZIP_TYPES:
+            try:
+                return swap_zip(filename, replacements)
+            except zipfile.BadZipfile:
+                return 0
+        if content_type is None:
+            with open(filename, 'rb') as f:
+                if not is_text(f.read(SNIFF_BYTES)):
+                    return 0
+        elif not (content_type.startswith('text/') or content_type in TEXT_TYPES):
+            return 0
+    return replace(filename, replacements)
 
 
 def __rename_objects(directory, p1, p2):
@@ -75,12 +257,9 @@ def __rename_objects(directory, p1, p2):
     Modified files are saved in place. The number of files renamed
     is not reflected by the tally returned by main.
     """
-    x1, x2 = (p1 + '__', p2 + '__')
-    xlen = len(x1)
-    path = directory + '/objects/'
-    for fileName in listdir(path):
-        if x1 == fileName[0:xlen]:
-            rename(path + fileName, path + fileName.replace(x1, x2))
+    objectsdir = directory + '/objects/'
+    for fileName in listdir(objectsdir):
+        rename_object(objectsdir + fileName, p1, p2)
 
 
 def main_verify_args(sourcedir, prefix_swap):
@@ -101,7 +280,7 @@ def main_verify_args(sourcedir, prefix_swap):
 def main_find_files(sourcedir, replacements):
     (count, hits_tally, hits) = (0, 0, 0)
     for filename in find_files(sourcedir, '*'):
-        hits = replace(filename, replacements)
+        hits = swap_file(filename, replacements)
         if hits:
             count += 1
             hits_tally += hits
@@ -126,8 +305,7 @@ def main(sourcedir, prefix_swap):
 
     __rename_objects(sourcedir, p1, p2)
 
-    replacements = {p1 + '__': p2 + '__', p1 + '.': p2 + '.',
-                    '<namespace>' + p1: '<namespace>' + p2}
+    replacements = prefix_replacements(p1, p2)
 
     main_find_files(sourcedir, replacements)
 
@@ -123,7 +123,8 @@ from sys import argv, exit
 
 from lxml import etree
 
-from tools_lxml import save_tree, sforce_root, SF_URI, namespace_declare, namespace_prepend
+from tools_lxml import load_tree, save_tree, sforce_root, SF_URI, \
+    namespace_declare, namespace_prepend, StreamWriter
 
 
 # ---- NOTE TO READER ----
@@ -265,6 +266,17 @@ class FetchElements(FindElements):
         return self.my_names
 
 
+class StreamElements(FindElements):
+    """Writes the named elements to a StreamWriter target instead of copying
+    them into an output tree."""
+    def do_yield(self, parent, child_text):
+        if child_text in self.my_names:
+            self.my_target.write(parent)
+
+    def do_return(self):
+        return self.my_target
+
+
 class PruneFalseElements(FindElements):
     def do_yield(self, parent, child_text):
         if child_text in ('false', 'None'):
@@ -338,7 +350,7 @@ def diff_elements(source, target, parent_name, test_mode=False):
 def prune_tree(profile_path):
     """Raises IOError if profile_path cannot be parsed.
     """
-    profile_tree = etree.parse(profile_path)
+    profile_tree = load_tree(profile_path)
     profile_root = prune_elements(profile_tree.getroot())
     return profile_root
 
@@ -401,6 +413,42 @@ def extract_elements(source_root, target_root, root_name='Profile', test_mode=Fa
     return root
 
 
+def stream_elements(source_root, target_root, writer, extras=None,
+                    test_mode=False):
+    """Streams the elements from target not granted by source to a
+    StreamWriter, section by section in Salesforce order, without building
+    an output tree. Any extras (name: element) are written in sequence.
+
+    >>> from tempfile import mkdtemp
+    >>> from os import path
+    >>> filename = path.join(mkdtemp(), 'Example.profile')
+    >>> source_root = prune_elements(example_profile_metadata_source(), True)
+    >>> target_root = prune_elements(example_profile_metadata_target(), True)
+    >>> with StreamWriter(filename, 'Profile') as writer:
+    ...     writer = stream_elements(source_root, target_root, writer, None, True)
+    >>> print open(filename).read(),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Profile xmlns="http://soap.sforce.com/2006/04/metadata">
+        <classAccesses>
+            <apexClass>AccountHierarchyBuilder</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+    </Profile>
+    """
+    extras = {} if extras is None else extras
+    my_stream_elements = StreamElements()
+    my_stream_elements.my_test_mode = test_mode
+    for parent_name in sorted(set(PARENTS) | set(extras)):
+        if parent_name in extras:
+            writer.write(extras[parent_name])
+            continue
+        children = PARENTS.get(parent_name)
+        names = diff_elements(source_root, target_root, parent_name, test_mode)
+        my_stream_elements.do(target_root, writer, parent_name,
+                              children[EXTRACT_CHILD], names)
+    return writer
+
+
 def is_profile(profile_path_output):
     return '.profile' in profile_path_output
 
@@ -416,13 +464,14 @@ def main(profile_path_source, profile_path_target, profile_path_output):
     source_root = main_prune_source(profile_path_source)
     target_root = main_prune_target(profile_path_target)
     output_name = root_name(profile_path_output)
-    root = extract_elements(source_root, target_root, output_name)
+    extras = {}
     # (TBD) - Fake it until you can make it KZN-673
     if not is_profile(profile_path_output):
-        my_element = etree.SubElement(root,'label')
+        my_element = etree.Element('label')
         my_element.text = 'Community Hub Guest'
-        root.append(my_element)
-    save_tree(root, profile_path_output)
+        extras['label'] = my_element
+    with StreamWriter(profile_path_output, output_name) as writer:
+        stream_elements(source_root, target_root, writer, extras)
     return 0
 
 
@@ -0,0 +1,485 @@
+#!/usr/bin/python
+"""Merges the grants of several profiles and permission sets into one
+Profile or PermissionSet document, keeping the most permissive setting of
+each access element.
+
+To call from the Python CLI (with metadata present):
+    ./profile_merge.py -o ~/Consolidated.permissionset
+                       ~/src/profiles/"Custom Standard.profile"
+                       ~/src/permissionsets/Reports.permissionset
+
+To call from the Ant CLI: ant -Dhome={}
+    -Dprofile_path_sources=~/A.profile:~/B.permissionset
+    -Dprofile_path_output=~/Consolidated.permissionset profileMerge
+
+To run the embedded tests: python -m doctest -v profile_merge.py
+"""
+"""
+Use Case for profile_merge.py
+
+Motivation: Grants from several profiles or permission sets are often
+consolidated into one document, as for a permission set group, and the union
+is worked out by hand.
+
+Stakeholders: Release Engineering, Administrators
+
+Output: A well-formed Profile or PermissionSet document (by the extension of
+the output path) granting everything any input grants.
+
+Prerequisite: The input documents are retrieved and can be passed at the
+command line.
+
+Assumptions:
+1. An access element is identified by its section and the key child named in
+profile_delta.PARENTS (a layout assignment by the object of its layout and
+its record type),
+userPermissions, customPermissions and the custom setting and custom metadata
+type accesses by name, external data source accesses by data source, and flow
+accesses by flow.
+2. The most permissive setting wins: a flag is true if any input sets it,
+and a tab is shown by the most visible setting of any input.
+3. Only one application, and one record type per object, can be the default,
+so the first input to claim a default keeps it. Likewise only one layout can
+be assigned per object and record type, so the first input's assignment is
+kept.
+4. The other single-valued elements (such as label or userLicense) are taken
+from the first input of the same kind as the output.
+5. The elements of any other section with children (such as loginIpRanges or
+profileActionOverrides) cannot be merged by key, so each distinct element is
+kept verbatim, with a warning.
+
+Success Scenario:
+1. External actor invokes script from command line passing the input
+documents and the output path.
+2. Process streams each input once with iterparse, indexing each access
+element by (section, key) and merging it into any element already indexed.
+3. Process writes the index through StreamWriter, section by section and key
+by key in sorted order.
+4. Process prints the number of elements written.
+
+Alternate Scenario:
+(3a)
+1. The output is a PermissionSet, so tabVisibilities are written as
+tabSettings, and the sections and defaults that only profiles hold are
+dropped. A PermissionSet input has its tabSettings read as tabVisibilities.
+"""
+import argparse
+from copy import deepcopy
+from os import environ, pathsep
+from sys import exit
+
+from lxml import etree
+
+from profile_delta import EXTRACT_CHILD, PARENTS, root_name
+from tools_lxml import SF_URI, StreamWriter, canonical_bytes, local_name, \
+    order_children, sforce_root
+
+# section: key child, for the sections merged by key
+MERGE_KEYS = dict((name, children[EXTRACT_CHILD])
+                  for (name, children) in PARENTS.items())
+MERGE_KEYS.update({'customPermissions': 'name', 'userPermissions': 'name',
+                   'customSettingAccesses': 'name',
+                   'customMetadataTypeAccesses': 'name',
+                   'externalDataSourceAccesses': 'externalDataSource',
+                   'flowAccesses': 'flow'})
+TRUE, FALSE = ('true', 'false')
+# Tab visibility from least to most visible, for profiles
+TAB_SECTION = 'tabVisibilities'
+TAB_SETTINGS = 'tabSettings'
+TAB_RANKS = ['Hidden', 'DefaultOff', 'DefaultOn']
+# Permission set tab settings in profile terms
+TAB_FROM_SETTINGS = {'None': 'Hidden', 'Available': 'DefaultOff',
+                     'Visible': 'DefaultOn'}
+TAB_TO_SETTINGS = dict((value, key) for (key, value)
+                       in TAB_FROM_SETTINGS.items())
+DEFAULT_CHILDREN = ('default', 'personAccountDefault')
+LAYOUT_SECTION = 'layoutAssignments'
+PROFILE_ONLY = ('layoutAssignments', 'loginHours', 'loginIpRanges',
+                'userLicense', 'custom', 'profileActionOverrides')
+PROFILE_SUFFIX = '.profile'
+
+
+def child_text(element, name):
+    """Returns the text of the named child, or None."""
+    return element.findtext('{%s}%s' % (SF_URI, name))
+
+
+def set_child_text(element, name, text):
+    child = element.find('{%s}%s' % (SF_URI, name))
+    if child is None:
+        child = etree.SubElement(element, '{%s}%s' % (SF_URI, name))
+    child.text = text
+
+
+def element_key(section, element):
+    """Returns the merge key of an access element: a layout assignment is
+    keyed by the object its layout is named for, and its record type.
+
+    >>> element = etree.fromstring('<layoutAssignments xmlns="%s">'
+    ...     '<layout>Account-Layout</layout><recordType>Account.Business'
+    ...     '</recordType></layoutAssignments>' % SF_URI)
+    >>> element_key('layoutAssignments', element)
+    ('Account', 'Account.Business')
+    """
+    key = child_text(element, MERGE_KEYS[section])
+    if section == LAYOUT_SECTION:
+        return ((key or '').split('-')[0], child_text(element, 'recordType'))
+    return key
+
+
+def default_scope(section, element):
+    """Names the scope in which only one element may be the default: the
+    section for applications, and the object for record types."""
+    if section == 'recordTypeVisibilities':
+        return (section, (child_text(element, 'recordType') or '').split('.')[0])
+    return (section, None)
+
+
+def more_visible(left, right):
+    """Returns the more visible of two profile tab visibilities.
+
+    >>> more_visible('DefaultOff', 'DefaultOn'), more_visible('Hidden', None)
+    ('DefaultOn', 'Hidden')
+    """
+    ranks = [TAB_RANKS.index(value) for value in (left, right)
+             if value in TAB_RANKS]
+    return TAB_RANKS[max(ranks)] if ranks else left
+
+
+def merge_element(kept, element):
+    """Merges element into the kept element of the same key: flags are or-ed,
+    the most visible tab setting wins, and children kept lacks are added."""
+    for child in element:
+        if not isinstance(child.tag, basestring):
+            continue
+        name = local_name(child)
+        if name in DEFAULT_CHILDREN:
+            # defaults are settled by the merge index
+            continue
+        current = child_text(kept, name)
+        if current is None:
+            kept.append(deepcopy(child))
+        elif name == 'visibility':
+            set_child_text(kept, name, more_visible(current, child.text))
+        elif current in (TRUE, FALSE) and child.text in (TRUE, FALSE):
+            set_child_text(kept, name, TRUE if TRUE in (current, child.text)
+                           else FALSE)
+
+
+class MergeIndex:
+    """Indexes access elements by (section, key), merging each element into
+    any already indexed, so that memory grows with the unique keys rather
+    than the inputs."""
+
+    def __init__(self, output_name):
+        self.output_name = output_name
+        self.elements = {}
+        self.scalars = {}
+        self.verbatim = {}
+        self.defaults = set()
+        self.count = 0
+
+    def add(self, section, element, document_name):
+        """Indexes one top-level element of a document."""
+        if section == TAB_SETTINGS:
+            section = TAB_SECTION
+            visibility = child_text(element, 'visibility')
+            set_child_text(element, 'visibility',
+                           TAB_FROM_SETTINGS.get(visibility, visibility))
+            element.tag = '{%s}%s' % (SF_URI, section)
+        if section not in MERGE_KEYS:
+            if len(element) == 0:
+                if document_name == self.output_name:
+                    self.scalars.setdefault(section, element)
+            else:
+                self.keep_verbatim(section, element)
+            return
+        self.count += 1
+        self.settle_defaults(section, element)
+        key = (section, element_key(section, element))
+        kept = self.elements.get(key)
+        if kept is None:
+            self.elements[key] = element
+        elif section != LAYOUT_SECTION:
+            # the first layout assigned to an object and record type is kept
+            merge_element(kept, element)
+
+    def overlay(self, other):
+        """Lays the elements of another index over this one, replacing the
+        elements of the same key, and the single-valued elements and unmerged
+        sections the other index holds, rather than merging them.
+
+        >>> from StringIO import StringIO
+        >>> def index(body):
+        ...     merged = MergeIndex('Profile')
+        ...     merged.load(StringIO('<Profile xmlns="%s">%s</Profile>'
+        ...                          % (SF_URI, body)))
+        ...     return merged
+        >>> cached = index('<classAccesses><apexClass>A</apexClass>'
+        ...     '<enabled>true</enabled></classAccesses><classAccesses>'
+        ...     '<apexClass>B</apexClass><enabled>true</enabled></classAccesses>')
+        >>> cached.overlay(index('<classAccesses><apexClass>B</apexClass>'
+        ...     '<enabled>false</enabled></classAccesses>'))
+        >>> [(key, child_text(element, 'enabled'))
+        ...  for ((section, key), element) in sorted(cached.elements.items())]
+        [('A', 'true'), ('B', 'false')]
+        """
+        self.elements.update(other.elements)
+        self.scalars.update(other.scalars)
+        self.verbatim.update(other.verbatim)
+
+    def keep_verbatim(self, section, element):
+        """Keeps each distinct element of a section that has no merge key,
+        warning the first time the section is seen."""
+        self.count += 1
+        if section not in self.verbatim:
+            print("Keeping {section} unmerged: no merge key is known for "
+                  "it.".format(section=section))
+            self.verbatim[section] = {}
+        self.verbatim[section].setdefault(etree.tostring(element), element)
+
+    def settle_defaults(self, section, element):
+        """Keeps a default only for the first element to claim its scope."""
+        for name in DEFAULT_CHILDREN:
+            if child_text(element, name) == TRUE:
+                scope = default_scope(section, element) + (name,)
+                if scope in self.defaults:
+                    set_child_text(element, name, FALSE)
+                else:
+                    self.defaults.add(scope)
+
+    def load(self, filename):
+        """Streams a document into the index, releasing each element of the
+        document once it is indexed."""
+        document_name = None
+        for (event, element) in etree.iterparse(filename, events=('start', 'end')):
+            parent = element.getparent()
+            if event == 'start':
+                if parent is None:
+                    document_name = local_name(element)
+                continue
+            if parent is None or parent.getparent() is not None:
+                continue
+            if isinstance(element.tag, basestring):
+                # a copy keeps the default namespace that removing the
+                # element from the document would rename
+                indexed = deepcopy(element)
+                indexed.tail = None
+                self.add(local_name(indexed), indexed, document_name)
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def output_elements(self):
+        """Yields the elements of the merged document in Salesforce order."""
+        profile = self.output_name == 'Profile'
+        sections = set(section for (section, key) in self.elements)
+        names = sorted(sections | set(self.scalars) | set(self.verbatim) |
+                       (set() if profile else set([TAB_SETTINGS])))
+        for name in names:
+            if not profile and name in PROFILE_ONLY:
+                continue
+            if name in self.scalars:
+                yield self.scalars[name]
+                continue
+            if name in self.verbatim:
+                for key in sorted(self.verbatim[name]):
+                    yield self.verbatim[name][key]
+                continue
+            section = TAB_SECTION if name == TAB_SETTINGS else name
+            if name == TAB_SECTION and not profile:
+                continue
+            keys = sorted(key for (each, key) in self.elements
+                          if each == section)
+            for key in keys:
+                element = self.output_element(section,
+                                              self.elements[(section, key)])
+                if element is not None:
+                    yield element
+
+    def write(self, filename):
+        """Writes the merged document in Salesforce order, and returns the
+        number of elements written."""
+        written = 0
+        with StreamWriter(filename, self.output_name) as writer:
+            for element in self.output_elements():
+                writer.write(element)
+                written += 1
+        return written
+
+    def content(self):
+        """Renders the merged document as bytes, as write would save it."""
+        root = sforce_root(self.output_name)
+        for element in self.output_elements():
+            root.append(element)
+        return canonical_bytes(root)
+
+    def output_element(self, section, element):
+        """Renders an indexed element for the output kind, or None if the
+        output kind cannot hold it."""
+        if self.output_name == 'Profile':
+            return order_children(element)
+        for name in DEFAULT_CHILDREN:
+            child = element.find('{%s}%s' % (SF_URI, name))
+            if child is not None:
+                element.remove(child)
+        if section == TAB_SECTION:
+            visibility = TAB_TO_SETTINGS.get(child_text(element, 'visibility'))
+            if visibility in (None, 'None'):
+                return None
+            set_child_text(element, 'visibility', visibility)
+            element.tag = '{%s}%s' % (SF_URI, TAB_SETTINGS)
+        return order_children(element)
+
+
+def main(profile_paths, profile_path_output, label=None):
+    """Merges the documents at profile_paths into profile_path_output.
+
+    >>> from tempfile import mkdtemp
+    >>> from os import path
+    >>> folder = mkdtemp()
+    >>> def write(name, root_name, body):
+    ...     filename = path.join(folder, name)
+    ...     open(filename, 'w').write('<?xml version="1.0" encoding="UTF-8"?>'
+    ...         '<%s xmlns="%s">%s</%s>' % (root_name, SF_URI, body, root_name))
+    ...     return filename
+    >>> standard = write('Standard.profile', 'Profile',
+    ...     '<classAccesses><apexClass>A</apexClass><enabled>true</enabled>'
+    ...     '</classAccesses><custom>false</custom><customSettingAccesses>'
+    ...     '<enabled>false</enabled><name>Limits__c</name>'
+    ...     '</customSettingAccesses><loginIpRanges><endAddress>10.0.0.255'
+    ...     '</endAddress><startAddress>10.0.0.0</startAddress>'
+    ...     '</loginIpRanges><objectPermissions>'
+    ...     '<allowCreate>false</allowCreate><allowRead>true</allowRead>'
+    ...     '<object>Account</object></objectPermissions><tabVisibilities>'
+    ...     '<tab>Account</tab><visibility>DefaultOff</visibility>'
+    ...     '</tabVisibilities><userLicense>Salesforce</userLicense>')
+    >>> reports = write('Reports.permissionset', 'PermissionSet',
+    ...     '<classAccesses><apexClass>B</apexClass><enabled>true</enabled>'
+    ...     '</classAccesses><customSettingAccesses><enabled>true</enabled>'
+    ...     '<name>Limits__c</name></customSettingAccesses><flowAccesses>'
+    ...     '<enabled>true</enabled><flow>Escalate</flow></flowAccesses>'
+    ...     '<label>Reports</label><objectPermissions>'
+    ...     '<allowCreate>true</allowCreate><allowRead>false</allowRead>'
+    ...     '<object>Account</object></objectPermissions><tabSettings>'
+    ...     '<tab>Account</tab><visibility>Visible</visibility></tabSettings>'
+    ...     '<userPermissions><enabled>true</enabled><name>RunReports</name>'
+    ...     '</userPermissions>')
+    >>> output = path.join(folder, 'Merged.profile')
+    >>> main([standard, reports], output)
+    Keeping loginIpRanges unmerged: no merge key is known for it.
+    Merged 11 elements from 2 documents into 10 elements.
+    0
+    >>> print open(output).read(),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Profile xmlns="http://soap.sforce.com/2006/04/metadata">
+        <classAccesses>
+            <apexClass>A</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+        <classAccesses>
+            <apexClass>B</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+        <custom>false</custom>
+        <customSettingAccesses>
+            <enabled>true</enabled>
+            <name>Limits__c</name>
+        </customSettingAccesses>
+        <flowAccesses>
+            <enabled>true</enabled>
+            <flow>Escalate</flow>
+        </flowAccesses>
+        <loginIpRanges>
+            <endAddress>10.0.0.255</endAddress>
+            <startAddress>10.0.0.0</startAddress>
+        </loginIpRanges>
+        <objectPermissions>
+            <allowCreate>true</allowCreate>
+            <allowRead>true</allowRead>
+            <object>Account</object>
+        </objectPermissions>
+        <tabVisibilities>
+            <tab>Account</tab>
+            <visibility>DefaultOn</visibility>
+        </tabVisibilities>
+        <userLicense>Salesforce</userLicense>
+        <userPermissions>
+            <enabled>true</enabled>
+            <name>RunReports</name>
+        </userPermissions>
+    </Profile>
+    >>> output = path.join(folder, 'Merged.permissionset')
+    >>> main([standard, reports], output, 'Merged')
+    Keeping loginIpRanges unmerged: no merge key is known for it.
+    Merged 11 elements from 2 documents into 8 elements.
+    0
+    >>> print open(output).read(), # doctest: +ELLIPSIS
+    <?xml version="1.0" encoding="UTF-8"?>
+    <PermissionSet xmlns="http://soap.sforce.com/2006/04/metadata">
+    ...
+        <label>Merged</label>
+    ...
+        <tabSettings>
+            <tab>Account</tab>
+            <visibility>Visible</visibility>
+        </tabSettings>
+    ...
+    </PermissionSet>
+    """
+    output_name = root_name(profile_path_output)
+    index = MergeIndex(output_name)
+    for filename in profile_paths:
+        index.load(filename)
+    if label is not None:
+        element = etree.Element('{%s}label' % SF_URI, nsmap={None: SF_URI})
+        element.text = label
+        index.scalars['label'] = element
+    written = index.write(profile_path_output)
+    print("Merged {count} elements from {documents} documents into {written} "
+          "elements.".format(count=index.count, documents=len(profile_paths),
+                             written=written))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Merges the grants of several "
+                                                 "profiles and permission sets "
+                                                 "into one document.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('profile_paths', nargs='*', help="The documents to "
+                                                         "merge.")
+    parser.add_argument('-o', '--profile_path_output', help="The merged "
+                                                            ".profile or "
+                                                            ".permissionset.")
+    parser.add_argument('-l', '--profile_label', help="The label of a merged "
+                                                      "permission set.")
+    return parser
+
+
+def __args_verify(profile_paths, profile_path_output):
+    if not profile_paths or profile_path_output is None:
+        print("Requires profile_path_sources, profile_path_output as parameters "
+              "or system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    profile_paths = None
+    if 'profile_path_sources' in environ:
+        profile_paths = [x for x in environ['profile_path_sources'].split(pathsep)
+                         if x]
+    profile_path_output = environ.get('profile_path_output')
+    profile_label = environ.get('profile_label') or None
+
+    args = __parser_config().parse_args()
+
+    profile_paths = args.profile_paths if args.profile_paths else profile_paths
+    profile_path_output = args.profile_path_output \
+        if args.profile_path_output is not None else profile_path_output
+    profile_label = args.profile_label if args.profile_label is not None \
+        else profile_label
+    __args_verify(profile_paths, profile_path_output)
+
+    exit(main(profile_paths, profile_path_output, profile_label))
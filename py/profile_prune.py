@@ -3,11 +3,14 @@
 enabled, and returns the pruned version to standard output.
 
 To call from the Python CLI (with metadata present):
-    ./profile_prune.py ~/8/"Custom Standard.profile" > pruned.profile
+    ./profile_prune.py ~/8/"Custom Standard.profile" pruned.profile
+    ./profile_prune.py -d ~/git/sf-org/src -o ~/pruned -j 8
 
 To call from the Ant CLI: ant -Dhome={} -Dsf_credentials={}
     -Dprofile_path_source=~/8/"Custom Standard.profile"
+    ant -Dhome={} -Dprofile_dir_source=~/git/sf-org/src profilePruneAll
 
+To run the embedded tests: python -m doctest -v profile_prune.py
 """
 """
 Use Case for profile_prune.py
@@ -37,41 +40,229 @@ remove elements that do not grant access.
 4. Process returns well-formed profile XML document to standard output, with
 default components removed.
 
-
+Alternate Scenario:
+(2a)
+1. External actor passes a directory instead, and process prunes every
+profile and permission set under it, several files at a time, each in place
+or to the same relative path under a mirror directory.
+(3a)
+1. Process streams the document with iterparse, dropping each element that
+does not grant access as soon as it is read, so that every section is pruned
+in one pass, and writes the elements that remain through StreamWriter.
 """
-from os import environ
-from sys import argv, exit
+import argparse
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from os import environ, makedirs, path, walk
+from sys import exit
+
+from lxml import etree
+
+from profile_delta import PARENTS, PRUNE_CHILD
+from tools_lxml import SF_URI, StreamWriter, local_name
+
+# section: child whose value is checked, for the sections pruned
+PRUNE_CHILDREN = dict((name, '{%s}%s' % (SF_URI, children[PRUNE_CHILD]))
+                      for (name, children) in PARENTS.items())
+PRUNE_VALUES = ('false', 'None')
+PATTERNS = ('*.profile', '*.permissionset')
+
+
+def prune_stream(profile_path_source, profile_path_target):
+    """Prunes a document in a single iterparse pass, and returns the number
+    of elements kept and dropped. Raises IOError if the source cannot be
+    read, and XMLSyntaxError if it cannot be parsed.
+
+    >>> from tempfile import mkdtemp
+    >>> source = path.join(mkdtemp(), 'Example.profile')
+    >>> open(source, 'w').write('<?xml version="1.0" encoding="UTF-8"?>'
+    ...     '<Profile xmlns="%s"><userLicense>Salesforce</userLicense>'
+    ...     '<classAccesses><apexClass>A</apexClass><enabled>false</enabled>'
+    ...     '</classAccesses><classAccesses><apexClass>B</apexClass>'
+    ...     '<enabled>true</enabled></classAccesses><objectPermissions>'
+    ...     '<allowRead>false</allowRead><object>Lead</object>'
+    ...     '</objectPermissions><custom>false</custom></Profile>' % SF_URI)
+    >>> prune_stream(source, source)
+    (3, 2)
+    >>> print open(source).read(),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Profile xmlns="http://soap.sforce.com/2006/04/metadata">
+        <classAccesses>
+            <apexClass>B</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+        <custom>false</custom>
+        <userLicense>Salesforce</userLicense>
+    </Profile>
+    """
+    root = None
+    dropped = 0
+    for (event, element) in etree.iterparse(profile_path_source,
+                                            events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+        parent = element.getparent()
+        if parent is not root or not isinstance(element.tag, basestring):
+            continue
+        prune_child = PRUNE_CHILDREN.get(local_name(element))
+        if prune_child is not None and \
+                element.findtext(prune_child) in PRUNE_VALUES:
+            parent.remove(element)
+            dropped += 1
+    kept = [child for child in root if isinstance(child.tag, basestring)]
+    with StreamWriter(profile_path_target, local_name(root)) as writer:
+        # Salesforce order, as save_tree renders with order=True
+        for element in sorted(kept, key=local_name):
+            writer.write(element)
+    return (len(kept), dropped)
+
+
+def prune_file(paths):
+    """Prunes one document for a worker, and returns its outcome rather than
+    raising, so that one bad file does not stop the others."""
+    (profile_path_source, profile_path_target) = paths
+    try:
+        (kept, dropped) = prune_stream(profile_path_source, profile_path_target)
+    except (IOError, etree.XMLSyntaxError) as error:
+        return (profile_path_source, None, str(error))
+    return (profile_path_source, dropped, kept)
 
-from tools_lxml import save_tree
 
-from profile_delta import prune_tree
+def find_documents(profile_dir_source, profile_dir_target=None):
+    """Lists (source, target) for each profile and permission set under the
+    source directory, the target being the source unless a mirror directory
+    is given.
+
+    >>> from tempfile import mkdtemp
+    >>> folder = mkdtemp()
+    >>> makedirs(path.join(folder, 'profiles'))
+    >>> makedirs(path.join(folder, 'permissionsets'))
+    >>> for name in ['profiles/A.profile', 'permissionsets/B.permissionset',
+    ...              'profiles/notes.txt']:
+    ...     open(path.join(folder, name), 'w').write('')
+    >>> [(path.relpath(source, folder), path.relpath(target, '/mirror'))
+    ...  for (source, target) in find_documents(folder, '/mirror')]
+    [('permissionsets/B.permissionset', 'permissionsets/B.permissionset'), ('profiles/A.profile', 'profiles/A.profile')]
+    """
+    documents = []
+    for (dirpath, dirnames, filenames) in walk(profile_dir_source):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not any(fnmatch(filename, pattern) for pattern in PATTERNS):
+                continue
+            source = path.join(dirpath, filename)
+            target = source
+            if profile_dir_target is not None:
+                target = path.join(profile_dir_target,
+                                   path.relpath(source, profile_dir_source))
+            documents.append((source, target))
+    return documents
+
+
+def main_dir(profile_dir_source, profile_dir_target=None, jobs=4):
+    """Prunes every profile and permission set under the source directory,
+    jobs files at a time, and returns the number of files that failed.
+
+    >>> from tempfile import mkdtemp
+    >>> folder = mkdtemp()
+    >>> makedirs(path.join(folder, 'profiles'))
+    >>> for name in ['A', 'B']:
+    ...     open(path.join(folder, 'profiles', name + '.profile'), 'w').write(
+    ...         '<Profile xmlns="%s"><pageAccesses><apexPage>P</apexPage>'
+    ...         '<enabled>false</enabled></pageAccesses></Profile>' % SF_URI)
+    >>> open(path.join(folder, 'profiles', 'C.profile'), 'w').write('<Profile')
+    >>> main_dir(folder, path.join(folder, 'mirror'), 2) # doctest: +ELLIPSIS
+    Could not prune .../profiles/C.profile: ...
+    Pruned 2 of 3 files, dropping 2 elements.
+    1
+    >>> print open(path.join(folder, 'mirror/profiles/A.profile')).read(),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Profile xmlns="http://soap.sforce.com/2006/04/metadata"/>
+    """
+    documents = find_documents(profile_dir_source, profile_dir_target)
+    for (source, target) in documents:
+        folder = path.dirname(target)
+        if not path.isdir(folder):
+            makedirs(folder)
+    failed = 0
+    dropped = 0
+    if documents:
+        pool = Pool(max(1, min(jobs, len(documents))))
+        for (source, count, detail) in pool.imap(prune_file, documents):
+            if count is None:
+                failed += 1
+                print("Could not prune {source}: {detail}".format(
+                    source=source, detail=detail))
+            else:
+                dropped += count
+        pool.close()
+        pool.join()
+    print("Pruned {count} of {total} files, dropping {dropped} elements.".format(
+        count=len(documents) - failed, total=len(documents), dropped=dropped))
+    return failed
 
 
 def main(profile_path_source, profile_path_target):
     """Reads profile from file system and renders pruned profile.
     """
     try:
-        source_root = prune_tree(profile_path_source)
+        prune_stream(profile_path_source, profile_path_target)
     except IOError:
         # Info error only. Not exception.
         print "{profile_path_source} is not available.".format(
             profile_path_source=profile_path_source)
         return 1
-    save_tree(source_root, profile_path_target) 
     return 0
 
 
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Removes the elements that do "
+                                                 "not grant access from "
+                                                 "profiles and permission sets.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('profile_path_source', nargs='?', help="The document "
+                                                               "to prune.")
+    parser.add_argument('profile_path_target', nargs='?', help="The pruned "
+                                                               "document.")
+    parser.add_argument('-d', '--profile_dir_source', help="A directory to "
+                                                           "prune every "
+                                                           "document under.")
+    parser.add_argument('-o', '--profile_dir_target', help="A mirror directory "
+                                                           "for the pruned "
+                                                           "documents (in "
+                                                           "place by default).")
+    parser.add_argument('-j', '--sf_jobs', type=int, help="The number of files "
+                                                          "to prune at once.")
+    return parser
+
+
 if __name__ == '__main__':
-    if len(argv) == 3:
-        main(argv[1], argv[2])
-    else:
-        profile_path_source = None
-        profile_path_target = None
-        try:
-            profile_path_source = environ['profile_path_source']
-            profile_path_target = environ['profile_path_target']
-        except KeyError:
-            print "Requires profile_path_source and profile_path_target as \
-            parameters or system properties."
-            exit(1)
-        main(profile_path_source, profile_path_target)
+    profile_path_source = environ.get('profile_path_source')
+    profile_path_target = environ.get('profile_path_target')
+    profile_dir_source = environ.get('profile_dir_source') or None
+    profile_dir_target = environ.get('profile_dir_target') or None
+    sf_jobs = environ.get('sf_jobs', '4')
+
+    args = __parser_config().parse_args()
+
+    sf_jobs = args.sf_jobs if args.sf_jobs is not None else int(sf_jobs)
+    profile_dir_source = args.profile_dir_source \
+        if args.profile_dir_source is not None else profile_dir_source
+    profile_dir_target = args.profile_dir_target \
+        if args.profile_dir_target is not None else profile_dir_target
+    if profile_dir_source is not None and args.profile_path_source is None:
+        exit(1 if main_dir(profile_dir_source, profile_dir_target, sf_jobs)
+             else 0)
+
+    profile_path_source = args.profile_path_source \
+        if args.profile_path_source is not None else profile_path_source
+    profile_path_target = args.profile_path_target \
+        if args.profile_path_target is not None else profile_path_target
+    if profile_path_source is None or profile_path_target is None:
+        print "Requires profile_path_source and profile_path_target, or \
+profile_dir_source, as parameters or system properties."
+        exit(1)
+    exit(main(profile_path_source, profile_path_target))
@@ -0,0 +1,451 @@
+#!/usr/bin/python
+"""Keeps the grants of each release's profiles and permission sets in one
+compact snapshot store, and renders the upgrade documents between any two
+ingested versions from the store alone.
+
+To call from the Python CLI (with metadata present):
+    ./profile_snapshot.py -s ~/snapshots.json.gz -v 7.0 -d ~/7/src
+    ./profile_snapshot.py -s ~/snapshots.json.gz -v 9.0 -d ~/9/src
+    ./profile_snapshot.py -s ~/snapshots.json.gz -f 7.0 -t 9.0 -o ~/upgrade
+
+To call from the Ant CLI: ant -Dhome={} -Dprofile_snapshot={}
+    -Dprofile_version=9.0 -Dprofile_dir_source=~/9/src profileSnapshot
+    ant -Dhome={} -Dprofile_snapshot={} -Dprofile_version_source=7.0
+    -Dprofile_version_target=9.0 -Dprofile_dir_output=~/upgrade
+    profileSnapshotDelta
+
+To run the embedded tests: python -m doctest -v profile_snapshot.py
+"""
+"""
+Use Case for profile_snapshot.py
+
+Motivation: profile_delta needs the source and target versions checked out
+side by side and reparses both documents for every comparison, though
+release engineering asks for many pairs (what does 9.x grant that 7.x did
+not?).
+
+Stakeholders: Release Engineering
+
+Output: A gzip JSON snapshot store holding, for each document and PARENTS
+section, a column of interned component names, a column of interned element
+bodies and a column of bitmaps of the versions granting each row. From the
+store, upgrade documents for any pair of versions, as profile_delta would
+render them.
+
+Prerequisite: Each release's profiles and permission sets are retrieved once
+to be ingested.
+
+Assumptions:
+1. A grant is an element of a PARENTS section whose prune child is not false,
+as profile_delta.prune_elements keeps.
+2. An element is identified by its section and extract child, so an element
+whose other children changed between versions is a new row sharing the name.
+3. The document names (the paths under the source folder) are stable across
+versions.
+
+Success Scenario:
+1. External actor invokes script from command line passing the store, a
+version and the source folder of that version.
+2. Process streams each profile and permission set once with iterparse,
+interning the names, children and values, and sets the version bit of each
+row granted, adding rows for new elements.
+3. Process saves the store.
+4. External actor invokes script again passing the store, a source version,
+a target version and an output folder.
+5. For each document, process finds the names granted by the target version
+and not by the source version from the bitmaps, and writes the target rows
+for those names through StreamWriter, section by section.
+
+Alternate Scenario:
+(2a)
+1. The version is already in the store, so its bit is cleared from every row
+before the documents are read again.
+(5a)
+1. A document grants nothing new, so no upgrade document is written for it.
+"""
+import argparse
+import gzip
+import json
+from fnmatch import fnmatch
+from os import environ, makedirs, path, rename, walk
+from sys import exit
+
+from lxml import etree
+
+from profile_delta import EXTRACT_CHILD, PARENTS, PRUNE_CHILD
+from tools_lxml import SF_URI, StreamWriter, local_name
+
+SNAPSHOT_FORMAT = 1
+PATTERNS = ('*.profile', '*.permissionset')
+PRUNE_VALUES = ('false', 'None')
+LABEL = 'label'
+
+
+class SnapshotStore:
+    """Columnar store of the grants of several versions of a set of
+    documents. Strings and element bodies are interned, so a row is two
+    integers and a bitmap whose bit i is set when versions[i] grants it.
+
+    >>> store = SnapshotStore()
+    >>> store.version_bit('7.0'), store.version_bit('9.0')
+    (1, 2)
+    >>> store.intern('Account'), store.intern('Lead'), store.intern('Account')
+    (0, 1, 0)
+    """
+
+    def __init__(self):
+        self.versions = []
+        self.strings = []
+        self.bodies = []
+        self.documents = {}
+        self.my_string_ids = {}
+        self.my_body_ids = {}
+        self.my_row_ids = {}
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a store saved by save, or returns an empty store if the
+        file does not exist."""
+        store = cls()
+        if not path.isfile(filename):
+            return store
+        with gzip.open(filename, 'rb') as snapshot_file:
+            data = json.load(snapshot_file)
+        if data.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError("{filename} is not a snapshot store of format "
+                             "{format}.".format(filename=filename,
+                                                format=SNAPSHOT_FORMAT))
+        store.versions = data['versions']
+        store.strings = data['strings']
+        store.bodies = [tuple(body) for body in data['bodies']]
+        store.documents = data['documents']
+        store.my_string_ids = dict((value, index) for (index, value)
+                                   in enumerate(store.strings))
+        store.my_body_ids = dict((body, index) for (index, body)
+                                 in enumerate(store.bodies))
+        return store
+
+    def save(self, filename):
+        """Writes the store as gzip JSON, replacing the file atomically."""
+        data = {'format': SNAPSHOT_FORMAT, 'versions': self.versions,
+                'strings': self.strings, 'bodies': self.bodies,
+                'documents': self.documents}
+        temp = filename + '.tmp'
+        with gzip.open(temp, 'wb') as snapshot_file:
+            json.dump(data, snapshot_file, separators=(',', ':'),
+                      sort_keys=True)
+        rename(temp, filename)
+
+    def intern(self, value):
+        """Returns the id of a string, adding it if it is new."""
+        index = self.my_string_ids.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(value)
+            self.my_string_ids[value] = index
+        return index
+
+    def intern_body(self, element):
+        """Returns the id of an element body, the interned (child, text)
+        pairs of its children in document order."""
+        body = []
+        for child in element:
+            if isinstance(child.tag, basestring):
+                body.extend([self.intern(local_name(child)),
+                             self.intern(child.text or '')])
+        body = tuple(body)
+        index = self.my_body_ids.get(body)
+        if index is None:
+            index = len(self.bodies)
+            self.bodies.append(body)
+            self.my_body_ids[body] = index
+        return index
+
+    def version_bit(self, version):
+        """Returns the bitmap bit of a version, adding it if it is new."""
+        if version not in self.versions:
+            self.versions.append(version)
+        return 1 << self.versions.index(version)
+
+    def document(self, relpath, root_name):
+        """Returns the columns of a document, adding it if it is new."""
+        document = self.documents.get(relpath)
+        if document is None:
+            document = {'root': root_name, 'labels': {}, 'sections': {}}
+            self.documents[relpath] = document
+        return document
+
+    def clear_version(self, version):
+        """Clears the bit of a version from every row, so that it can be
+        ingested again."""
+        if version not in self.versions:
+            return
+        mask = ~(1 << self.versions.index(version))
+        for document in self.documents.values():
+            document['labels'].pop(version, None)
+            for columns in document['sections'].values():
+                columns['bits'] = [bits & mask for bits in columns['bits']]
+
+    def add_row(self, relpath, document, section, name_id, body_id, bit):
+        """Sets the version bit of a row, adding the row if it is new."""
+        columns = document['sections'].get(section)
+        if columns is None:
+            columns = {'names': [], 'bodies': [], 'bits': []}
+            document['sections'][section] = columns
+        key = (relpath, section)
+        rows = self.my_row_ids.get(key)
+        if rows is None:
+            rows = dict(((name, body), index) for (index, (name, body))
+                        in enumerate(zip(columns['names'], columns['bodies'])))
+            self.my_row_ids[key] = rows
+        index = rows.get((name_id, body_id))
+        if index is None:
+            rows[(name_id, body_id)] = len(columns['names'])
+            columns['names'].append(name_id)
+            columns['bodies'].append(body_id)
+            columns['bits'].append(bit)
+        else:
+            columns['bits'][index] |= bit
+
+    def ingest_file(self, filename, relpath, version):
+        """Streams one document into the store as granted by version, and
+        returns the number of grants."""
+        bit = self.version_bit(version)
+        document = None
+        count = 0
+        for (event, element) in etree.iterparse(filename, events=('start', 'end')):
+            parent = element.getparent()
+            if event == 'start':
+                if parent is None:
+                    document = self.document(relpath, local_name(element))
+                continue
+            if parent is None or parent.getparent() is not None:
+                continue
+            if isinstance(element.tag, basestring):
+                section = local_name(element)
+                children = PARENTS.get(section)
+                if section == LABEL:
+                    document['labels'][version] = element.text
+                elif children is not None and element.findtext(
+                        '{%s}%s' % (SF_URI, children[PRUNE_CHILD])) \
+                        not in PRUNE_VALUES:
+                    name = element.findtext('{%s}%s' % (SF_URI,
+                                                        children[EXTRACT_CHILD]))
+                    self.add_row(relpath, document, section,
+                                 self.intern(name or ''),
+                                 self.intern_body(element), bit)
+                    count += 1
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+        return count
+
+    def ingest(self, sourcedir, version):
+        """Ingests every profile and permission set under sourcedir as
+        granted by version, replacing any earlier ingest of that version,
+        and returns the number of documents."""
+        self.clear_version(version)
+        count = 0
+        for (dirpath, dirnames, filenames) in walk(sourcedir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if any(fnmatch(filename, pattern) for pattern in PATTERNS):
+                    filename = path.join(dirpath, filename)
+                    self.ingest_file(filename, path.relpath(filename, sourcedir),
+                                     version)
+                    count += 1
+        return count
+
+    def delta_rows(self, relpath, version_source, version_target):
+        """Lists (section, body id) for the target rows whose names the
+        source version does not grant, in section and row order."""
+        source_bit = 1 << self.versions.index(version_source)
+        target_bit = 1 << self.versions.index(version_target)
+        rows = []
+        sections = self.documents[relpath]['sections']
+        for section in sorted(sections):
+            columns = sections[section]
+            granted = {}
+            for (name, bits) in zip(columns['names'], columns['bits']):
+                granted[name] = granted.get(name, 0) | bits
+            for (name, body, bits) in zip(columns['names'], columns['bodies'],
+                                          columns['bits']):
+                if bits & target_bit and not granted[name] & source_bit:
+                    rows.append((section, body))
+        return rows
+
+    def element(self, section, body_id):
+        """Renders a row as an element."""
+        element = etree.Element('{%s}%s' % (SF_URI, section),
+                                nsmap={None: SF_URI})
+        body = self.bodies[body_id]
+        for index in range(0, len(body), 2):
+            child = etree.SubElement(element, '{%s}%s' % (SF_URI,
+                                                          self.strings[body[index]]))
+            child.text = self.strings[body[index + 1]]
+        return element
+
+    def write_delta(self, relpath, version_source, version_target, filename):
+        """Writes the upgrade document of one document, and returns the
+        number of elements written, writing nothing if there are none."""
+        rows = self.delta_rows(relpath, version_source, version_target)
+        if not rows:
+            return 0
+        document = self.documents[relpath]
+        label = document['labels'].get(version_target)
+        if document['root'] != 'Profile' and label is not None:
+            rows.append((LABEL, None))
+            rows.sort(key=lambda row: row[0])
+        folder = path.dirname(filename)
+        if folder and not path.isdir(folder):
+            makedirs(folder)
+        with StreamWriter(filename, document['root']) as writer:
+            for (section, body_id) in rows:
+                if section == LABEL:
+                    element = etree.Element('{%s}%s' % (SF_URI, LABEL),
+                                            nsmap={None: SF_URI})
+                    element.text = label
+                    writer.write(element)
+                else:
+                    writer.write(self.element(section, body_id))
+        return len(rows)
+
+
+def main_ingest(snapshot, version, sourcedir):
+    """Ingests the documents of one version into the store."""
+    store = SnapshotStore.load(snapshot)
+    count = store.ingest(sourcedir, version)
+    store.save(snapshot)
+    print("Ingested {count} documents of {version} into {snapshot}.".format(
+        count=count, version=version, snapshot=snapshot))
+    return 0
+
+
+def main_delta(snapshot, version_source, version_target, outputdir):
+    """Writes the upgrade documents between two ingested versions.
+
+    >>> from tempfile import mkdtemp
+    >>> folder = mkdtemp()
+    >>> def write(version, name, body):
+    ...     filename = path.join(folder, version, 'profiles', name)
+    ...     if not path.isdir(path.dirname(filename)):
+    ...         makedirs(path.dirname(filename))
+    ...     open(filename, 'w').write('<Profile xmlns="%s">%s</Profile>'
+    ...                               % (SF_URI, body))
+    >>> write('7', 'Admin.profile', '<classAccesses><apexClass>A</apexClass>'
+    ...     '<enabled>true</enabled></classAccesses><classAccesses><apexClass>'
+    ...     'B</apexClass><enabled>false</enabled></classAccesses>')
+    >>> write('9', 'Admin.profile', '<classAccesses><apexClass>A</apexClass>'
+    ...     '<enabled>true</enabled></classAccesses><classAccesses><apexClass>'
+    ...     'B</apexClass><enabled>true</enabled></classAccesses><tabVisibilities>'
+    ...     '<tab>T</tab><visibility>DefaultOn</visibility></tabVisibilities>')
+    >>> write('9', 'Guest.profile', '<custom>true</custom>')
+    >>> snapshot = path.join(folder, 'snapshots.json.gz')
+    >>> main_ingest(snapshot, '7.0', path.join(folder, '7')) # doctest: +ELLIPSIS
+    Ingested 1 documents of 7.0 into ....
+    0
+    >>> main_ingest(snapshot, '9.0', path.join(folder, '9')) # doctest: +ELLIPSIS
+    Ingested 2 documents of 9.0 into ....
+    0
+    >>> main_delta(snapshot, '7.0', '9.0', path.join(folder, 'upgrade'))
+    Wrote 1 upgrade documents granting 2 elements from 7.0 to 9.0.
+    0
+    >>> print open(path.join(folder, 'upgrade/profiles/Admin.profile')).read(),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Profile xmlns="http://soap.sforce.com/2006/04/metadata">
+        <classAccesses>
+            <apexClass>B</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+        <tabVisibilities>
+            <tab>T</tab>
+            <visibility>DefaultOn</visibility>
+        </tabVisibilities>
+    </Profile>
+    >>> main_delta(snapshot, '9.0', '7.0', path.join(folder, 'downgrade'))
+    Wrote 0 upgrade documents granting 0 elements from 9.0 to 7.0.
+    0
+    """
+    store = SnapshotStore.load(snapshot)
+    for version in (version_source, version_target):
+        if version not in store.versions:
+            print("{version} is not in {snapshot}.".format(version=version,
+                                                           snapshot=snapshot))
+            return 1
+    documents = 0
+    elements = 0
+    for relpath in sorted(store.documents):
+        count = store.write_delta(relpath, version_source, version_target,
+                                  path.join(outputdir, relpath))
+        documents += 1 if count else 0
+        elements += count
+    print("Wrote {documents} upgrade documents granting {elements} elements "
+          "from {source} to {target}.".format(documents=documents,
+                                              elements=elements,
+                                              source=version_source,
+                                              target=version_target))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Ingests profile versions into "
+                                                 "a snapshot store, or writes "
+                                                 "the upgrade documents between "
+                                                 "two versions.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-s', '--profile_snapshot', help="The snapshot store.")
+    parser.add_argument('-v', '--profile_version', help="The version to "
+                                                        "ingest.")
+    parser.add_argument('-d', '--profile_dir_source', help="The source folder "
+                                                           "of the version to "
+                                                           "ingest.")
+    parser.add_argument('-f', '--profile_version_source', help="The version "
+                                                               "upgraded "
+                                                               "from.")
+    parser.add_argument('-t', '--profile_version_target', help="The version "
+                                                               "upgraded to.")
+    parser.add_argument('-o', '--profile_dir_output', help="The folder for the "
+                                                           "upgrade documents.")
+    return parser
+
+
+def __args_verify(profile_snapshot, ingest, delta):
+    if profile_snapshot is None or not (all(ingest) or all(delta)):
+        print("Requires profile_snapshot with profile_version, "
+              "profile_dir_source to ingest, or with profile_version_source, "
+              "profile_version_target, profile_dir_output to write upgrades, "
+              "as parameters or system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    profile_snapshot = environ.get('profile_snapshot')
+    profile_version = environ.get('profile_version') or None
+    profile_dir_source = environ.get('profile_dir_source') or None
+    profile_version_source = environ.get('profile_version_source') or None
+    profile_version_target = environ.get('profile_version_target') or None
+    profile_dir_output = environ.get('profile_dir_output') or None
+
+    args = __parser_config().parse_args()
+
+    profile_snapshot = args.profile_snapshot \
+        if args.profile_snapshot is not None else profile_snapshot
+    profile_version = args.profile_version \
+        if args.profile_version is not None else profile_version
+    profile_dir_source = args.profile_dir_source \
+        if args.profile_dir_source is not None else profile_dir_source
+    profile_version_source = args.profile_version_source \
+        if args.profile_version_source is not None else profile_version_source
+    profile_version_target = args.profile_version_target \
+        if args.profile_version_target is not None else profile_version_target
+    profile_dir_output = args.profile_dir_output \
+        if args.profile_dir_output is not None else profile_dir_output
+    ingest = (profile_version, profile_dir_source)
+    delta = (profile_version_source, profile_version_target, profile_dir_output)
+    __args_verify(profile_snapshot, ingest, delta)
+
+    if all(ingest):
+        exit(main_ingest(profile_snapshot, profile_version, profile_dir_source))
+    exit(main_delta(profile_snapshot, profile_version_source,
+                    profile_version_target, profile_dir_output))
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+"""Keeps a local cache of the components retrieved from an org, with the
+lastModifiedDate and fileName listed for each, and refreshes it by
+retrieving only the components modified since the last snapshot.
+
+To call from the Python CLI (with metadata present):
+    % ./retrieve_cache.py -u ~/git/ant-sf/package-all.xml
+                          -c ~/git/sf-org/.retrieveCache
+                          -t ~/git/sf-org/retrieveTarget
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_credentials={} retrieveIncremental
+
+To run the embedded tests: python -m doctest -v retrieve_cache.py
+"""
+"""
+Use Case for retrieve_cache.py
+
+Motivation: RetrieveFromOrg and the Backup targets retrieve the whole org
+every time, though a nightly backup of production sees a few dozen changes.
+
+Stakeholders: Release Engineering
+
+Output: The cache folder holds snapshot.json and the retrieved files under
+tree/. The tree, with a package.xml of every cached member, is copied to
+sf_retrieveTarget, as retrieveUnpackaged would leave it.
+
+Prerequisite: The credentials and manifest are set as for retrieveUnpackaged.
+
+Assumptions:
+1. A component is unchanged while its lastModifiedDate is unchanged. An
+object's date does not move when only a field, validation rule, record type
+or other child changes, so the children of CHILD_TYPES are listed as well,
+and an object is stale when the date of any of its children moves, or a
+child is added or removed.
+2. Types that cannot be listed are retrieved in full every time.
+3. Wildcards exclude installed package components, as a retrieve does.
+4. A profile or permission set holds the grants of only the components
+retrieved with it. When only other components changed, every cached profile
+and permission set is retrieved with them, and the grants retrieved replace
+the cached grants of the same key. A profile or permission set that itself
+changed may have changed any grant, so everything is retrieved again.
+
+Success Scenario:
+1. External actor invokes script from command line passing the manifest,
+cache folder and retrieve target.
+2. Process describes the org to find the types kept in folders, and lists
+their folders.
+3. Process lists the components of the manifest types, three queries per
+call.
+4. Process compares the listing with the snapshot, and retrieves the new and
+modified components in chunks into the cached tree.
+5. Process removes the files of the components no longer listed.
+6. Process saves the snapshot, and copies the tree to the retrieve target.
+
+Alternate Scenario:
+(4a)
+1. There is no snapshot, or it was taken for another user, and process
+retrieves every listed component.
+(4b)
+1. Nothing was modified, and process retrieves only the unlisted types.
+(4c)
+1. A profile or permission set was modified, and process retrieves every
+listed component.
+"""
+import argparse
+import json
+from os import environ, makedirs, path, remove
+from shutil import copytree, rmtree
+from sys import exit
+
+from metadata_cache import cached_client
+from metadata_client import MetadataClient
+from poll_scheduler import default_initial_millis
+from retrieve_chunked import CHILD_TYPES, MANIFEST_NAME, MERGED_FOLDERS, \
+    PARENT_TYPE, WILDCARD, LIST_QUERIES, build_manifest, default_chunk_size, default_jobs, plan_chunks, \
+    read_manifest, retrieve_all
+from tools_lxml import load_tree, save_tree
+
+SNAPSHOT_NAME = 'snapshot.json'
+TREE_NAME = 'tree'
+SNAPSHOT_VERSION = 2
+META_SUFFIX = '-meta.xml'
+INSTALLED = 'installed'
+# Types kept in folders, and the type that lists their folders
+FOLDER_TYPES = {'Dashboard': 'DashboardFolder', 'Document': 'DocumentFolder',
+                'EmailTemplate': 'EmailFolder', 'Report': 'ReportFolder'}
+default_api_version = '38.0'
+
+
+def list_queries(client, types):
+    """Returns the (type, folder) queries for the manifest types, listing the
+    folders of the types that describeMetadata marks as in folders."""
+    in_folder = set(fields['xmlName']
+                    for fields in client.describe_metadata()['metadataObjects']
+                    if fields.get('inFolder') == 'true')
+    queries = []
+    for (name, members) in types:
+        if name not in in_folder:
+            queries.append((name, None))
+            continue
+        folders = [fields['fullName']
+                   for fields in client.list_metadata([(FOLDER_TYPES.get(
+                       name, name + 'Folder'), None)])]
+        queries.extend((name, folder) for folder in folders)
+    return (queries, in_folder)
+
+
+def child_dates(listed):
+    """Returns the {object: {type:child: lastModifiedDate}} of the children
+    listed of each object.
+
+    >>> child_dates({'CustomField': {'Account.Tier__c': {
+    ...     'lastModifiedDate': '2'}}, 'ApexClass': {'A': {}}})
+    {'Account': {'CustomField:Account.Tier__c': '2'}}
+    """
+    children = {}
+    for name in CHILD_TYPES:
+        for (member, fields) in listed.get(name, {}).items():
+            children.setdefault(member.split('.')[0], {})[name + ':' + member] = \
+                fields.get('lastModifiedDate')
+    return children
+
+
+def list_components(client, types):
+    """Lists the components of the manifest types as {type: {member:
+    {lastModifiedDate, fileName}}}, and returns the types that could not be
+    listed. Each object also holds the dates of its children."""
+    (queries, in_folder) = list_queries(client, types)
+    objects = PARENT_TYPE in dict(types)
+    if objects:
+        queries.extend((name, None) for name in CHILD_TYPES
+                       if (name, None) not in queries)
+    listed = {}
+    unlisted = set()
+    for start in range(0, len(queries), LIST_QUERIES):
+        batch = queries[start:start + LIST_QUERIES]
+        try:
+            for fields in client.list_metadata(batch):
+                listed.setdefault(fields['type'], {})[fields['fullName']] = fields
+        except IOError as e:
+            failed = set(name for (name, folder) in batch)
+            if objects and failed & set(CHILD_TYPES):
+                # objects cannot be compared without their children
+                failed.add(PARENT_TYPE)
+            failed &= set(dict(types))
+            print("Retrieving {types} in full: {error}".format(
+                types=', '.join(sorted(failed)), error=e))
+            unlisted.update(failed)
+    children = child_dates(listed)
+    components = {}
+    for (name, members) in types:
+        if name in unlisted:
+            continue
+        wanted = set(members)
+        if name in in_folder:
+            # Folders are members of the type they hold
+            for (member, fields) in listed.get(FOLDER_TYPES.get(name, ''), {}).items():
+                listed.setdefault(name, {})[member] = fields
+        components[name] = dict(
+            (member, {'lastModifiedDate': fields.get('lastModifiedDate'),
+                      'fileName': fields.get('fileName')})
+            for (member, fields) in listed.get(name, {}).items()
+            if member in wanted or (WILDCARD in wanted and
+                                    fields.get('manageableState') != INSTALLED))
+    for (member, entry) in components.get(PARENT_TYPE, {}).items():
+        entry['children'] = children.get(member, {})
+    return (components, unlisted)
+
+
+def compare(previous, current):
+    """Returns the {type: members} modified or added, and the entries of the
+    components removed, between two snapshots. An object is modified when
+    the dates of its children differ.
+
+    >>> previous = {'ApexClass': {'A': {'lastModifiedDate': '1', 'fileName': 'classes/A.cls'},
+    ...                           'B': {'lastModifiedDate': '1', 'fileName': 'classes/B.cls'}}}
+    >>> current = {'ApexClass': {'A': {'lastModifiedDate': '2', 'fileName': 'classes/A.cls'},
+    ...                          'C': {'lastModifiedDate': '1', 'fileName': 'classes/C.cls'}},
+    ...            'ApexPage': {}}
+    >>> (changed, removed) = compare(previous, current)
+    >>> print changed, [entry['fileName'] for entry in removed]
+    {'ApexClass': ['A', 'C']} ['classes/B.cls']
+    >>> account = {'lastModifiedDate': '1', 'fileName': 'objects/Account.object',
+    ...            'children': {'CustomField:Account.Tier__c': '1'}}
+    >>> moved = dict(account, children={'CustomField:Account.Tier__c': '2'})
+    >>> compare({'CustomObject': {'Account': account}},
+    ...         {'CustomObject': {'Account': moved}})
+    ({'CustomObject': ['Account']}, [])
+    """
+    changed = {}
+    removed = []
+    for (name, members) in current.items():
+        known = previous.get(name, {})
+        modified = sorted(member for (member, entry) in members.items()
+                          if known.get(member, {}).get('lastModifiedDate') !=
+                          entry['lastModifiedDate'] or
+                          known.get(member, {}).get('children') !=
+                          entry.get('children'))
+        if modified:
+            changed[name] = modified
+    for (name, members) in previous.items():
+        removed.extend(entry for (member, entry) in sorted(members.items())
+                       if member not in current.get(name, {}))
+    return (changed, removed)
+
+
+def remove_files(tree, entries):
+    """Removes the files, and companion -meta.xml files, of the entries from
+    the tree, and returns the number removed."""
+    count = 0
+    for entry in entries:
+        if not entry.get('fileName'):
+            continue
+        filename = path.join(tree, entry['fileName'])
+        for name in (filename, filename + META_SUFFIX):
+            if path.isfile(name):
+                remove(name)
+                count += 1
+    return count
+
+
+class RetrieveCache:
+    """The snapshot and tree of components retrieved for one user."""
+
+    def __init__(self, cachedir, username):
+        self.cachedir = cachedir
+        self.username = username
+        self.tree = path.join(cachedir, TREE_NAME)
+        self.snapshot_path = path.join(cachedir, SNAPSHOT_NAME)
+        self.components = {}
+
+    def load(self):
+        """Loads the snapshot, starting over if it is missing, outdated, or
+        was taken for another user."""
+        self.components = {}
+        if path.isfile(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') == SNAPSHOT_VERSION and \
+                    snapshot.get('username') == self.username:
+                self.components = snapshot['components']
+        if not self.components and path.isdir(self.tree):
+            rmtree(self.tree)
+        if not path.isdir(self.tree):
+            makedirs(self.tree)
+        return self
+
+    def save(self):
+        with open(self.snapshot_path, 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'username': self.username,
+                       'components': self.components}, f, indent=1, sort_keys=True)
+
+    def refresh(self, client, types, version, jobs=default_jobs,
+                chunk_size=default_chunk_size, **poll):
+        """Retrieves the components modified since the snapshot, and those of
+        the types that cannot be listed, into the tree. The profiles and
+        permission sets are retrieved with them, and laid over the cached
+        ones, unless one of them changed and everything is retrieved."""
+        (current, unlisted) = list_components(client, types)
+        (changed, removed) = compare(self.components, current)
+        for (name, members) in types:
+            if name in unlisted:
+                changed[name] = members
+        merged_types = set(MERGED_FOLDERS.values())
+        overlay = not merged_types & set(changed)
+        retrieved = changed
+        if not overlay:
+            retrieved = dict((name, sorted(members))
+                             for (name, members) in current.items() if members)
+            retrieved.update(changed)
+        elif changed:
+            retrieved = dict(changed)
+            retrieved.update((name, sorted(current[name]))
+                             for name in merged_types if current.get(name))
+        packages = [build_manifest(chunk, version)
+                    for chunk in plan_chunks(sorted(retrieved.items()), chunk_size)]
+        (roots, count) = retrieve_all(client, packages, self.tree, jobs,
+                                      overlay=overlay, **poll)
+        deleted = remove_files(self.tree, removed)
+        self.components = current
+        manifest = dict((name, sorted(members)) for (name, members) in current.items()
+                        if members)
+        for name in unlisted:
+            manifest[name] = dict(types)[name]
+        save_tree(build_manifest(manifest, version), path.join(self.tree, MANIFEST_NAME))
+        self.save()
+        print("Retrieved {count} files for {changed} changed components, and "
+              "removed {deleted} files.".format(
+                  count=count, deleted=deleted,
+                  changed=sum(len(members) for members in changed.values())))
+        return count
+
+
+def main(client, unpackaged, cachedir, target, jobs=default_jobs,
+         chunk_size=default_chunk_size, **poll):
+    """Refreshes the cache and copies its tree to the retrieve target."""
+    (types, version) = read_manifest(load_tree(unpackaged).getroot())
+    version = version or client.api_version
+    cache = RetrieveCache(cachedir, client.username).load()
+    cache.refresh(client, types, version, jobs, chunk_size, **poll)
+    if path.isdir(target):
+        rmtree(target)
+    copytree(cache.tree, target)
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Refreshes a cache of "
+                                                 "retrieved components with "
+                                                 "the components modified "
+                                                 "since the last refresh.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-u', '--sf_unpackaged', help="The package.xml to "
+                                                      "retrieve.")
+    parser.add_argument('-c', '--sf_retrieveCache', help="The cache folder.")
+    parser.add_argument('-t', '--sf_retrieveTarget', help="The folder to "
+                                                          "copy the cached "
+                                                          "tree to.")
+    parser.add_argument('-j', '--sf_jobs', type=int, help="The number of "
+                                                          "chunks to retrieve "
+                                                          "at once.")
+    return parser
+
+
+def __args_verify(serverurl, username, unpackaged, cachedir, target):
+    if serverurl is None or username is None or unpackaged is None or \
+            cachedir is None or target is None:
+        print("Requires sf_serverurl, sf_username, sf_password as system "
+              "properties, and sf_unpackaged, sf_retrieveCache, "
+              "sf_retrieveTarget as parameters or system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    sf_serverurl = environ.get('sf_serverurl')
+    sf_username = environ.get('sf_username')
+    sf_password = environ.get('sf_password')
+    sf_unpackaged = environ.get('sf_unpackaged')
+    sf_retrieveCache = environ.get('sf_retrieveCache')
+    sf_retrieveTarget = environ.get('sf_retrieveTarget')
+    sf_apiVersion = environ.get('sf_apiVersion', default_api_version)
+    sf_jobs = int(environ.get('sf_jobs', default_jobs))
+    sf_chunkSize = int(environ.get('sf_chunkSize', default_chunk_size))
+    sf_pollInitialMillis = int(environ.get('sf_pollInitialMillis',
+                                           default_initial_millis))
+    sf_pollWaitMillis = int(environ.get('sf_pollWaitMillis', 30000))
+    sf_maxPoll = int(environ.get('sf_maxPoll', 600))
+    sf_metadataCache = environ.get('sf_metadataCache')
+
+    args = __parser_config().parse_args()
+
+    sf_unpackaged = args.sf_unpackaged if args.sf_unpackaged is not None else sf_unpackaged
+    sf_retrieveCache = args.sf_retrieveCache if args.sf_retrieveCache is not None \
+        else sf_retrieveCache
+    sf_retrieveTarget = args.sf_retrieveTarget if args.sf_retrieveTarget is not None \
+        else sf_retrieveTarget
+    sf_jobs = args.sf_jobs if args.sf_jobs is not None else sf_jobs
+    __args_verify(sf_serverurl, sf_username, sf_unpackaged, sf_retrieveCache,
+                  sf_retrieveTarget)
+
+    client = MetadataClient(sf_serverurl, sf_username, sf_password,
+                            api_version=sf_apiVersion, pool_size=sf_jobs)
+    if sf_metadataCache:
+        # Listings must be fresh to compare dates, but are stored for others
+        client = cached_client(client, sf_metadataCache, 0)
+    main(client, sf_unpackaged, sf_retrieveCache, sf_retrieveTarget, sf_jobs,
+         sf_chunkSize, initial_millis=sf_pollInitialMillis,
+         max_millis=sf_pollWaitMillis, timeout_millis=sf_pollWaitMillis * sf_maxPoll)
+    client.close()
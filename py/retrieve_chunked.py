@@ -0,0 +1,503 @@
+#!/usr/bin/python
+"""Retrieves a package manifest in size-balanced chunks, several at a time,
+and merges the results into one retrieve target with one package.xml.
+
+To call from the Python CLI (with metadata present):
+    % ./retrieve_chunked.py -u ~/git/ant-sf/package-all.xml
+                            -t ~/git/sf-org/retrieveTarget -j 4
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_credentials={} retrieveChunked
+
+To run the embedded tests: python -m doctest -v retrieve_chunked.py
+"""
+"""
+Use Case for retrieve_chunked.py
+
+Motivation: retrieveUnpackaged sends the whole manifest as one request. With
+the package-all.xml wildcards on a big org, that hits the limit of 10,000
+files per retrieve, or polls for twenty minutes.
+
+Stakeholders: Release Engineering
+
+Output: The retrieved components under sf_retrieveTarget, as unzipped by
+retrieveUnpackaged, with a package.xml listing every retrieved member.
+
+Prerequisite: The credentials and manifest are set as for retrieveUnpackaged.
+
+Assumptions:
+1. A member retrieves about one file, so member counts balance the chunks.
+2. A wildcard that cannot be listed (like a folder type) stays one item.
+3. The children of an object (CHILD_TYPES, such as CustomField) are written
+to the object's file, so an object and its children share a chunk.
+4. A profile or permission set holds only the grants for the components
+retrieved with it, so every chunk retrieves them, and their grants are
+merged as profile_merge does.
+5. Listing CustomObject for a wildcard also returns the standard objects,
+which the wildcard alone would not retrieve.
+
+Success Scenario:
+1. External actor invokes script from command line passing the manifest and
+retrieve target.
+2. Process reads the manifest, and lists the members of each wildcard type
+with listMetadata, three types per call.
+3. Process splits the members into chunks of at most sf_chunkSize members,
+placing the largest groups first into the lightest chunk.
+4. Process retrieves up to sf_jobs chunks at once over one session.
+5. As each chunk arrives, process unzips it into the retrieve target, except
+its package.xml and the files excluded by the component filter, and merges
+its profiles and permission sets into those of the earlier chunks.
+6. Process writes the merged profiles, permission sets and package.xml, and
+prints the tally.
+
+Alternate Scenario:
+(2a)
+1. Process drops the members excluded by the component filter
+(sf_componentFilter, see component_filter), so that they are not retrieved.
+(4a)
+1. A chunk fails, and process raises IOError with its error message.
+"""
+import argparse
+from math import ceil
+from multiprocessing.pool import ThreadPool
+from os import environ, makedirs, path
+from StringIO import StringIO
+from sys import exit
+from zipfile import ZipFile
+
+from lxml import etree
+
+from component_filter import load_filter
+from metadata_cache import cached_client, default_ttl
+from metadata_client import MetadataClient
+from poll_scheduler import default_initial_millis
+from profile_merge import MergeIndex
+from tools_io import write_bytes
+from tools_lxml import SF_URI, load_tree, save_tree, sforce_root, \
+    sub_element_text
+
+MANIFEST_NAME = 'package.xml'
+WILDCARD = '*'
+MAX_FILES = 10000
+LIST_QUERIES = 3
+# Types listed as children of CustomObject, as Object.Child members
+PARENT_TYPE = 'CustomObject'
+CHILD_TYPES = ['BusinessProcess', 'CompactLayout', 'CustomField', 'FieldSet',
+               'ListView', 'RecordType', 'SharingReason', 'ValidationRule',
+               'WebLink']
+# folder: type, for the documents whose grants are merged across chunks
+MERGED_FOLDERS = {'profiles': 'Profile', 'permissionsets': 'PermissionSet'}
+default_chunk_size = 5000
+default_jobs = 4
+default_api_version = '38.0'
+
+
+def read_manifest(root):
+    """Returns the (type, members) pairs and version of a package.xml root.
+
+    >>> root = etree.fromstring('<Package xmlns="%s"><types><members>*</members>'
+    ...     '<name>ApexClass</name></types><!-- <types/> --><version>38.0</version>'
+    ...     '</Package>' % SF_URI)
+    >>> read_manifest(root)
+    ([('ApexClass', ['*'])], '38.0')
+    """
+    ns = {'md': SF_URI}
+    types = [(types.findtext('md:name', namespaces=ns),
+              [member.text for member in types.findall('md:members', namespaces=ns)])
+             for types in root.findall('md:types', namespaces=ns)]
+    return (types, root.findtext('md:version', namespaces=ns))
+
+
+def expand_wildcards(client, types):
+    """Replaces each wildcard with the members listed in the org, keeping the
+    wildcard for types that cannot be listed. Note that listing CustomObject
+    also returns the standard objects, so they are retrieved as well."""
+    wild = [name for (name, members) in types if WILDCARD in members]
+    listed = {}
+    for start in range(0, len(wild), LIST_QUERIES):
+        queries = [(name, None) for name in wild[start:start + LIST_QUERIES]]
+        try:
+            for fields in client.list_metadata(queries):
+                listed.setdefault(fields['type'], set()).add(fields['fullName'])
+        except IOError as e:
+            print("Keeping wildcards for {types}: {error}".format(
+                types=', '.join(name for (name, folder) in queries), error=e))
+    expanded = []
+    for (name, members) in types:
+        if WILDCARD in members and name in listed:
+            members = sorted(set(members) - set([WILDCARD]) | listed[name])
+        expanded.append((name, members))
+    return expanded
+
+
+def plan_groups(types, chunk_size):
+    """Returns the (weight, [(type, members)]) groups that plan_chunks
+    places: each object with its children, and the other members in pieces
+    of chunk_size. A wildcard counts as a full chunk, and holds every object
+    and child if it is one of theirs.
+
+    >>> for group in plan_groups([('CustomObject', ['Account', 'Idea__c']),
+    ...         ('CustomField', ['Account.Tier__c', 'Case.Reason__c']),
+    ...         ('ApexClass', ['A', 'B', 'C'])], 2):
+    ...     print group
+    (2, [('CustomObject', ['Account']), ('CustomField', ['Account.Tier__c'])])
+    (1, [('CustomObject', ['Idea__c'])])
+    (1, [('CustomField', ['Case.Reason__c'])])
+    (2, [('ApexClass', ['A', 'B'])])
+    (1, [('ApexClass', ['C'])])
+    """
+    object_types = [(name, members) for (name, members) in types
+                    if name == PARENT_TYPE or name in CHILD_TYPES]
+    groups = []
+    if any(WILDCARD in members for (name, members) in object_types):
+        groups.append((chunk_size, object_types))
+    elif object_types:
+        bundles = {}
+        order = []
+        for (name, members) in object_types:
+            for member in members:
+                parent = member.split('.')[0]
+                if parent not in bundles:
+                    bundles[parent] = []
+                    order.append(parent)
+                bundle = bundles[parent]
+                if bundle and bundle[-1][0] == name:
+                    bundle[-1][1].append(member)
+                else:
+                    bundle.append((name, [member]))
+        for parent in order:
+            groups.append((sum(len(members) for (name, members)
+                               in bundles[parent]), bundles[parent]))
+    for (name, members) in types:
+        if name == PARENT_TYPE or name in CHILD_TYPES:
+            continue
+        if WILDCARD in members:
+            groups.append((chunk_size, [(name, [WILDCARD])]))
+            continue
+        for start in range(0, len(members), chunk_size):
+            piece = members[start:start + chunk_size]
+            groups.append((len(piece), [(name, piece)]))
+    return groups
+
+
+def plan_chunks(types, chunk_size=default_chunk_size):
+    """Splits the members into chunks of about chunk_size members, placing
+    the largest groups (see plan_groups) first into the lightest chunk.
+    Profiles and permission sets are added to every chunk, so that each
+    chunk returns their grants for its components.
+
+    >>> types = [('ApexClass', ['A', 'B', 'C', 'D', 'E']), ('ApexPage', ['P']),
+    ...          ('Report', ['*']), ('Flow', ['F1', 'F2'])]
+    >>> for chunk in plan_chunks(types, 3):
+    ...     print sorted(chunk.items())
+    [('ApexClass', ['A', 'B', 'C'])]
+    [('Report', ['*'])]
+    [('ApexClass', ['D', 'E']), ('ApexPage', ['P'])]
+    [('Flow', ['F1', 'F2'])]
+    >>> for chunk in plan_chunks([('CustomObject', ['Account', 'Case']),
+    ...         ('CustomField', ['Account.A__c', 'Account.B__c', 'Case.C__c']),
+    ...         ('Profile', ['Admin'])], 3):
+    ...     print sorted(chunk.items())
+    [('CustomField', ['Account.A__c', 'Account.B__c']), ('CustomObject', ['Account']), ('Profile', ['Admin'])]
+    [('CustomField', ['Case.C__c']), ('CustomObject', ['Case']), ('Profile', ['Admin'])]
+    """
+    chunk_size = min(chunk_size, MAX_FILES)
+    merged = [(name, members) for (name, members) in types
+              if name in MERGED_FOLDERS.values()]
+    groups = plan_groups([(name, members) for (name, members) in types
+                          if name not in MERGED_FOLDERS.values()], chunk_size)
+    total = sum(weight for (weight, pieces) in groups)
+    count = max(1, int(ceil(total / float(chunk_size))))
+    loads = [0] * count
+    chunks = [{} for index in range(count)]
+    for (weight, pieces) in sorted(groups, key=lambda group: -group[0]):
+        index = loads.index(min(loads))
+        if loads[index] and loads[index] + weight > MAX_FILES:
+            loads.append(0)
+            chunks.append({})
+            index = len(chunks) - 1
+        for (name, piece) in pieces:
+            chunks[index].setdefault(name, []).extend(piece)
+        loads[index] += weight
+    chunks = [chunk for chunk in chunks if chunk] or ([{}] if merged else [])
+    for chunk in chunks:
+        for (name, members) in merged:
+            chunk[name] = list(members)
+    return chunks
+
+
+def build_manifest(chunk, version):
+    """Renders a chunk of {type: members} as a package.xml root."""
+    sf_tag = '{%s}' % SF_URI
+    root = sforce_root('Package')
+    for name in sorted(chunk):
+        types = etree.SubElement(root, sf_tag + 'types')
+        for member in sorted(chunk[name]):
+            sub_element_text(types, sf_tag + 'members', member)
+        sub_element_text(types, sf_tag + 'name', name)
+    sub_element_text(root, sf_tag + 'version', version)
+    return root
+
+
+def merge_manifests(roots, version):
+    """Merges the members of several package.xml roots into one.
+
+    >>> from tools_lxml import print_tree
+    >>> roots = [build_manifest({'ApexClass': ['B'], 'Flow': ['F']}, '38.0'),
+    ...          build_manifest({'ApexClass': ['A']}, '38.0')]
+    >>> print_tree(merge_manifests(roots, '38.0'))
+    <?xml version='1.0' encoding='UTF-8'?>
+    <Package xmlns="http://soap.sforce.com/2006/04/metadata">
+      <types>
+        <members>A</members>
+        <members>B</members>
+        <name>ApexClass</name>
+      </types>
+      <types>
+        <members>F</members>
+        <name>Flow</name>
+      </types>
+      <version>38.0</version>
+    </Package>
+    <BLANKLINE>
+    """
+    merged = {}
+    for root in roots:
+        for (name, members) in read_manifest(root)[0]:
+            merged.setdefault(name, set()).update(members)
+    return build_manifest(merged, version)
+
+
+def merge_entry(merged, filename, data):
+    """Merges a profile or permission set entry of a chunk into the MergeIndex
+    kept for its path in merged, and returns True, or returns False for any
+    other entry."""
+    folder = filename.split('/')[0]
+    if folder not in MERGED_FOLDERS:
+        return False
+    if filename not in merged:
+        merged[filename] = MergeIndex(MERGED_FOLDERS[folder])
+    merged[filename].load(StringIO(data))
+    return True
+
+
+def unzip_chunk(zip_bytes, target, component_filter=None, merged=None):
+    """Unzips a retrieved chunk into the target, skipping the excluded
+    entries, and returns its package.xml root (or None) and the number of
+    files written. The files are written through tools_io, so that they are
+    journaled. If merged is given, profiles and permission sets are merged
+    into it (see merge_entry) rather than written."""
+    manifest = None
+    count = 0
+    zip_file = ZipFile(StringIO(zip_bytes))
+    for info in zip_file.infolist():
+        if info.filename.endswith('/'):
+            continue
+        if path.basename(info.filename) == MANIFEST_NAME:
+            manifest = etree.fromstring(zip_file.read(info))
+            continue
+        if component_filter is not None and \
+                component_filter.excludes_path(info.filename):
+            continue
+        if merged is not None and \
+                merge_entry(merged, info.filename, zip_file.read(info)):
+            continue
+        filename = path.join(target, *info.filename.split('/'))
+        folder = path.dirname(filename)
+        try:
+            makedirs(folder)
+        except OSError:
+            # another chunk may have made it
+            if not path.isdir(folder):
+                raise
+        write_bytes(filename, zip_file.read(info))
+        count += 1
+    return (manifest, count)
+
+
+def retrieve_all(client, packages, target, jobs=default_jobs,
+                 component_filter=None, overlay=False, **poll):
+    """Retrieves the package.xml roots concurrently, unzipping each into the
+    target as it arrives, and returns the retrieved package.xml roots and the
+    file count. The profiles and permission sets of the chunks are merged,
+    and written once every chunk has arrived. With overlay, they are laid
+    over the documents already in the target (see MergeIndex.overlay), which
+    keeps the grants of the components not retrieved.
+
+    >>> from base64 import b64encode
+    >>> from shutil import rmtree
+    >>> from tempfile import mkdtemp
+    >>> from metadata_client import StubServer
+    >>> def canned_zip(request):
+    ...     manifest = request.find('{%s}retrieveRequest/{%s}unpackaged' % (SF_URI, SF_URI))
+    ...     members = [member.text for member in manifest.iter('{%s}members' % SF_URI)]
+    ...     zip_bytes = StringIO()
+    ...     zip_file = ZipFile(zip_bytes, 'w')
+    ...     for member in members:
+    ...         zip_file.writestr('classes/%s.cls' % member, member)
+    ...     zip_file.writestr('profiles/Admin.profile', '<Profile xmlns="%s">'
+    ...         % SF_URI + ''.join('<classAccesses><apexClass>%s</apexClass>'
+    ...         '<enabled>true</enabled></classAccesses>' % member
+    ...         for member in members) + '</Profile>')
+    ...     zip_file.writestr(MANIFEST_NAME, etree.tostring(build_manifest(
+    ...         {'ApexClass': members}, '38.0')))
+    ...     zip_file.close()
+    ...     return [[('id', b64encode(zip_bytes.getvalue()))]]
+    >>> stub = StubServer({'retrieve': canned_zip,
+    ...     'checkRetrieveStatus': lambda request: [[('done', True),
+    ...         ('status', 'Succeeded'),
+    ...         ('zipFile', request.findtext('{%s}asyncProcessId' % SF_URI))]]})
+    >>> client = MetadataClient(stub.url, 'user', 'pass')
+    >>> target = mkdtemp()
+    >>> chunks = plan_chunks([('ApexClass', ['A', 'B', 'C'])], 2)
+    >>> (roots, count) = retrieve_all(client, [build_manifest(chunk, '38.0')
+    ...                                        for chunk in chunks], target)
+    >>> print count, read_manifest(merge_manifests(roots, '38.0'))[0]
+    4 [('ApexClass', ['A', 'B', 'C'])]
+    >>> print open(path.join(target, 'classes', 'C.cls')).read()
+    C
+    >>> print open(path.join(target, 'profiles', 'Admin.profile')).read().count(
+    ...     '<classAccesses>')
+    3
+    >>> from component_filter import ComponentFilter
+    >>> (roots, count) = retrieve_all(client, [build_manifest(chunk, '38.0')
+    ...                                        for chunk in chunks], mkdtemp(),
+    ...                               component_filter=ComponentFilter(['classes/B*']))
+    >>> print count
+    3
+    >>> (roots, count) = retrieve_all(client, [build_manifest(
+    ...     {'ApexClass': ['A']}, '38.0')], target, overlay=True)
+    >>> print open(path.join(target, 'profiles', 'Admin.profile')).read().count(
+    ...     '<classAccesses>')
+    3
+    >>> client.close(); stub.close(); rmtree(target)
+    """
+    roots = []
+    count = 0
+    merged = {}
+    for zip_bytes in retrieve_zips(client, packages, jobs, **poll):
+        (manifest, files) = unzip_chunk(zip_bytes, target, component_filter,
+                                        merged)
+        if manifest is not None:
+            roots.append(manifest)
+        count += files
+    for (name, index) in sorted(merged.items()):
+        filename = path.join(target, *name.split('/'))
+        if not path.isdir(path.dirname(filename)):
+            makedirs(path.dirname(filename))
+        if overlay and path.isfile(filename):
+            cached = MergeIndex(index.output_name)
+            cached.load(filename)
+            cached.overlay(index)
+            index = cached
+        index.write(filename)
+        count += 1
+    return (roots, count)
+
+
+def retrieve_zips(client, packages, jobs=default_jobs, **poll):
+    """Retrieves the package.xml roots concurrently, yielding the zip bytes
+    of each as it arrives."""
+    retrieve = lambda package: client.retrieve_wait(package, **poll)
+    pool = ThreadPool(max(1, min(jobs, len(packages))))
+    try:
+        for status in pool.imap_unordered(retrieve, packages):
+            if status.get('status') == 'Failed':
+                raise IOError('Retrieve {id} failed: {message}'.format(
+                    id=status.get('id'), message=status.get('errorMessage')))
+            yield status['zipFile']
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+
+def main(client, unpackaged, target, jobs=default_jobs,
+         chunk_size=default_chunk_size, component_filter=None, **poll):
+    """Retrieves the manifest in chunks into the target, leaving out the
+    components the filter excludes."""
+    (types, version) = read_manifest(load_tree(unpackaged).getroot())
+    version = version or client.api_version
+    component_filter = load_filter() if component_filter is None \
+        else component_filter
+    types = component_filter.filter_types(expand_wildcards(client, types))
+    packages = [build_manifest(chunk, version)
+                for chunk in plan_chunks(types, chunk_size)]
+    if not path.isdir(target):
+        makedirs(target)
+    (roots, count) = retrieve_all(client, packages, target, jobs,
+                                  component_filter, **poll)
+    (types, version) = read_manifest(merge_manifests(roots, version))
+    save_tree(build_manifest(dict(component_filter.filter_types(types)), version),
+              path.join(target, MANIFEST_NAME))
+    print("Retrieved {count} files in {chunks} chunks into {target}.".format(
+        count=count, chunks=len(packages), target=target))
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Retrieves a package manifest "
+                                                 "in chunks, several at a time.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-u', '--sf_unpackaged', help="The package.xml to "
+                                                      "retrieve.")
+    parser.add_argument('-t', '--sf_retrieveTarget', help="The folder to "
+                                                          "unzip into.")
+    parser.add_argument('-j', '--sf_jobs', type=int, help="The number of "
+                                                          "chunks to retrieve "
+                                                          "at once.")
+    parser.add_argument('-c', '--sf_chunkSize', type=int, help="The number of "
+                                                               "members per "
+                                                               "chunk.")
+    parser.add_argument('-f', '--sf_componentFilter', help="The rules file of "
+                                                           "components to "
+                                                           "leave out.")
+    return parser
+
+
+def __args_verify(serverurl, username, unpackaged, target):
+    if serverurl is None or username is None or unpackaged is None or \
+            target is None:
+        print("Requires sf_serverurl, sf_username, sf_password as system "
+              "properties, and sf_unpackaged, sf_retrieveTarget as parameters "
+              "or system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    sf_serverurl = environ.get('sf_serverurl')
+    sf_username = environ.get('sf_username')
+    sf_password = environ.get('sf_password')
+    sf_unpackaged = environ.get('sf_unpackaged')
+    sf_retrieveTarget = environ.get('sf_retrieveTarget')
+    sf_apiVersion = environ.get('sf_apiVersion', default_api_version)
+    sf_jobs = int(environ.get('sf_jobs', default_jobs))
+    sf_chunkSize = int(environ.get('sf_chunkSize', default_chunk_size))
+    sf_pollInitialMillis = int(environ.get('sf_pollInitialMillis',
+                                           default_initial_millis))
+    sf_pollWaitMillis = int(environ.get('sf_pollWaitMillis', 30000))
+    sf_maxPoll = int(environ.get('sf_maxPoll', 600))
+    sf_metadataCache = environ.get('sf_metadataCache')
+    sf_metadataCacheTtl = int(environ.get('sf_metadataCacheTtl', default_ttl))
+    sf_componentFilter = environ.get('sf_componentFilter')
+
+    args = __parser_config().parse_args()
+
+    sf_unpackaged = args.sf_unpackaged if args.sf_unpackaged is not None else sf_unpackaged
+    sf_retrieveTarget = args.sf_retrieveTarget if args.sf_retrieveTarget is not None \
+        else sf_retrieveTarget
+    sf_jobs = args.sf_jobs if args.sf_jobs is not None else sf_jobs
+    sf_chunkSize = args.sf_chunkSize if args.sf_chunkSize is not None else sf_chunkSize
+    sf_componentFilter = args.sf_componentFilter \
+        if args.sf_componentFilter is not None else sf_componentFilter
+    __args_verify(sf_serverurl, sf_username, sf_unpackaged, sf_retrieveTarget)
+
+    client = MetadataClient(sf_serverurl, sf_username, sf_password,
+                            api_version=sf_apiVersion, pool_size=sf_jobs)
+    if sf_metadataCache:
+        client = cached_client(client, sf_metadataCache, sf_metadataCacheTtl)
+    main(client, sf_unpackaged, sf_retrieveTarget, sf_jobs, sf_chunkSize,
+         load_filter(sf_componentFilter), initial_millis=sf_pollInitialMillis, max_millis=sf_pollWaitMillis,
+         timeout_millis=sf_pollWaitMillis * sf_maxPoll)
+    client.close()
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+"""Runs a list of the Python and shell build steps, starting each step as
+soon as the earlier steps it conflicts with have finished, so that steps
+touching different files run side by side.
+
+To call from the Python CLI (with metadata present):
+    % ./step_dag.py -d ~/git/sf-org -j 4 fieldsetsExtend listViewRemove zlabelsBuild
+
+To call from the Ant CLI: ant -Dhome={}
+    -Dsf_steps=fieldsetsExtend,listViewRemove,zlabelsBuild runSteps
+
+To run the embedded tests: python -m doctest -v step_dag.py
+"""
+"""
+Use Case for step_dag.py
+
+Motivation: Ant runs the steps of a target strictly in sequence through
+depends, though many steps change different files (zlabelsBuild and
+fixProfiles never touch the same document), and the build waits on each in
+turn.
+
+Stakeholders: Release Engineering
+
+Output: The output of each step, printed as a block when the step finishes,
+with its status and duration, and a tally of the elapsed and serial times.
+
+Prerequisite: Each step is declared in STEPS with the globs (relative to
+homedir) of the files it reads and the files it writes, and the source folder
+is homedir/src, as set by build_sf.properties.
+
+Assumptions:
+1. A step reads and writes only the files its globs match, so two steps that
+neither write what the other reads or writes can run in either order, or at
+once, with the same result.
+2. Two globs with wildcards conflict when either literal prefix contains the
+other, which may order some steps that need not be.
+
+Success Scenario:
+1. External actor invokes script from command line passing homedir and the
+steps in their serial order.
+2. Process adds an edge from each step to every later step it conflicts
+with, so that the graph keeps the serial order of conflicting steps.
+3. Process starts up to jobs steps at once, each as soon as the steps it
+depends on have succeeded, passing sf_step so that the change journal names
+the step.
+4. As each step finishes, process prints its output and duration.
+5. Process prints the tally.
+
+Alternate Scenario:
+(4a)
+1. A step fails, so process starts no more steps, waits for the running
+ones, and exits with an error.
+"""
+import argparse
+import re
+import subprocess
+from multiprocessing.pool import ThreadPool
+from os import environ, path
+from Queue import Queue
+from sys import exit
+from time import time
+
+from component_filter import glob_regex
+from tools_io import STEP_ENV
+
+tooldir = path.dirname(path.dirname(path.abspath(__file__)))
+default_jobs = 4
+WILDCARDS = re.compile(r'[*?]')
+
+
+class Step:
+    """A build step: the command to run (with {tooldir} replaced), the globs
+    of the files under homedir it reads and writes, and the exit statuses
+    that count as success."""
+
+    def __init__(self, name, command, reads=(), writes=(), ok_status=(0,)):
+        self.name = name
+        self.command = command
+        self.reads = list(reads)
+        self.writes = list(writes)
+        self.ok_status = ok_status
+
+    def args(self):
+        return [arg.format(tooldir=tooldir) for arg in self.command]
+
+
+# The steps of build-script.xml that run a script, by target name. The
+# inject scripts exit 1 when the manifest already holds their members.
+STEPS = dict((step.name, step) for step in [
+    Step('fixManifest', ['bash', '{tooldir}/sh/del_unpackaged_label'],
+         writes=['src/package.xml']),
+    Step('injectProfiles', ['bash', '{tooldir}/sh/add_admin_member'],
+         writes=['src/package.xml', 'src/tmp'], ok_status=(0, 1)),
+    Step('injectFlowDefinitions',
+         ['bash', '{tooldir}/sh/add_flowDefinition_member'],
+         reads=['src/flows/*'], writes=['src/package.xml', 'src/tmp'],
+         ok_status=(0, 1)),
+    Step('fixProfiles', ['bash', '{tooldir}/sh/del_profile_permset_members'],
+         writes=['src/profiles/*', 'src/permissionsets/*']),
+    Step('fixComponents', ['python', '{tooldir}/py/component_filter.py'],
+         writes=['src/**']),
+    Step('fieldsetsExtend', ['python', '{tooldir}/py/fieldsets_extend.py'],
+         writes=['src/objects/Account.object']),
+    Step('listViewRemove', ['python', '{tooldir}/py/listviews_remove.py'],
+         writes=['src/objects/Account.object', 'src/objects/Contact.object']),
+    Step('zlabelsBuild', ['python', '{tooldir}/py/zlabels_build.py'],
+         reads=['src/labels/CustomLabels.labels'],
+         writes=['src/classes/ZLabels.cls', 'src/classes/ZLabels.cls-meta.xml']),
+    Step('prefixSwap', ['python', '{tooldir}/py/prefix_swap.py'],
+         writes=['src/**']),
+    Step('versionForward', ['python', '{tooldir}/py/version_forward.py'],
+         reads=['opt/installedPackages/*'],
+         writes=['src/classes/**', 'src/components/**', 'src/pages/**',
+                 'src/triggers/**', 'src/email/**'])])
+
+
+def globs_overlap(left, right):
+    """Returns True if two globs may match the same path.
+
+    >>> globs_overlap('src/objects/Account.object', 'src/objects/*.object')
+    True
+    >>> globs_overlap('src/objects/Account.object', 'src/objects/Contact.object')
+    False
+    >>> globs_overlap('src/profiles/*', 'src/permissionsets/*')
+    False
+    >>> globs_overlap('src/**', 'src/classes/ZLabels.cls')
+    True
+    """
+    left_wild = WILDCARDS.search(left)
+    right_wild = WILDCARDS.search(right)
+    if not left_wild and not right_wild:
+        return left == right
+    if not right_wild:
+        return re.match(glob_regex(left) + r'\Z', right, re.DOTALL) is not None
+    if not left_wild:
+        return re.match(glob_regex(right) + r'\Z', left, re.DOTALL) is not None
+    left_prefix = left[:left_wild.start()]
+    right_prefix = right[:right_wild.start()]
+    return left_prefix.startswith(right_prefix) or \
+        right_prefix.startswith(left_prefix)
+
+
+def conflicts(earlier, later):
+    """Returns True if the order of two steps may change the result: one
+    writes a file that the other reads or writes."""
+    pairs = [(earlier.writes, later.reads + later.writes),
+             (later.writes, earlier.reads)]
+    return any(globs_overlap(written, touched) for (writes, touches) in pairs
+               for written in writes for touched in touches)
+
+
+def plan(steps):
+    """Returns {step name: names of the earlier steps it must follow} for the
+    steps in their serial order.
+
+    >>> for (name, after) in sorted(plan([STEPS[name] for name in
+    ...         ['fieldsetsExtend', 'listViewRemove', 'zlabelsBuild',
+    ...          'fixProfiles', 'fixComponents']]).items()):
+    ...     print name, after
+    fieldsetsExtend []
+    fixComponents ['fieldsetsExtend', 'listViewRemove', 'zlabelsBuild', 'fixProfiles']
+    fixProfiles []
+    listViewRemove ['fieldsetsExtend']
+    zlabelsBuild []
+    """
+    return dict((step.name, [earlier.name for earlier in steps[:index]
+                             if conflicts(earlier, step)])
+                for (index, step) in enumerate(steps))
+
+
+class StepRun:
+    """Runs a step in homedir, returning its name, status, duration and
+    output. A step that cannot be started returns the status -1, so that the
+    executor always hears back from it."""
+
+    def __init__(self, homedir):
+        self.homedir = homedir
+
+    def __call__(self, step):
+        start = time()
+        env = dict(environ)
+        env['homedir'] = self.homedir
+        env[STEP_ENV] = step.name
+        try:
+            process = subprocess.Popen(step.args(), cwd=self.homedir, env=env,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError as e:
+            return (step.name, -1, time() - start, str(e) + '\n')
+        output = process.communicate()[0]
+        return (step.name, process.returncode, time() - start, output)
+
+
+def run_steps(steps, homedir, jobs=default_jobs):
+    """Runs the steps, jobs at a time, each once the steps it must follow
+    have succeeded, and returns the names of the steps that failed.
+
+    >>> from tempfile import mkdtemp
+    >>> homedir = mkdtemp()
+    >>> def append(name, filename, seconds):
+    ...     return Step(name, ['python', '-c', 'import time; time.sleep(%s); '
+    ...         'open("%s", "a").write("%s ")' % (seconds, filename, name)],
+    ...         writes=[filename])
+    >>> steps = [append('first', 'a.txt', 0.1), append('second', 'b.txt', 0.8),
+    ...          append('third', 'a.txt', 0.1)]
+    >>> run_steps(steps, homedir) # doctest: +ELLIPSIS
+    first: ok in ...s
+    third: ok in ...s
+    second: ok in ...s
+    Ran 3 of 3 steps in ...s (...s serially), 0 failed.
+    []
+    >>> open(path.join(homedir, 'a.txt')).read().split()
+    ['first', 'third']
+    >>> steps = [Step('broken', ['python', '-c', 'exit(3)'], writes=['c.txt']),
+    ...          append('fourth', 'c.txt', 0)]
+    >>> run_steps(steps, homedir) # doctest: +ELLIPSIS
+    broken: failed (3) in ...s
+    Ran 0 of 2 steps in ...s (...s serially), 1 failed.
+    ['broken']
+    >>> run_steps([Step('missing', ['no-such-binary-zz'], writes=['d.txt']),
+    ...            Step('optional', ['python', '-c', 'exit(1)'], writes=['e.txt'],
+    ...                 ok_status=(0, 1))], homedir) # doctest: +ELLIPSIS
+    [Errno 2] No such file or directory
+    missing: failed (-1) in ...s
+    optional: ok in ...s
+    Ran 1 of 2 steps in ...s (...s serially), 1 failed.
+    ['missing']
+    """
+    after = plan(steps)
+    ok_status = dict((step.name, step.ok_status) for step in steps)
+    waiting = dict((step.name, set(after[step.name])) for step in steps)
+    pending = list(steps)
+    finished = Queue()
+    run = StepRun(homedir)
+    pool = ThreadPool(max(1, min(jobs, len(steps))))
+    failed = []
+    ran = 0
+    running = 0
+    serial = 0.0
+    start = time()
+    while pending or running:
+        if not failed:
+            for step in [step for step in pending if not waiting[step.name]]:
+                if running >= jobs:
+                    break
+                pending.remove(step)
+                pool.apply_async(run, (step,), callback=finished.put)
+                running += 1
+        if not running:
+            break
+        (name, status, seconds, output) = finished.get()
+        running -= 1
+        ran += 1
+        serial += seconds
+        if output:
+            print(output.rstrip('\n'))
+        if status in ok_status[name]:
+            print("{name}: ok in {seconds:.1f}s".format(name=name, seconds=seconds))
+            for names in waiting.values():
+                names.discard(name)
+        else:
+            failed.append(name)
+            print("{name}: failed ({status}) in {seconds:.1f}s".format(
+                name=name, status=status, seconds=seconds))
+    pool.close()
+    pool.join()
+    print("Ran {ran} of {count} steps in {elapsed:.1f}s ({serial:.1f}s serially), "
+          "{failed} failed.".format(ran=ran - len(failed), count=len(steps),
+                                    elapsed=time() - start, serial=serial,
+                                    failed=len(failed)))
+    return failed
+
+
+def main(homedir, names, jobs=default_jobs):
+    """Runs the named steps of STEPS in homedir."""
+    unknown = [name for name in names if name not in STEPS]
+    if unknown:
+        print("Unknown steps: {unknown}. Known steps: {known}.".format(
+            unknown=', '.join(unknown), known=', '.join(sorted(STEPS))))
+        return 1
+    return 1 if run_steps([STEPS[name] for name in names], homedir, jobs) else 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Runs build steps, side by "
+                                                 "side where they touch "
+                                                 "different files.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('sf_steps', nargs='*', help="The steps, in their serial "
+                                                    "order.")
+    parser.add_argument('-d', '--homedir', help="The folder holding the "
+                                                "metadata.")
+    parser.add_argument('-j', '--sf_jobs', type=int, help="The number of steps "
+                                                          "to run at once.")
+    return parser
+
+
+def __args_verify(homedir, steps):
+    if homedir is None or not steps:
+        print("Requires homedir, sf_steps as parameters or system properties.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    homedir = environ.get('homedir')
+    sf_steps = [name.strip() for name in environ.get('sf_steps', '').split(',')
+                if name.strip()]
+    sf_jobs = int(environ.get('sf_jobs', default_jobs))
+
+    args = __parser_config().parse_args()
+
+    homedir = args.homedir if args.homedir is not None else homedir
+    sf_steps = args.sf_steps if args.sf_steps else sf_steps
+    sf_jobs = args.sf_jobs if args.sf_jobs is not None else sf_jobs
+    __args_verify(homedir, sf_steps)
+
+    exit(main(path.abspath(homedir), sf_steps, sf_jobs))
@@ -2,8 +2,28 @@
 """Centralize IO utilities used by multiple modules.
 """
 
+import json
+import mmap
+import re
+from collections import OrderedDict
 from fnmatch import fnmatch
-from os import path, walk
+from hashlib import sha1
+from os import O_APPEND, O_CREAT, O_WRONLY, close, environ, fdopen, makedirs, \
+    open as os_open, path, remove, rename, walk, write
+from shutil import copymode
+from sys import argv
+from tempfile import mkstemp
+
+# Names the change journal file, and the step recorded against each change.
+# The journal is disabled while sf_journal is unset or empty.
+JOURNAL_ENV = 'sf_journal'
+STEP_ENV = 'sf_step'
+CREATE, MODIFY, DELETE = ('create', 'modify', 'delete')
+
+# Files larger than this are replaced in chunks of CHUNK_BYTES (see
+# stream_replace), so that memory does not grow with the file.
+STREAM_THRESHOLD = 8 * 1024 * 1024
+CHUNK_BYTES = 1024 * 1024
 
 def find_files(directory, pattern):
     """Yields filenames matching a pattern in a directory (generic). 
@@ -21,29 +41,340 @@ def find_files(directory, pattern):
                 yield filename
 
 
+def file_hash(filename):
+    """Returns the SHA-1 hex digest of a file, read in blocks.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> f = NamedTemporaryFile()
+    >>> f.write('abc'); f.flush()
+    >>> print file_hash(f.name)
+    a9993e364706816aba3e25717850c26c9cd0d89d
+    """
+    digest = sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def contains_any(filename, tokens):
+    """Returns True if the raw bytes of a file contain any of the tokens,
+    scanning a memory map of the file rather than reading it into a string.
+    Transforms use this to skip parsing documents that cannot change. An
+    empty file contains no tokens.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> f = NamedTemporaryFile()
+    >>> contains_any(f.name, ['<namespace>'])
+    False
+    >>> f.write('<namespace>Example</namespace>'); f.flush()
+    >>> contains_any(f.name, ['<listViews>', '<namespace>Example<'])
+    True
+    >>> contains_any(f.name, ['<namespace>Other<'])
+    False
+    """
+    with open(filename, 'rb') as f:
+        if path.getsize(filename) == 0:
+            return False
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return any(mapped.find(token) != -1 for token in tokens)
+        finally:
+            mapped.close()
+
+
+def content_hash(content):
+    """Returns the SHA-1 hex digest of a string, as file_hash would for a file
+    holding it.
+
+    >>> print content_hash('abc')
+    a9993e364706816aba3e25717850c26c9cd0d89d
+    """
+    return sha1(content).hexdigest()
+
+
+def existing_hash(filename):
+    """Returns the file_hash of a file, or None if there is no such file."""
+    return file_hash(filename) if path.isfile(filename) else None
+
+
+def journal_file():
+    """Returns the change journal named by sf_journal, or None if the journal
+    is disabled."""
+    return environ.get(JOURNAL_ENV) or None
+
+
+def journal_step():
+    """Names the step making a change: sf_step if set, or else the running
+    script without its extension."""
+    step = environ.get(STEP_ENV)
+    if not step:
+        step = path.splitext(path.basename(argv[0] if argv and argv[0] else ''))[0]
+    return step or 'python'
+
+
+def journal_record(filename, before, after, step=None, journal=None):
+    """Appends a change to the journal as a line of JSON holding the absolute
+    path, the operation, the hash of the file before and after (None where
+    the file is absent), and the step. The operation follows from the hashes.
+    Returns False, without touching any hash, while the journal is disabled.
+    Each line is written with a single append, so concurrent steps can share
+    a journal.
+
+    >>> from tempfile import mkdtemp
+    >>> journal = path.join(mkdtemp(), 'journal')
+    >>> journal_record('/org/src/a.cls', None, 'a1', 'test', journal)
+    True
+    >>> journal_record('/org/src/a.cls', 'a1', None, 'test', journal)
+    True
+    >>> [change['op'] for change in read_journal(journal)]
+    [u'create', u'delete']
+    """
+    journal = journal or journal_file()
+    if journal is None:
+        return False
+    if before is None:
+        operation = CREATE
+    elif after is None:
+        operation = DELETE
+    else:
+        operation = MODIFY
+    line = json.dumps(OrderedDict([('path', path.abspath(filename)),
+                                   ('op', operation), ('before', before),
+                                   ('after', after),
+                                   ('step', step or journal_step())]))
+    folder = path.dirname(path.abspath(journal))
+    if not path.isdir(folder):
+        makedirs(folder)
+    handle = os_open(journal, O_WRONLY | O_APPEND | O_CREAT, 0644)
+    try:
+        write(handle, line + '\n')
+    finally:
+        close(handle)
+    return True
+
+
+def read_journal(journal):
+    """Yields each change recorded in a journal, in order. A missing journal
+    holds no changes."""
+    if not path.isfile(journal):
+        return
+    with open(journal) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def journal_changes(journal):
+    """Collapses the journal to the net change of each path, in the order
+    the paths were first touched, as a map of path to a change holding the
+    first before hash, the last after hash and the steps involved. Paths
+    that end as they began are dropped.
+
+    >>> from tempfile import mkdtemp
+    >>> journal = path.join(mkdtemp(), 'journal')
+    >>> _ = journal_record('/org/src/a.cls', 'a1', 'a2', 'prefix_swap', journal)
+    >>> _ = journal_record('/org/src/a.cls', 'a2', 'a3', 'version_forward', journal)
+    >>> _ = journal_record('/org/src/b.cls', 'b1', 'b2', 'prefix_swap', journal)
+    >>> _ = journal_record('/org/src/b.cls', 'b2', 'b1', 'prefix_swap', journal)
+    >>> for (filename, change) in journal_changes(journal).items():
+    ...     steps = ','.join(change['steps'])
+    ...     print filename, change['op'], change['before'], change['after'], steps
+    /org/src/a.cls modify a1 a3 prefix_swap,version_forward
+    """
+    changes = OrderedDict()
+    for entry in read_journal(journal):
+        change = changes.get(entry['path'])
+        if change is None:
+            change = changes[entry['path']] = {'before': entry['before'],
+                                               'steps': []}
+        change['after'] = entry['after']
+        if entry['step'] not in change['steps']:
+            change['steps'].append(entry['step'])
+    for (filename, change) in changes.items():
+        if change['before'] == change['after']:
+            del changes[filename]
+        elif change['before'] is None:
+            change['op'] = CREATE
+        elif change['after'] is None:
+            change['op'] = DELETE
+        else:
+            change['op'] = MODIFY
+    return changes
+
+
+def journal_paths(journal, basedir):
+    """Lists the paths with a net change in the journal that lie under
+    basedir, relative to it, sorted.
+
+    >>> from tempfile import mkdtemp
+    >>> journal = path.join(mkdtemp(), 'journal')
+    >>> _ = journal_record('/org/src/a.cls', 'a1', 'a2', 'test', journal)
+    >>> _ = journal_record('/org/src/b.cls', 'b1', None, 'test', journal)
+    >>> _ = journal_record('/tmp/c.xml', None, 'c1', 'test', journal)
+    >>> journal_paths(journal, '/org')
+    [u'src/a.cls', u'src/b.cls']
+    """
+    prefix = path.join(path.abspath(basedir), '')
+    return sorted(filename[len(prefix):] for filename in journal_changes(journal)
+                  if filename.startswith(prefix))
+
+
+def write_bytes(filename, content):
+    """Writes content to a file unless it already holds the same bytes, and
+    journals the change. Returns True if the file was written.
+
+    >>> from tempfile import mkdtemp
+    >>> filename = path.join(mkdtemp(), 'example.txt')
+    >>> write_bytes(filename, 'abc'), write_bytes(filename, 'abc')
+    (True, False)
+    """
+    before = existing_hash(filename)
+    after = content_hash(content)
+    if before == after:
+        return False
+    with open(filename, 'wb') as f:
+        f.write(content)
+    journal_record(filename, before, after)
+    return True
+
+
+def remove_file(filename):
+    """Removes a file, and journals the change."""
+    before = existing_hash(filename) if journal_file() else None
+    remove(filename)
+    if before is not None:
+        journal_record(filename, before, None)
+
+
+def rename_file(source, target):
+    """Renames a file, and journals the change as removing the source and
+    creating the target."""
+    before = existing_hash(source) if journal_file() else None
+    rename(source, target)
+    if before is not None:
+        journal_record(source, before, None)
+        journal_record(target, None, before)
+
+
+def replacement_pattern(replacements):
+    """Compiles the keys of the replacements map into one regular expression
+    that tries the longest key first, so that where keys overlap the longest
+    key matching at a position wins. An empty key is rejected, as it would
+    match everywhere.
+
+    >>> replacement_pattern({'zX__': 'X__', 'X__': 'Y__'}).sub(
+    ...     lambda match: {'zX__': 'X__', 'X__': 'Y__'}[match.group()],
+    ...     'zX__A X__B')
+    'X__A Y__B'
+    >>> replacement_pattern({'': 'X'})
+    Traceback (most recent call last):
+    ValueError: An empty key cannot be replaced.
+    """
+    if '' in replacements:
+        raise ValueError("An empty key cannot be replaced.")
+    keys = sorted(replacements.keys(), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(key) for key in keys))
+
+
+def stream_replace(filename, replacements, chunk_bytes=CHUNK_BYTES):
+    """Applies the substitutions in the replacements map to the file in one
+    pass, reading chunk_bytes at a time. A match may span chunks: the last
+    bytes of each chunk, up to the length of the longest key, are carried
+    into the next. Where keys overlap, the longest key matching at a position
+    wins. The output goes to a temporary file that replaces the file only if
+    there was a match. The number of matches is returned.
+
+    >>> from tempfile import mkdtemp
+    >>> filename = path.join(mkdtemp(), 'bundle.js')
+    >>> text = 'zX__A zX.B <namespace>zX</namespace> zX__C' * 3
+    >>> open(filename, 'w').write(text)
+    >>> replacements = {'zX__': 'X__', 'zX.': 'X.', '<namespace>zX': '<namespace>X'}
+    >>> stream_replace(filename, replacements, chunk_bytes=5)
+    12
+    >>> open(filename).read() == text.replace('zX', 'X')
+    True
+    >>> stream_replace(filename, replacements, chunk_bytes=5)
+    0
+    """
+    pattern = replacement_pattern(replacements)
+    overlap = max(len(key) for key in replacements) - 1
+    hits = 0
+    (handle, temp) = mkstemp(dir=path.dirname(filename) or '.',
+                             prefix='.' + path.basename(filename))
+    try:
+        with open(filename, 'rb') as alpha:
+            with fdopen(handle, 'wb') as omega:
+                carry = ''
+                while True:
+                    chunk = alpha.read(chunk_bytes)
+                    buffer = carry + chunk
+                    # a match starting before limit cannot run past the buffer
+                    limit = len(buffer) if not chunk \
+                        else max(len(buffer) - overlap, 0)
+                    position = 0
+                    for match in pattern.finditer(buffer):
+                        if match.start() >= limit:
+                            break
+                        omega.write(buffer[position:match.start()])
+                        omega.write(replacements[match.group()])
+                        position = match.end()
+                        hits += 1
+                    if limit > position:
+                        omega.write(buffer[position:limit])
+                        position = limit
+                    carry = buffer[position:]
+                    if not chunk:
+                        break
+        if hits:
+            before = existing_hash(filename) if journal_file() else None
+            copymode(filename, temp)
+            rename(temp, filename)
+            if before is not None:
+                journal_record(filename, before, file_hash(filename))
+    finally:
+        if path.isfile(temp):
+            remove(temp)
+    return hits
+
+
 def replace(filename, replacements):
     """Applies any number of substitutions in the replacements map to the file
     referenced by filename. Any modified file is written back, and the
-    original file overwritten. The number of lines modified is returned.
+    original file overwritten. The number of matches is returned.
+    Files over STREAM_THRESHOLD are replaced with stream_replace, and both
+    make the same single pass, the longest key first.
+
+    >>> from tempfile import mkdtemp
+    >>> filename = path.join(mkdtemp(), 'bundle.js')
+    >>> open(filename, 'w').write('zX__A X__B')
+    >>> replace(filename, {'zX__': 'X__', 'X__': 'Y__'})
+    2
+    >>> open(filename).read()
+    'X__A Y__B'
     """
     zero = 0
+    if not replacements:
+        return zero
+    pattern = replacement_pattern(replacements)
     try:
+        if path.getsize(filename) > STREAM_THRESHOLD:
+            return stream_replace(filename, replacements)
         alpha = open(filename).read()
-    except IOError:
+    except (IOError, OSError):
         return zero
-    hits = 0
-    for key in replacements.keys():
-        count = alpha.count(key)
-        if count>0:
-            alpha = alpha.replace(key, replacements[key])
-            hits += count
+    (alpha, hits) = pattern.subn(lambda match: replacements[match.group()],
+                                 alpha)
     if hits>0:
+        before = existing_hash(filename) if journal_file() else None
         try:
             omega = open(filename, 'w')
             omega.write(alpha)
             omega.close()
         except IOError:
             return zero
+        if before is not None:
+            journal_record(filename, before, content_hash(alpha))
         return hits
     else:
         return zero
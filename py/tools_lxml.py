@@ -1,12 +1,30 @@
 #!/usr/bin/python
 """Centralize lxml utilities used by multiple nu modules.
 """
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from filecmp import cmp
+from os import chmod, fdopen, path, remove, rename, stat
+from shutil import copymode
+from tempfile import mkstemp
+
 from lxml import etree
 
+from tools_io import contains_any, content_hash, existing_hash, file_hash, \
+    journal_file, journal_record
+
 # Defines the Salesforce metadata namespace and metadata prefix
 SF_URI = 'http://soap.sforce.com/2006/04/metadata'
 SF_PREFIX = 'md'
 
+# Salesforce renders metadata with a double-quoted declaration, four-space
+# indentation, and quotes escaped in text content.
+SF_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SF_INDENT = '    '
+SF_ESCAPES = [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'),
+              ("'", '&apos;')]
+
 
 def namespace_declare(test_mode=False):
     """Returns None for test mode, or the SF namespace reference
@@ -30,17 +48,435 @@ def namespace_prepend(match_string, test_mode=False):
     """
     return match_string if test_mode else SF_PREFIX + ':' + match_string
 
+
+# Bounds the document cache by the bytes of the files it holds
+default_cache_bytes = 64 * 1024 * 1024
+
+# The document cache shared by the transforms in this process, if enabled
+document_cache = None
+
+my_parsers = threading.local()
+
+
+def xml_parser():
+    """Returns an XMLParser for the calling thread, created on first use and
+    reused after, since a parser may not be shared between threads."""
+    parser = getattr(my_parsers, 'parser', None)
+    if parser is None:
+        parser = my_parsers.parser = etree.XMLParser(remove_blank_text=True)
+    return parser
+
+
+def file_key(filename):
+    """Returns the modification time and size of a file, or None if there is
+    no such file."""
+    try:
+        status = stat(filename)
+    except OSError:
+        return None
+    return (status.st_mtime, status.st_size)
+
+
+class DocumentCache:
+    """Holds parsed documents by path, so that transforms running in one
+    process parse each file once. An entry is valid while the modification
+    time and size of the file are unchanged, and the least recently used
+    entries are evicted once the files held exceed max_bytes. Each load
+    returns a private copy, so callers may change the tree freely, and a
+    save writes through, so later loads see the saved tree without parsing.
+
+    >>> from tempfile import mkdtemp
+    >>> filename = path.join(mkdtemp(), 'Example.labels')
+    >>> save_tree(sforce_root('CustomLabels'), filename)
+    True
+    >>> cache = DocumentCache()
+    >>> first = cache.load(filename)
+    >>> (cache.misses, cache.hits)
+    (1, 0)
+    >>> first.getroot().append(etree.Element('labels'))
+    >>> len(cache.load(filename).getroot()), (cache.misses, cache.hits)
+    (0, (1, 1))
+    >>> cache.put(filename, first)
+    >>> len(cache.load(filename).getroot()), (cache.misses, cache.hits)
+    (1, (1, 2))
+    >>> small = DocumentCache(max_bytes=1)
+    >>> small.put(filename, first)
+    >>> len(small.entries)
+    0
+    """
+
+    def __init__(self, max_bytes=default_cache_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, filename):
+        """Returns a copy of the cached tree for a file, parsing the file
+        if the cached tree is missing or stale."""
+        filename = path.abspath(filename)
+        key = file_key(filename)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == key:
+                # move the entry to the most recently used end
+                del self.entries[filename]
+                self.entries[filename] = entry
+                self.hits += 1
+                return deepcopy(entry[1])
+        tree = etree.parse(filename, xml_parser())
+        self.misses += 1
+        if key is not None:
+            self.store(filename, key, deepcopy(tree))
+        return tree
+
+    def put(self, filename, root):
+        """Caches a copy of the tree just saved to a file."""
+        filename = path.abspath(filename)
+        key = file_key(filename)
+        if key is None:
+            return self.discard(filename)
+        if not hasattr(root, 'getroot'):
+            root = etree.ElementTree(root)
+        self.store(filename, key, deepcopy(root))
+
+    def store(self, filename, key, tree):
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.size -= entry[0][1]
+            if key[1] > self.max_bytes:
+                return
+            self.entries[filename] = (key, tree)
+            self.size += key[1]
+            while self.size > self.max_bytes:
+                (_, (old_key, _)) = self.entries.popitem(last=False)
+                self.size -= old_key[1]
+
+    def discard(self, filename):
+        """Drops any cached tree for a file."""
+        with self.lock:
+            entry = self.entries.pop(path.abspath(filename), None)
+            if entry is not None:
+                self.size -= entry[0][1]
+
+
+def enable_cache(max_bytes=default_cache_bytes):
+    """Shares a DocumentCache between load_tree and save_tree for the rest of
+    the process, as for a pipeline or watch mode, and returns it."""
+    global document_cache
+    document_cache = DocumentCache(max_bytes)
+    return document_cache
+
+
+def disable_cache():
+    global document_cache
+    document_cache = None
+
+
 def load_tree(filename):
-    """Loads an XML document as an etree."""
-    parser = etree.XMLParser(remove_blank_text=True)
-    return etree.parse(filename, parser)
-
-def save_tree(root, filename):
-    """Saves etree as XML document and raises IOError for any problem."""
-    f = open(filename, 'w')
-    f.write(etree.tostring(root, pretty_print=True, encoding='UTF-8',
-                         xml_declaration=True))
+    """Loads an XML document as an etree, from the document cache if it is
+    enabled."""
+    if document_cache is not None:
+        return document_cache.load(filename)
+    return etree.parse(filename, xml_parser())
+
+
+def load_tree_if(filename, tokens):
+    """Loads an XML document as an etree only if its raw bytes contain one of
+    the tokens (see tools_io.contains_any), and returns None otherwise, so
+    that documents a transform cannot change are never parsed.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> f = NamedTemporaryFile()
+    >>> f.write('<CustomObject><listViews/></CustomObject>'); f.flush()
+    >>> print load_tree_if(f.name, ['<fieldSets>'])
+    None
+    >>> print local_name(load_tree_if(f.name, ['<listViews']).getroot())
+    CustomObject
+    """
+    if not contains_any(filename, tokens):
+        return None
+    return load_tree(filename)
+
+
+def escape_text(text):
+    """Escapes text content the way Salesforce does, including quotes.
+
+    >>> print escape_text('<quote> & "you"')
+    &lt;quote&gt; &amp; &quot;you&quot;
+    """
+    for (char, entity) in SF_ESCAPES:
+        text = text.replace(char, entity)
+    return text
+
+
+def local_name(element):
+    """Returns the tag of an element without any namespace URI."""
+    return etree.QName(element).localname
+
+
+def qualified_name(name, nsmap):
+    """Renders a {uri}name as prefix:name using the given nsmap."""
+    qname = etree.QName(name)
+    if qname.namespace is None:
+        return qname.localname
+    for (prefix, uri) in nsmap.items():
+        if uri == qname.namespace and prefix is not None:
+            return prefix + ':' + qname.localname
+    return qname.localname
+
+
+def order_children(root):
+    """Sorts the children of root by tag, keeping repeated elements in their
+    original relative order, as Salesforce does for profiles and similar
+    documents. Comments and processing instructions keep their positions,
+    and the elements are sorted into the positions between them. The root is
+    modified in place and returned.
+
+    >>> root = sforce_root('Profile')
+    >>> x = sub_element_text(root, 'userLicense', 'Salesforce')
+    >>> x = sub_element_text(root, 'custom', 'true')
+    >>> print ' '.join(local_name(child) for child in order_children(root))
+    custom userLicense
+    >>> root = etree.fromstring('<a><!-- first --><c/><?pi x?><b/></a>')
+    >>> print etree.tostring(order_children(root))
+    <a><!-- first --><b/><?pi x?><c/></a>
+    """
+    children = list(root)
+    elements = iter(sorted((child for child in children
+                            if isinstance(child.tag, basestring)),
+                           key=local_name))
+    root[:] = [next(elements) if isinstance(child.tag, basestring) else child
+               for child in children]
+    return root
+
+
+def canonical_lines(element, depth, parent_nsmap):
+    """Yields the lines of an element rendered in the Salesforce style.
+    Salesforce documents hold no text between elements, so a tail that is
+    not whitespace raises ValueError rather than being dropped.
+
+    >>> root = etree.fromstring('<a><b/><!----><?pi x?></a>')
+    >>> for line in canonical_lines(root, 0, {}):
+    ...     print line
+    <a>
+        <b/>
+        <!---->
+        <?pi x?>
+    </a>
+    >>> list(canonical_lines(etree.fromstring('<a><b/>text</a>'), 0, {}))
+    Traceback (most recent call last):
+    ValueError: Mixed content after <b> cannot be rendered: 'text'
+    """
+    indent = SF_INDENT * depth
+    if element.tail is not None and element.tail.strip():
+        name = local_name(element) if isinstance(element.tag, basestring) \
+            else element.tag.__name__
+        raise ValueError("Mixed content after <%s> cannot be rendered: %r" %
+                         (name, element.tail))
+    if not isinstance(element.tag, basestring):
+        if element.tag is etree.Comment:
+            yield indent + '<!--' + (element.text or '') + '-->'
+        elif element.tag is etree.PI:
+            yield indent + '<?' + element.target + \
+                (' ' + element.text if element.text else '') + '?>'
+        return
+    nsmap = element.nsmap
+    name = qualified_name(element.tag, nsmap)
+    attributes = ''
+    # Salesforce lists attributes ahead of any namespace they introduce,
+    # as in <defaultValue xsi:nil="true" xmlns:xsi="..."/>
+    for (key, value) in element.attrib.items():
+        attributes += ' %s="%s"' % (qualified_name(key, nsmap),
+                                    escape_text(value))
+    for (prefix, uri) in sorted(nsmap.items(), key=lambda x: x[0] or ''):
+        if parent_nsmap.get(prefix) != uri:
+            declare = 'xmlns' if prefix is None else 'xmlns:' + prefix
+            attributes += ' %s="%s"' % (declare, escape_text(uri))
+    text = element.text
+    if len(element) == 0:
+        if text:
+            yield '%s<%s%s>%s</%s>' % (indent, name, attributes,
+                                       escape_text(text), name)
+        else:
+            yield '%s<%s%s/>' % (indent, name, attributes)
+        return
+    opening = indent + '<' + name + attributes + '>'
+    if text is not None and text.strip():
+        opening += escape_text(text)
+    yield opening
+    for child in element:
+        for line in canonical_lines(child, depth + 1, nsmap):
+            yield line
+    yield indent + '</' + name + '>'
+
+
+def canonical_bytes(root, order=False):
+    """Renders an element (or tree) as UTF-8 bytes matching the Salesforce
+    on-disk format byte for byte. If order is set, the children of the root
+    are first sorted by tag (see order_children). Comments and processing
+    instructions beside the root of a document are kept in place.
+
+    >>> root = sforce_root('CustomLabels')
+    >>> labels = etree.SubElement(root, 'labels')
+    >>> x = sub_element_text(labels, 'fullName', 'Quote')
+    >>> x = sub_element_text(labels, 'value', "Don't")
+    >>> print canonical_bytes(root),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <CustomLabels xmlns="http://soap.sforce.com/2006/04/metadata">
+        <labels>
+            <fullName>Quote</fullName>
+            <value>Don&apos;t</value>
+        </labels>
+    </CustomLabels>
+    >>> print canonical_bytes(etree.fromstring('<!--Generated--><a/><!--End-->')),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <!--Generated-->
+    <a/>
+    <!--End-->
+    """
+    if hasattr(root, 'getroot'):
+        root = root.getroot()
+    if order:
+        order_children(root)
+    siblings = [root]
+    if root.getparent() is None:
+        siblings = list(reversed(list(root.itersiblings(preceding=True)))) + \
+            siblings + list(root.itersiblings())
+    lines = (line for element in siblings
+             for line in canonical_lines(element, 0, {}))
+    content = u'\n'.join(unicode(line) for line in lines)
+    return SF_DECLARATION + content.encode('UTF-8') + '\n'
+
+
+def same_bytes(filename, content):
+    """Returns True if the file already holds exactly the given bytes."""
+    try:
+        if path.getsize(filename) != len(content):
+            return False
+        with open(filename, 'rb') as f:
+            return f.read() == content
+    except (IOError, OSError):
+        return False
+
+
+def save_tree(root, filename, order=False):
+    """Saves etree as XML document in the Salesforce format and raises
+    IOError for any problem. The file is not written when it already holds
+    the same bytes, so unchanged documents keep their timestamps and stay out
+    of git status. Returns True if the file was written, and journals the
+    change (see tools_io.journal_record).
+    """
+    content = canonical_bytes(root, order)
+    if same_bytes(filename, content):
+        return False
+    before = existing_hash(filename) if journal_file() else None
+    f = open(filename, 'wb')
+    f.write(content)
     f.close()
+    journal_record(filename, before, content_hash(content))
+    if document_cache is not None:
+        document_cache.put(filename, root)
+    return True
+
+
+class StreamWriter:
+    """Writes a Salesforce metadata document one element at a time, on top of
+    etree.xmlfile, so that peak memory is bounded by the largest element
+    rather than the document. The output is byte for byte what save_tree
+    would render for the same elements. The document is written to a
+    temporary file that replaces filename on close, unless the bytes are
+    unchanged, in which case the original file is left untouched.
+
+    >>> from tempfile import mkdtemp
+    >>> filename = path.join(mkdtemp(), 'Example.profile')
+    >>> with StreamWriter(filename, 'Profile') as writer:
+    ...     for name in ['Alpha', 'Beta']:
+    ...         access = etree.Element('classAccesses')
+    ...         x = sub_element_text(access, 'apexClass', name)
+    ...         x = sub_element_text(access, 'enabled', 'true')
+    ...         writer.write(access)
+    >>> print open(filename).read(),
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Profile xmlns="http://soap.sforce.com/2006/04/metadata">
+        <classAccesses>
+            <apexClass>Alpha</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+        <classAccesses>
+            <apexClass>Beta</apexClass>
+            <enabled>true</enabled>
+        </classAccesses>
+    </Profile>
+    >>> writer.written
+    True
+    """
+
+    def __init__(self, filename, root_name):
+        self.filename = filename
+        self.root_name = root_name
+        self.count = 0
+        self.written = False
+        self.my_file = None
+        self.my_temp = None
+        self.my_xmlfile = None
+        self.my_writer = None
+        self.my_root = None
+
+    def __enter__(self):
+        (handle, self.my_temp) = mkstemp(dir=path.dirname(self.filename) or '.',
+                                         prefix='.' + path.basename(self.filename))
+        self.my_file = fdopen(handle, 'wb')
+        self.my_file.write(SF_DECLARATION)
+        self.my_xmlfile = etree.xmlfile(self.my_file, encoding='UTF-8',
+                                        buffered=False)
+        self.my_writer = self.my_xmlfile.__enter__()
+        return self
+
+    def write(self, element):
+        """Appends an element to the document as a child of the root."""
+        if self.my_root is None:
+            # Opening the root is deferred so that an empty document can be
+            # rendered as a self-closing tag, as save_tree does.
+            self.my_root = self.my_writer.element('{%s}%s' % (SF_URI, self.root_name),
+                                                  nsmap={None: SF_URI})
+            self.my_root.__enter__()
+        lines = canonical_lines(element, 1, {None: SF_URI})
+        content = u'\n' + u'\n'.join(unicode(line) for line in lines)
+        self.my_file.write(content.encode('UTF-8'))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.my_root is not None:
+            self.my_file.write('\n')
+            self.my_root.__exit__(exc_type, exc_value, traceback)
+        else:
+            self.my_writer.write(sforce_root(self.root_name))
+        self.my_xmlfile.__exit__(exc_type, exc_value, traceback)
+        self.my_file.write('\n')
+        self.my_file.close()
+        if exc_type is not None or (path.isfile(self.filename) and
+                                    cmp(self.my_temp, self.filename, shallow=False)):
+            remove(self.my_temp)
+        else:
+            before = None
+            if path.isfile(self.filename):
+                copymode(self.filename, self.my_temp)
+                if journal_file():
+                    before = file_hash(self.filename)
+            else:
+                chmod(self.my_temp, 0644)
+            after = file_hash(self.my_temp) if journal_file() else None
+            rename(self.my_temp, self.filename)
+            journal_record(self.filename, before, after)
+            if document_cache is not None:
+                document_cache.discard(self.filename)
+            self.written = True
+        return False
+
 
 def print_tree(root):
     """Renders an XML document with indentation and an XML declaration
@@ -5,7 +5,7 @@
 from glob import glob
 from os import path
 from re import match, search, sub, IGNORECASE
-from tools_lxml import namespace_declare, load_tree, save_tree
+from tools_lxml import namespace_declare, load_tree_if, save_tree
 
 
 class Namespacer:
@@ -30,9 +30,13 @@ class Namespacer:
 
     def process(self, obj_type, fields, operation):
         """Applies a namespacing operation to the specified fields of a specified metadata object type.
-        Operations include dot_namespacer and underscore_namespacer."""
+        Operations include dot_namespacer and underscore_namespacer. Records that
+        name none of the fields are not parsed."""
+        tokens = ['<field>' + field + '</field>' for field in fields]
         for filename in glob(path.join(self.sourcedir, "customMetadata/" + obj_type + ".*.md")):
-            root = load_tree(filename)
+            root = load_tree_if(filename, tokens)
+            if root is None:
+                continue
 
             for field in fields:
                 element = self.get_field_element(root, field)
@@ -75,7 +75,12 @@ from sys import exit
 from lxml import etree
 
 from tools_io import find_files
-from tools_lxml import print_tree, sforce_root, namespace_declare, namespace_prepend
+from tools_lxml import load_tree, load_tree_if, print_tree, save_tree, \
+    sforce_root, namespace_declare, namespace_prepend
+
+# The source folders holding metadata files with packageVersions
+VERSION_FOLDERS = ['classes', 'components', 'pages', 'triggers', 'email']
+META_PATTERN = '*.*-meta.xml'
 
 
 def example_installed_package():
@@ -192,38 +197,74 @@ def modify_version(root, prefix, major_number, minor_number, test_mode=False):
 
 
 def write_metadata(filename, root):
-    with open(filename, 'w') as text_file:
-        text_file.write(etree.tostring(root, pretty_print=True,
-                                       encoding='UTF-8', xml_declaration=True))
-        text_file.close()
+    """Writes the metadata document in the Salesforce format, skipping the
+    write if the file is unchanged. Returns True if the file was written."""
+    return save_tree(root, filename)
+
+
+def namespace_token(prefix):
+    """Returns the bytes a metadata file holds if it references the package
+    with the prefix.
+
+    >>> namespace_token('Example')
+    '<namespace>Example</namespace>'
+    """
+    return '<namespace>' + prefix + '</namespace>'
+
+
+def conform_file(filename, prefix, major_number, minor_number):
+    """Updates one metadata file to the installed version for the package
+    corresponding to the prefix. Returns True if the file was written. Files
+    that do not name the prefix as a namespace are not parsed."""
+    tree = load_tree_if(filename, [namespace_token(prefix)])
+    if tree is None:
+        return False
+    root = modify_version(tree.getroot(), prefix, major_number, minor_number)
+    return root is not None and write_metadata(filename, root)
 
 
 def conform_metadata(prefix, sourcedir, sourcepattern, major_number, minor_number):
     """Updates Apex class metadata files to the installed version for the package corresponding to the prefix. """
     count = 0
     for filename in find_files(sourcedir, sourcepattern):
-        tree = etree.parse(filename)
-        root = modify_version(tree.getroot(), prefix, major_number, minor_number)
-        if root is not None:
-            write_metadata(filename, root)
+        if conform_file(filename, prefix, major_number, minor_number):
             count += 1
 
     return count
 
 
+def installed_version(prefixdir):
+    """Returns the major and minor version of an InstalledPackage document,
+    or None if the package is not installed (retrieved)."""
+    try:
+        tree = load_tree(prefixdir)
+    except IOError:
+        return None
+    return get_version(tree.getroot())
+
+
+def installed_path(homedir, prefix):
+    """Names the InstalledPackage document retrieved for a prefix."""
+    return path.join(homedir, 'opt/installedPackages', prefix + '.installedPackage')
+
+
+def source_folders(homedir):
+    """Lists the source folders holding packageVersions references."""
+    return [path.join(homedir, 'src', folder) for folder in VERSION_FOLDERS]
+
+
 def update_package_version(prefix, prefixdir, sourcedirs,
                            sourcepattern):
     """Loops through classes and sets version reference for a given prefix.
     Requires - opt/installedPackages retrieved from org. Returns a message
     if package not installed (does not raise exception).
     """
-    try:
-        tree = etree.parse(prefixdir)
-    except IOError:
+    version = installed_version(prefixdir)
+    if version is None:
         # Info error only. Continue for any other prefixes.
         return "{prefix} is not installed to {prefixdir}.".format(prefix=prefix,prefixdir=prefixdir)
 
-    (major_number, minor_number) = get_version(tree.getroot())
+    (major_number, minor_number) = version
 
     for sourcedir in sourcedirs:
         count = conform_metadata(prefix, sourcedir, sourcepattern, major_number, minor_number)
@@ -240,11 +281,9 @@ def main(homedir, prefix_list):
   """
     prefixes = [x.strip() for x in prefix_list.split(',')]
     for px in prefixes:
-        prefixdir = path.join(homedir, 'opt/installedPackages', px+'.installedPackage')
-        sourcedirs = [path.join(homedir, 'src/classes'),path.join(homedir, 'src/components'),
-                      path.join(homedir, 'src/pages'), path.join(homedir, 'src/triggers'),
-                      path.join(homedir, 'src/email')]
-        log = update_package_version(px, prefixdir, sourcedirs, '*.*-meta.xml')
+        prefixdir = installed_path(homedir, px)
+        sourcedirs = source_folders(homedir)
+        log = update_package_version(px, prefixdir, sourcedirs, META_PATTERN)
         print(log)
 
 
@@ -0,0 +1,482 @@
+#!/usr/bin/python
+"""Watches the metadata in homedir, and reapplies the transforms relevant to
+each file as it changes: prefixSwap to any source, versionForward to the
+-meta.xml files, and zlabelsBuild to the CustomLabels. Bursts of edits are
+debounced into one batch, and the files written by the transforms are not
+taken for edits.
+
+To call from the Python CLI (with metadata present):
+    % ./watch.py -d ~/git/sf-org -s PREFIX1,PREFIX2 -x zPREFIX,PREFIX
+
+To call from the Ant CLI: ant -Dhome={} -Dsf_prefix_list=PREFIX1,PREFIX2 watch
+
+To run the embedded tests: python -m doctest -v watch.py
+"""
+"""
+Use Case for watch.py
+
+Motivation: Developers working in a task org run prefixSwap, versionForward
+and zlabelsBuild by hand after each edit, and each run walks the whole src
+folder, so an edit takes tens of seconds to be ready.
+
+Stakeholders: Developers
+
+Output: The changed files are transformed in place, and each batch is
+printed with the passes applied and the time taken.
+
+Prerequisite: The metadata is checked out to homedir. For versionForward,
+the installed packages are retrieved to opt/installedPackages (see the
+retrieveInstalledPackages target).
+
+Assumptions:
+1. The transforms give the same result applied to one changed file as to
+the whole folder.
+2. A changed InstalledPackage document needs every source conformed again.
+3. A file that a transform writes is not an edit, unless it changes again.
+
+Success Scenario:
+1. External actor invokes script from command line passing homedir, and
+optionally the prefix list, the prefix swap and the API version.
+2. Process loads the transforms and the installed versions once, enables
+the document cache, and watches the src and opt folders with inotify.
+3. Process waits for a change, then collects changes until none arrives for
+the debounce interval.
+4. Process applies the passes relevant to each changed file, in the order
+prefixSwap, versionForward, zlabelsBuild.
+5. Process notes the files the passes wrote (from a private change journal),
+so that their events are ignored, and forwards them to sf_journal if set.
+6. Process prints the batch, and repeats from step 3 until interrupted.
+
+Alternate Scenario:
+(2a)
+1. inotify is not available (as on macOS), and process polls the folders
+for changed modification times instead.
+(4a)
+1. An InstalledPackage document changed, and process reloads the version
+and conforms every source for that prefix.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import struct
+from errno import EINTR
+from os import close, environ, path, read, remove, stat, walk
+from select import error as select_error, select
+from sys import exit
+from tempfile import mkstemp
+from time import sleep, time
+
+import version_forward
+import zlabels_build
+from prefix_swap import prefix_replacements, rename_object, swap_file
+from tools_io import JOURNAL_ENV, STEP_ENV, existing_hash, journal_record, \
+    read_journal, replace
+from tools_lxml import enable_cache
+
+WATCHED_FOLDERS = ('src', 'opt')
+LABELS_PATH = 'src/labels/CustomLabels.labels'
+INSTALLED_FOLDER = 'opt/installedPackages/'
+INSTALLED_SUFFIX = '.installedPackage'
+META_SUFFIX = '-meta.xml'
+default_debounce_millis = 150
+default_poll_millis = 500
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def tree_files(roots):
+    """Yields every file under the roots."""
+    for root in roots:
+        for (folder, folders, names) in walk(root):
+            for name in names:
+                yield path.join(folder, name)
+
+
+class InotifyWatcher:
+    """Reports the files changed under the roots using inotify, watching
+    each folder (and any folder created later) for closed writes, moves,
+    creations and deletions. Raises OSError where inotify is unavailable."""
+
+    def __init__(self, roots):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError("inotify is not available.")
+        self.libc = libc
+        self.roots = roots
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed.")
+        self.folders = {}
+        for root in roots:
+            self.add_tree(root)
+
+    def add_tree(self, root):
+        """Watches a folder and its subfolders, and returns the files already
+        in them."""
+        found = []
+        for (folder, folders, names) in walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, folder, WATCH_MASK)
+            if wd >= 0:
+                self.folders[wd] = folder
+            found.extend(path.join(folder, name) for name in names)
+        return found
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds (or indefinitely, for None) for events,
+        and returns the set of paths changed."""
+        try:
+            (ready, _, _) = select([self.fd], [], [], timeout)
+        except select_error as e:
+            if e.args[0] == EINTR:
+                return set()
+            raise
+        if not ready:
+            return set()
+        data = read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed.update(tree_files(self.roots))
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            filename = path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self.add_tree(filename))
+            elif not mask & IN_CREATE:
+                # a created file is reported once its write is closed
+                changed.add(filename)
+        return changed
+
+    def close(self):
+        close(self.fd)
+
+
+class PollingWatcher:
+    """Reports the files changed under the roots by comparing the modification
+    time and size of each file every poll interval.
+
+    >>> from tempfile import mkdtemp
+    >>> root = mkdtemp()
+    >>> watcher = PollingWatcher([root], 0.01)
+    >>> open(path.join(root, 'A.cls'), 'w').write('v1')
+    >>> [path.basename(filename) for filename in watcher.read(0)]
+    ['A.cls']
+    >>> watcher.read(0)
+    set([])
+    """
+
+    def __init__(self, roots, interval=default_poll_millis / 1000.0):
+        self.roots = roots
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self):
+        files = {}
+        for filename in tree_files(self.roots):
+            try:
+                status = stat(filename)
+            except OSError:
+                continue
+            files[filename] = (status.st_mtime, status.st_size)
+        return files
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds (or indefinitely, for None) for a scan
+        to find changes, and returns the set of paths changed."""
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            files = self.scan()
+            changed = set(filename for (filename, status) in files.items()
+                          if self.files.get(filename) != status)
+            changed.update(set(self.files) - set(files))
+            self.files = files
+            if changed or (deadline is not None and time() >= deadline):
+                return changed
+            wait = self.interval if deadline is None \
+                else min(self.interval, max(deadline - time(), 0))
+            sleep(wait)
+
+    def close(self):
+        pass
+
+
+def open_watcher(roots, poll_millis=default_poll_millis):
+    """Returns an InotifyWatcher, or a PollingWatcher where inotify is not
+    available."""
+    try:
+        return InotifyWatcher(roots)
+    except (OSError, AttributeError):
+        return PollingWatcher(roots, poll_millis / 1000.0)
+
+
+class Watch:
+    """Applies the transforms relevant to batches of changed files. The
+    installed versions are loaded once, and reloaded as they change.
+
+    >>> from tempfile import mkdtemp
+    >>> from shutil import rmtree
+    >>> from os import makedirs
+    >>> homedir = mkdtemp()
+    >>> for folder in ['src/classes', 'src/labels', 'opt/installedPackages']:
+    ...     makedirs(path.join(homedir, folder))
+    >>> root = version_forward.example_installed_package()
+    >>> _ = version_forward.save_tree(root, path.join(homedir,
+    ...     'opt/installedPackages/Example.installedPackage'))
+    >>> meta = path.join(homedir, 'src/classes/A.cls-meta.xml')
+    >>> _ = version_forward.save_tree(version_forward.example_apex_class(), meta)
+    >>> _ = replace(meta, {'<majorNumber>1<': '<majorNumber>0<'})
+    >>> watch = Watch(homedir, 'Example', 'zX,X')
+    >>> print watch.apply([meta]) # doctest: +ELLIPSIS
+    prefixSwap, versionForward on 1 changed files in ... ms.
+    >>> print open(meta).read() # doctest: +ELLIPSIS
+    <?xml version="1.0" encoding="UTF-8"?>
+    ...
+            <majorNumber>1</majorNumber>
+            <minorNumber>2</minorNumber>
+    ...
+    >>> watch.apply([meta])
+    >>> labels = path.join(homedir, LABELS_PATH)
+    >>> open(labels, 'w').write('<?xml version="1.0" encoding="UTF-8"?>'
+    ...     '<CustomLabels xmlns="http://soap.sforce.com/2006/04/metadata">'
+    ...     '<labels><fullName>zX__Hello</fullName></labels></CustomLabels>')
+    >>> print watch.apply([labels]) # doctest: +ELLIPSIS
+    prefixSwap, zlabelsBuild on 1 changed files in ... ms.
+    >>> 'X__Hello' in open(path.join(homedir, 'src/classes/ZLabels.cls')).read()
+    True
+    >>> watch.close()
+    >>> rmtree(homedir)
+    """
+
+    def __init__(self, homedir, prefix_list=None, prefix_swap=None,
+                 api_version=None):
+        self.homedir = path.abspath(homedir)
+        self.api_version = api_version
+        self.prefixes = [x.strip() for x in (prefix_list or '').split(',')
+                         if x.strip()]
+        self.swap = None
+        if prefix_swap:
+            (p1, p2) = [x.strip() for x in prefix_swap.split(',')]
+            self.swap = (p1, p2, prefix_replacements(p1, p2))
+        self.versions = dict((prefix, version_forward.installed_version(
+            version_forward.installed_path(self.homedir, prefix)))
+            for prefix in self.prefixes)
+        (handle, self.journal) = mkstemp(prefix='.watch', suffix='.journal')
+        close(handle)
+        self.written = {}
+
+    def relpath(self, filename):
+        return path.relpath(filename, self.homedir).replace(path.sep, '/')
+
+    def own_write(self, filename):
+        """Returns True if the file is as a pass last wrote it."""
+        expected = self.written.pop(filename, None)
+        return expected is not None and existing_hash(filename) == expected
+
+    def versioned(self, relpath):
+        return relpath.endswith(META_SUFFIX) and any(
+            relpath.startswith('src/' + folder + '/')
+            for folder in version_forward.VERSION_FOLDERS)
+
+    def prefix_swap(self, filenames):
+        (p1, p2, replacements) = self.swap
+        swapped = []
+        for filename in filenames:
+            if self.relpath(filename).startswith('src/objects/'):
+                filename = rename_object(filename, p1, p2) or filename
+            swap_file(filename, replacements)
+            swapped.append(filename)
+        return swapped
+
+    def version_forward(self, filenames):
+        for filename in filenames:
+            for (prefix, version) in self.versions.items():
+                if version is not None:
+                    version_forward.conform_file(filename, prefix, *version)
+
+    def reload_versions(self, prefixes):
+        for prefix in prefixes:
+            prefixdir = version_forward.installed_path(self.homedir, prefix)
+            self.versions[prefix] = version_forward.installed_version(prefixdir)
+            print(version_forward.update_package_version(
+                prefix, prefixdir, version_forward.source_folders(self.homedir),
+                version_forward.META_PATTERN))
+
+    def run_pass(self, name, function, *args):
+        environ[STEP_ENV] = name
+        return function(*args)
+
+    def passes(self, filenames):
+        """Runs the passes relevant to the files, and returns their names."""
+        applied = []
+        sources = [filename for filename in filenames
+                   if self.relpath(filename).startswith('src/')]
+        if self.swap and sources:
+            sources = self.run_pass('prefixSwap', self.prefix_swap, sources)
+            applied.append('prefixSwap')
+        installed = [path.basename(relpath)[:-len(INSTALLED_SUFFIX)]
+                     for relpath in map(self.relpath, filenames)
+                     if relpath.startswith(INSTALLED_FOLDER)
+                     and relpath.endswith(INSTALLED_SUFFIX)]
+        installed = [prefix for prefix in installed if prefix in self.versions]
+        if installed:
+            self.run_pass('versionForward', self.reload_versions, installed)
+        metas = [filename for filename in sources
+                 if self.versioned(self.relpath(filename))]
+        if installed or (metas and any(self.versions.values())):
+            if metas:
+                self.run_pass('versionForward', self.version_forward, metas)
+            applied.append('versionForward')
+        if LABELS_PATH in map(self.relpath, sources):
+            self.run_pass('zlabelsBuild', zlabels_build.main, self.homedir,
+                          self.api_version)
+            applied.append('zlabelsBuild')
+        return applied
+
+    def apply(self, filenames):
+        """Applies the passes to a batch of changed files, skipping the files
+        the passes wrote themselves, and returns a summary (or None if there
+        was nothing to do)."""
+        start = time()
+        filenames = [path.abspath(filename) for filename in sorted(filenames)]
+        filenames = [filename for filename in filenames
+                     if path.isfile(filename) and not self.own_write(filename)]
+        if not filenames:
+            return None
+        forward = environ.get(JOURNAL_ENV)
+        step = environ.get(STEP_ENV)
+        environ[JOURNAL_ENV] = self.journal
+        try:
+            applied = self.passes(filenames)
+        finally:
+            restore(JOURNAL_ENV, forward)
+            restore(STEP_ENV, step)
+        for change in read_journal(self.journal):
+            self.written[change['path']] = change['after']
+            if forward:
+                journal_record(change['path'], change['before'], change['after'],
+                               change['step'], forward)
+        open(self.journal, 'w').close()
+        if not applied:
+            return None
+        return "{passes} on {count} changed files in {millis} ms.".format(
+            passes=', '.join(applied), count=len(filenames),
+            millis=int((time() - start) * 1000))
+
+    def run(self, watcher, debounce_millis=default_debounce_millis):
+        """Applies the passes to each debounced batch of changes reported by
+        the watcher, until interrupted."""
+        while True:
+            changed = watcher.read()
+            while True:
+                more = watcher.read(debounce_millis / 1000.0)
+                if not more:
+                    break
+                changed.update(more)
+            summary = self.apply(changed)
+            if summary:
+                print(summary)
+
+    def close(self):
+        if path.isfile(self.journal):
+            remove(self.journal)
+
+
+def restore(key, value):
+    """Restores an environment variable to a prior value, or unsets it."""
+    if value is None:
+        environ.pop(key, None)
+    else:
+        environ[key] = value
+
+
+def main(homedir, prefix_list=None, prefix_swap=None, api_version=None,
+         debounce_millis=default_debounce_millis, poll_millis=default_poll_millis):
+    """Watches homedir until interrupted."""
+    roots = [path.join(homedir, folder) for folder in WATCHED_FOLDERS
+             if path.isdir(path.join(homedir, folder))]
+    enable_cache()
+    watch = Watch(homedir, prefix_list, prefix_swap, api_version)
+    watcher = open_watcher(roots, poll_millis)
+    print("Watching {roots} with {watcher}. Press Ctrl-C to stop.".format(
+        roots=', '.join(roots), watcher=watcher.__class__.__name__))
+    try:
+        watch.run(watcher, debounce_millis)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        watch.close()
+    return 0
+
+
+def __parser_config():
+    parser = argparse.ArgumentParser(description="Reapplies the transforms "
+                                                 "relevant to each metadata "
+                                                 "file as it changes.",
+                                     epilog="The parameters may also be passed "
+                                            "as environment variables.")
+    parser.add_argument('-d', '--homedir', help="The folder holding the "
+                                                "Salesforce metadata.")
+    parser.add_argument('-s', '--sf_prefix_list', help="The managed packages "
+                                                       "to conform versions to.")
+    parser.add_argument('-x', '--sf_prefix_swap', help="The prefixes to swap, "
+                                                       "as X1,X2.")
+    parser.add_argument('-v', '--sf_apiVersion', help="The API version for the "
+                                                      "ZLabels metadata.")
+    parser.add_argument('--debounce', type=int, default=default_debounce_millis,
+                        help="Milliseconds without changes that end a batch.")
+    parser.add_argument('--poll', type=int, default=default_poll_millis,
+                        help="Milliseconds between scans without inotify.")
+    return parser
+
+
+def __args_verify(homedir):
+    if homedir is None:
+        print("Requires homedir as a parameter or system property.")
+        exit(1)
+    if not path.exists(homedir):
+        print("The homedir does not exist: {}".format(homedir))
+        exit(1)
+
+
+if __name__ == '__main__':
+    homedir = environ.get('homedir')
+    sf_prefix_list = environ.get('sf_prefix_list')
+    sf_prefix_swap = environ.get('sf_prefix_swap')
+    sf_apiVersion = environ.get('sf_apiVersion')
+
+    args = __parser_config().parse_args()
+
+    homedir = args.homedir if args.homedir is not None else homedir
+    sf_prefix_list = args.sf_prefix_list if args.sf_prefix_list is not None \
+        else sf_prefix_list
+    sf_prefix_swap = args.sf_prefix_swap if args.sf_prefix_swap is not None \
+        else sf_prefix_swap
+    sf_apiVersion = args.sf_apiVersion if args.sf_apiVersion is not None \
+        else sf_apiVersion
+    __args_verify(homedir)
+
+    main(homedir, sf_prefix_list, sf_prefix_swap, sf_apiVersion, args.debounce,
+         args.poll)
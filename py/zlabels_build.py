@@ -43,8 +43,9 @@ from sys import exit
 
 from lxml import etree
 
+from tools_io import write_bytes
 from tools_lxml import namespace_declare, namespace_prepend, print_tree, \
-    sforce_root, sub_element_text
+    load_tree, sforce_root, sub_element_text
 
 # ---- NOTE TO READER ----
 # In Python, all functions must be declared before they are used.
@@ -162,15 +163,12 @@ def build_meta():
 
 
 def main_write_zlabels_metadata(homedir):
-    f = open(path.join(homedir, 'src/classes', 'ZLabels.cls-meta.xml'), 'w')
-    f.write(build_meta())
-    f.close()
+    write_bytes(path.join(homedir, 'src/classes', 'ZLabels.cls-meta.xml'),
+                build_meta())
 
 
 def main_write_zlabels_class(homedir, zlabel_class):
-    f = open(path.join(homedir, 'src/classes', 'ZLabels.cls'), 'w')
-    f.write(zlabel_class)
-    f.close()
+    write_bytes(path.join(homedir, 'src/classes', 'ZLabels.cls'), zlabel_class)
 
 
 def main_zlabels_class(root):
@@ -180,7 +178,7 @@ def main_zlabels_class(root):
 
 def main_labels_metadata(homedir):
     filename = path.join(homedir, 'src/labels', 'CustomLabels.labels')
-    tree = etree.parse(filename)
+    tree = load_tree(filename)
     return tree.getroot()
 
 